@@ -0,0 +1,236 @@
+##########################################################
+# Planning benchmarks
+#
+# Times the planner hot path headless and offline: a simulated robot and webcam,
+# and a tiny randomly initialized param2img model written to a temporary cache_dir.
+#
+#   cd benchmarks
+#   python benchmark_planning.py --output baseline.json
+#   python benchmark_planning.py --output new.json --compare baseline.json
+##########################################################
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import datetime
+
+import numpy as np
+import torch
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from options import Options
+from param2stroke import StrokeParametersToImage
+from robot import SimulatedRobot
+from camera.dslr import SimulatedWebCam
+from painter import Painter
+from painting_optimization import optimize_painting, pyramid_report
+from my_tensorboard import TensorBoard
+from paint_utils3 import canvas_to_global_coordinates, discretize_colors, parse_csv_line_continuous, \
+        random_init_painting, sort_brush_strokes_by_location
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+def make_cache_dir(cache_dir, opt, seed=0):
+    ''' Write a tiny random param2img checkpoint and its settings, like train_param2stroke would '''
+    torch.manual_seed(seed)
+    torch.save(StrokeParametersToImage().state_dict(), os.path.join(cache_dir, 'param2img.pt'))
+    settings = {
+        'w_p2i_m': opt.MAX_STROKE_LENGTH + 0.04,
+        'h_p2i_m': 2*opt.MAX_BEND + 0.002,
+        'xtra_room_horz_m': 0.01,
+        'xtra_room_vert_m': 0.001,
+        'MAX_BEND': opt.MAX_BEND,
+    }
+    with open(os.path.join(cache_dir, 'param2stroke_settings.json'), 'w') as f:
+        json.dump(settings, f, indent=4)
+
+def get_options(cache_dir, materials_json, render_height):
+    opt = Options()
+    parser = opt.initialize(argparse.ArgumentParser())
+    opt.opt = vars(parser.parse_args(['--simulate', '--cache_dir', cache_dir,
+        '--materials_json', materials_json, '--render_height', str(render_height)]))
+    with open(materials_json, 'r') as f:
+        opt.opt = {**opt.opt, **json.load(f)}
+
+    opt.h_render = int(opt.render_height)
+    opt.w_render = int(opt.render_height * (opt.CANVAS_WIDTH_M/opt.CANVAS_HEIGHT_M))
+    opt.writer = TensorBoard(os.path.join(cache_dir, 'tensorboard'))
+    return opt
+
+def get_simulated_painter(opt):
+    ''' Painter with a SimulatedRobot and SimulatedWebCam, skipping the calibration that needs a person '''
+    painter = Painter.__new__(Painter)
+    painter.opt = opt
+    painter.robot = SimulatedRobot(debug=False)
+    painter.camera = SimulatedWebCam(opt)
+    painter.H_coord = None
+    painter.Z_CANVAS = opt.INIT_TABLE_Z
+    painter.Z_MAX_CANVAS = opt.INIT_TABLE_Z - 0.01
+    painter.Z_RANGE = np.abs(painter.Z_MAX_CANVAS - painter.Z_CANVAS)
+    return painter
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def time_it(f, repeats, setup=None, warmup=1):
+    ''' Median and min seconds of f() over repeats. setup() is run untimed before each call '''
+    times = []
+    for i in range(warmup + repeats):
+        if setup is not None: setup()
+        sync()
+        start = time.perf_counter()
+        f()
+        sync()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return {'median_s':float(np.median(times)), 'min_s':float(np.min(times)), 'repeats':repeats}
+
+def run_benchmarks(args):
+    results = []
+    for render_height in args.render_heights:
+        for n_strokes in args.stroke_counts:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                opt = get_options(cache_dir, args.materials_json, render_height)
+                make_cache_dir(cache_dir, opt, seed=args.seed)
+                h, w = opt.h_render, opt.w_render
+
+                torch.manual_seed(args.seed)
+                np.random.seed(args.seed)
+                painter = get_simulated_painter(opt)
+                background = painter.camera.get_canvas_tensor(h, w).to(device)[:,:3] / 255.
+                painting = random_init_painting(opt, background, n_strokes, device=device)
+                palette = torch.rand((opt.n_colors, 3), device=device)
+                n = len(painting) # random_init_painting puts strokes on a square grid
+
+                def record(case, timing):
+                    timing.update({'case':case, 'n_strokes':n, 'render_height':render_height})
+                    results.append(timing)
+                    print('{:>32} n_strokes={:<6} render_height={:<5} median {:.4f}s'.format(
+                        case, n, render_height, timing['median_s']))
+
+                def forward():
+                    with torch.no_grad():
+                        painting(h, w, use_alpha=False)
+                record('forward', time_it(forward, args.repeats))
+
+                def forward_backward():
+                    painting.zero_grad()
+                    painting(h, w, use_alpha=False).mean().backward()
+                record('forward_backward', time_it(forward_backward, args.repeats))
+
+                record('discretize_colors', time_it(lambda : discretize_colors(painting, palette), args.repeats))
+                record('cluster_colors', time_it(lambda : painting.cluster_colors(opt.n_colors), args.repeats))
+                record('sort_brush_strokes_by_location',
+                       time_it(lambda : sort_brush_strokes_by_location(painting), args.repeats))
+
+                csv = painting.to_csv()
+                record('to_csv', time_it(painting.to_csv, args.repeats))
+                record('csv_parse', time_it(lambda : [parse_csv_line_continuous(l) for l in csv.split('\n')],
+                                            args.repeats))
+
+                def execute():
+                    for stroke in painting.brush_strokes:
+                        x, y = stroke.transformation.xt.item()*0.5+0.5, stroke.transformation.yt.item()*0.5+0.5
+                        y = 1-y
+                        x, y = min(max(x,0.),1.), min(max(y,0.),1.) #safety
+                        x_glob, y_glob,_ = canvas_to_global_coordinates(x,y,None, opt)
+                        stroke.execute(painter, x_glob, y_glob, stroke.transformation.a.item())
+                record('execute', time_it(execute, args.repeats))
+
+                if args.optim_iter > 0:
+                    target = torch.rand((1,3,h,w), device=device)
+                    opt.objective, opt.objective_weight = ['l2'], [1.0]
+                    opt.objective_data_loaded = [target]
+                    def optimize():
+                        optimize_painting(opt, painting, optim_iter=args.optim_iter, color_palette=palette)
+                    timing = time_it(optimize, max(1, args.repeats // 2))
+                    timing['median_s'] /= args.optim_iter
+                    timing['min_s'] /= args.optim_iter
+                    record('optimize_painting_per_iter', timing)
+
+                    if args.compile_step:
+                        # Same iterations with --compile_step. The first call compiles and is the warmup
+                        opt.compile_step = True
+                        timing = time_it(optimize, max(1, args.repeats // 2))
+                        opt.compile_step = False
+                        timing['median_s'] /= args.optim_iter
+                        timing['min_s'] /= args.optim_iter
+                        record('optimize_painting_per_iter_compiled', timing)
+
+                if args.pyramid_levels > 1 and args.optim_iter > 0:
+                    # Wall-clock time and final loss, coarse-to-fine vs single resolution
+                    for r in pyramid_report(opt, painting, args.optim_iter, color_palette=palette, seed=args.seed,
+                                            schedules=[(1, None), (args.pyramid_levels, None)]):
+                        record('pyramid_levels_{}'.format(r['levels']),
+                               {'median_s':r['seconds'], 'min_s':r['seconds'], 'repeats':1, 'loss':r['loss']})
+    return results
+
+def get_metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'git_commit': commit,
+        'torch': torch.__version__,
+        'device': torch.cuda.get_device_name() if device.type == 'cuda' else platform.processor(),
+    }
+
+def compare(results, baseline_fn, threshold):
+    ''' Print how each case changed from a previous run. Returns the cases slower by more than threshold '''
+    with open(baseline_fn, 'r') as f:
+        baseline = json.load(f)['results']
+    key = lambda r : (r['case'], r['n_strokes'], r['render_height'])
+    baseline = {key(r):r for r in baseline}
+
+    regressions = []
+    print('\nCompared to', baseline_fn)
+    for r in results:
+        if key(r) not in baseline: continue
+        ratio = r['median_s'] / max(baseline[key(r)]['median_s'], 1e-12)
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- slower'
+            regressions.append(key(r))
+        print('{:>32} n_strokes={:<6} render_height={:<5} {:.2f}x{}'.format(*key(r), ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FRIDA planning benchmarks')
+    parser.add_argument('--stroke_counts', nargs='*', type=int, default=[100, 400, 1600])
+    parser.add_argument('--render_heights', nargs='*', type=int, default=[128, 256, 512])
+    parser.add_argument('--optim_iter', type=int, default=10, help='Iterations to time optimize_painting over. 0 to skip')
+    parser.add_argument('--compile_step', action='store_true', help='Also time optimize_painting with --compile_step')
+    parser.add_argument('--pyramid_levels', type=int, default=0, help='Compare a coarse-to-fine schedule with \
+            this many levels to the single resolution one. 0 to skip')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--materials_json', type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'materials.json'))
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--compare', type=str, default=None, help='Results JSON from an earlier run to compare to')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    with open(args.output, 'w') as f:
+        json.dump({'metadata':get_metadata(), 'args':vars(args), 'results':results}, f, indent=4)
+    print('Saved results to', args.output)
+
+    if args.compare is not None:
+        regressions = compare(results, args.compare, args.threshold)
+        if len(regressions) > 0:
+            print('{} cases slower than {:.2f}x'.format(len(regressions), args.threshold))
+            sys.exit(1)
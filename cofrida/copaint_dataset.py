@@ -26,7 +26,12 @@ class CoPaintDataset(Dataset):
         Arguments:
             root_dir (string): Directory with all the images.
         """
-        if os.path.exists(data_dict_path):
+        if os.path.isdir(data_dict_path):
+            # --output_parent_dir of create_copaint_data.py, read its manifest
+            from copaint_manifest import load_manifest
+            self.data_dict = load_manifest(data_dict_path)
+            data_dict_path = os.path.join(data_dict_path, 'data_dict.pkl')
+        elif os.path.exists(data_dict_path):
             self.data_dict = pickle.load(open(data_dict_path,'rb'))
         else:
             print('could not find data pickle file', data_dict_path)
@@ -0,0 +1,209 @@
+'''
+Append-only manifest of the CoFRIDA training data, so several create_copaint_data.py
+workers can generate data into the same --output_parent_dir and pick up where they left off.
+
+output_parent_dir/
+    manifest/worker{id}.jsonl   One line per finished sample (a target and the paintings made from it),
+                                only ever appended to by that worker
+    manifest/legacy.jsonl       Entries from a data_dict.pkl made before the manifest existed
+    manifest/meta.json          First entry id to use for new samples
+    claims/{range}.claim        Which worker owns each range of sample ids. {range}.{generation}.claim
+                                once another worker took it over from a worker that stopped
+
+Each line is {"sample_id": int, "worker": int, "entries": [data_dict entries]}. A sample is done once
+its line is in the manifest. A line cut off by a crash is ignored, and the sample gets redone.
+'''
+
+import os
+import json
+import pickle
+import tempfile
+import time
+
+def manifest_dir(output_parent_dir):
+    return os.path.join(output_parent_dir, 'manifest')
+
+def read_manifest_lines(output_parent_dir):
+    ''' Every complete line of every shard '''
+    d = manifest_dir(output_parent_dir)
+    if not os.path.exists(d): return []
+    lines = []
+    for fn in sorted(os.listdir(d)):
+        if not fn.endswith('.jsonl'): continue
+        with open(os.path.join(d, fn), 'r') as f:
+            for line in f:
+                try:
+                    lines.append(json.loads(line))
+                except ValueError:
+                    pass # Partially written line
+    return lines
+
+def load_manifest(output_parent_dir):
+    ''' All the data_dict entries in the manifest, sorted by id. Same format as data_dict.pkl '''
+    entries, seen = [], set()
+    for line in read_manifest_lines(output_parent_dir):
+        if line['sample_id'] is not None:
+            # A sample could have been redone after a crash right after its line was written
+            if line['sample_id'] in seen: continue
+            seen.add(line['sample_id'])
+        entries += line['entries']
+    return sorted(entries, key=lambda e : e['id'])
+
+def write_data_dict(output_parent_dir, data_dict_fn=None):
+    ''' Export the manifest to data_dict.pkl for the training scripts. Written to a temporary file first. '''
+    data_dict_fn = os.path.join(output_parent_dir, 'data_dict.pkl') if data_dict_fn is None else data_dict_fn
+    with open(data_dict_fn + '.tmp', 'wb') as f:
+        pickle.dump(load_manifest(output_parent_dir), f)
+    os.replace(data_dict_fn + '.tmp', data_dict_fn)
+    return data_dict_fn
+
+def publish_file(fn, text, replace=False):
+    '''
+    Write text to fn atomically: other processes see either no file or the whole file.
+    Written to a temporary file in the same directory first, then renamed (replace=True) or
+    hard linked to fn, which fails if fn already exists.
+    returns:
+        bool : whether fn was written
+    '''
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=os.path.basename(fn), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if replace:
+            os.rename(tmp_fn, fn)
+            return True
+        try:
+            os.link(tmp_fn, fn)
+            return True
+        except FileExistsError:
+            return False
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+def read_json(fn, attempts=50):
+    ''' Read a json file, waiting for it if it is missing or (written by an older version) half written '''
+    for attempt in range(attempts):
+        try:
+            with open(fn, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            time.sleep(0.1)
+    raise Exception('Could not read {}'.format(fn))
+
+def get_id_offset(output_parent_dir):
+    '''
+    First entry id for new samples. The first time, any data_dict.pkl from before the manifest
+    existed goes into manifest/legacy.jsonl and new ids start after its entries.
+    Several workers can call this at the same time, all of them get the same offset.
+    '''
+    d = manifest_dir(output_parent_dir)
+    os.makedirs(d, exist_ok=True)
+    meta_fn = os.path.join(d, 'meta.json')
+    if not os.path.exists(meta_fn):
+        id_offset = 0
+        legacy_fn = os.path.join(output_parent_dir, 'data_dict.pkl')
+        if os.path.exists(legacy_fn):
+            legacy = pickle.load(open(legacy_fn, 'rb'))
+            lines = [json.dumps({'sample_id':None, 'worker':None, 'entries':[entry]}) + '\n' for entry in legacy]
+            # Every worker here read the same data_dict.pkl, so it doesn't matter whose legacy.jsonl
+            # is the one left. Once meta.json exists, data_dict.pkl is exported from the manifest
+            if not os.path.exists(meta_fn):
+                publish_file(os.path.join(d, 'legacy.jsonl'), ''.join(lines), replace=True)
+            id_offset = 1 + max([e['id'] for e in legacy]) if len(legacy) > 0 else 0
+        # Only the first worker's meta.json is used
+        publish_file(meta_fn, json.dumps({'id_offset':id_offset}))
+    return read_json(meta_fn)['id_offset']
+
+class ManifestWriter(object):
+    def __init__(self, output_parent_dir, worker_id):
+        os.makedirs(manifest_dir(output_parent_dir), exist_ok=True)
+        self.fn = os.path.join(manifest_dir(output_parent_dir), 'worker{}.jsonl'.format(worker_id))
+        self.worker_id = worker_id
+        self.f = open(self.fn, 'a')
+
+    def append(self, sample_id, entries):
+        ''' Record a finished sample. One write, flushed to disk before returning. '''
+        self.f.write(json.dumps({'sample_id':sample_id, 'worker':self.worker_id, 'entries':entries}) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+def claim_fn(claims_dir, r, generation=0):
+    if generation == 0:
+        return os.path.join(claims_dir, '{:06d}.claim'.format(r))
+    return os.path.join(claims_dir, '{:06d}.{}.claim'.format(r, generation))
+
+def create_claim(fn, worker_id):
+    ''' Exclusive file creation, only one worker can make a given claim file '''
+    try:
+        fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(worker_id))
+    return True
+
+def latest_claim(claims_dir, r):
+    '''
+    The newest claim on range r. A range that was taken over has a claim file per generation.
+    returns:
+        (int, str, str) : generation, owner and file name, or None if nobody claimed it
+    '''
+    if not os.path.exists(claim_fn(claims_dir, r)):
+        return None
+    generation = 0
+    while os.path.exists(claim_fn(claims_dir, r, generation + 1)):
+        generation += 1
+    fn = claim_fn(claims_dir, r, generation)
+    with open(fn, 'r') as f:
+        return generation, f.read().strip(), fn
+
+def claim_ranges(output_parent_dir, worker_id, n_samples, range_size, stale_after=0):
+    '''
+    Sample ids this worker should generate: the ones in ranges it claimed before (to resume them)
+    and then in new ranges that nobody has claimed. Claiming is an exclusive file creation, so two
+    workers never get the same range.
+
+    The claim's modification time is updated before each sample id is handed out. A worker that
+    crashed stops doing that. Its ranges are resumed by restarting it with the same worker_id or, with
+    stale_after > 0, taken over by any worker once the claim is older than stale_after seconds.
+    Taking over creates the next generation of the claim file, also exclusively. The previous owner
+    stops handing out ids from that range when it sees the newer claim.
+    kwargs:
+        stale_after (float) : seconds. 0 to never take over ranges from other workers
+    returns:
+        generator of sample ids
+    '''
+    claims_dir = os.path.join(output_parent_dir, 'claims')
+    os.makedirs(claims_dir, exist_ok=True)
+    for r in range((n_samples + range_size - 1) // range_size):
+        claim = latest_claim(claims_dir, r)
+        if claim is None:
+            fn = claim_fn(claims_dir, r)
+            if not create_claim(fn, worker_id):
+                continue
+        else:
+            generation, owner, fn = claim
+            if owner != str(worker_id):
+                try:
+                    stale = stale_after > 0 and time.time() - os.path.getmtime(fn) > stale_after
+                except FileNotFoundError:
+                    stale = False
+                if not stale:
+                    continue
+                fn = claim_fn(claims_dir, r, generation + 1)
+                if not create_claim(fn, worker_id):
+                    continue
+                print('Worker {} took over samples {}-{} from worker {}'.format(
+                    worker_id, r*range_size, min((r+1)*range_size, n_samples) - 1, owner))
+
+        for sample_id in range(r*range_size, min((r+1)*range_size, n_samples)):
+            if latest_claim(claims_dir, r)[2] != fn:
+                break # Taken over
+            os.utime(fn)
+            yield sample_id
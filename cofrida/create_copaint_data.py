@@ -19,6 +19,9 @@ import torch
 import random
 import numpy as np
 import copy
+import time
+import queue
+import threading
 import cv2
 from datasets import load_dataset
 from PIL import Image
@@ -30,6 +33,7 @@ from torchvision import transforms
 from torchvision.transforms import InterpolationMode 
 bicubic = InterpolationMode.BICUBIC
 from torchvision.utils import save_image
+from async_writer import get_image_writer
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -46,6 +50,10 @@ from paint_utils3 import format_img, initialize_painting, \
         load_img, get_colors
 from clip_attn import get_attention
 from painting_optimization import parse_objective
+from losses.clip_loss import clip_conv_loss_batch
+from multi_start import render_paintings, loss_lock
+from copaint_manifest import ManifestWriter, claim_ranges, get_id_offset, load_manifest, \
+        read_manifest_lines, write_data_dict
 from options import Options
 
 from transformers import CLIPProcessor, CLIPModel, CLIPTokenizer, CLIPTextModel
@@ -57,6 +65,8 @@ if not os.path.exists('../src/clipscore/'):
     print('You have to clone the clipscore repo here from Github.')
 sys.path.append('../src/clipscore')
 from clipscore import get_clip_score, extract_all_images
+from clip_registry import get_clip_model
+from convergence import get_convergence_monitor
 
 # Load the CLIP model
 device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -122,7 +132,9 @@ def plan_from_image(opt, num_strokes, target_img, current_canvas, clip_lr=1.0):
     og_lrs = [o.param_groups[0]['lr'] if o is not None else None for o in optims]
     plans = []
 
+    monitor = get_convergence_monitor(opt, painting, opt.n_iters)
     for it in tqdm(range(opt.n_iters), desc="Optim. {} Strokes".format(len(painting.brush_strokes))):
+        if monitor.skip(it): continue
         for o in optims: o.zero_grad() if o is not None else None
 
         lr_factor = (1 - np.abs(it/opt.n_iters)) + 0.001 # 1.001 -> 0.001
@@ -139,13 +151,15 @@ def plan_from_image(opt, num_strokes, target_img, current_canvas, clip_lr=1.0):
         # loss += parse_objective('l2', target_img, p[:,:3], weight=1-t)
         # loss += parse_objective('clip_conv_loss', target_img, p[:,:3], weight=clip_lr)
         # loss += parse_objective('l2', target_img, p[:,:3], weight=1)
-        loss += parse_objective('clip_conv_loss', target_img, p[:,:3], weight=1)
+        with loss_lock: # The CLIP model is shared with the scoring stage
+            loss += parse_objective('clip_conv_loss', target_img, p[:,:3], weight=1)
 
 
         loss.backward()
 
         for o in optims: o.step() if o is not None else None
         painting.validate()
+        monitor.update(loss, it)
 
         if not opt.ink:
             painting = sort_brush_strokes_by_color(painting, bin_size=opt.bin_size)
@@ -159,10 +173,64 @@ def plan_from_image(opt, num_strokes, target_img, current_canvas, clip_lr=1.0):
         #     p = format_img(p)
         #     plans.append((p*255.).astype(np.uint8))
 
+    monitor.log(opt.writer, 'plan_from_image')
+
     # to_video(plans, fn=os.path.join(opt.plan_gif_dir,'controlnet_training{}.mp4'.format(str(time.time()))))
     # video_path = os.path.join(output_dir, 'id{}_{}strokes.jpg'.format(len(data_dict), opt.max_strokes_added))
     return painting
 
+def plan_from_images(opt, num_strokes, target_imgs, current_canvases, batch_colors):
+    '''
+    plan_from_image for a batch of targets at once. The paintings are rendered in one 
+    param2img batch and the CLIP conv loss of all of them is one call.
+    args:
+        num_strokes (list[int]), target_imgs (list[torch.Tensor[1,3,h,w]]), 
+        current_canvases (list[torch.Tensor[1,3,h,w]]), batch_colors (list[torch.Tensor[n_colors,3]])
+    returns:
+        list[Painting]
+    '''
+    paintings = []
+    for n, target_img, current_canvas in zip(num_strokes, target_imgs, current_canvases):
+        painting = initialize_painting(opt, 0, target_img, current_canvas, opt.ink)
+        painting.to(device)
+        painting = add_strokes_to_painting(opt, painting, painting(h,w)[:,:3], n, 
+                                            target_img, current_canvas, opt.ink)
+        painting.validate()
+        paintings.append(painting)
+    optims = [painting.get_optimizers(multiplier=opt.lr_multiplier, ink=opt.ink) for painting in paintings]
+
+    # Learning rate scheduling. Start low, middle high, end low
+    og_lrs = [[o.param_groups[0]['lr'] if o is not None else None for o in optim] for optim in optims]
+
+    monitor = get_convergence_monitor(opt, paintings, opt.n_iters)
+    for it in tqdm(range(opt.n_iters), desc="Optim. {} Paintings".format(len(paintings))):
+        if monitor.skip(it): continue
+        lr_factor = (1 - np.abs(it/opt.n_iters)) + 0.001 # 1.001 -> 0.001
+        for optim, lrs in zip(optims, og_lrs):
+            for o, lr in zip(optim, lrs):
+                if o is not None:
+                    o.zero_grad()
+                    o.param_groups[0]['lr'] = lr*lr_factor
+
+        p = torch.cat(render_paintings(paintings, h, w, use_alpha=True), dim=0)
+        with loss_lock: # The CLIP model is shared with the scoring stage
+            loss = clip_conv_loss_batch(p[:,:3], target_imgs).sum()
+        loss.backward()
+
+        for b in range(len(paintings)):
+            for o in optims[b]: o.step() if o is not None else None
+            paintings[b].validate()
+
+            if not opt.ink:
+                paintings[b] = sort_brush_strokes_by_color(paintings[b], bin_size=opt.bin_size)
+            
+            if (it % 10 == 0 and it > (0.5*opt.n_iters)) or it > 0.9*opt.n_iters:
+                if not opt.ink:
+                    discretize_colors(paintings[b], batch_colors[b])
+        monitor.update(loss, it)
+    monitor.log(opt.writer, 'plan_from_images')
+    return paintings
+
 def process_pil(im, h=None, w=None):
     if im.mode != 'RGB':
         im = im.convert('RGB')
@@ -315,9 +383,7 @@ def generate_image_text_pair(prompt, pipeline):
 
 def remove_strokes_randomly(painting, min_strokes_added, max_strokes_added):
     to_delete = set(random.sample(range(len(painting.brush_strokes)), max_strokes_added-min_strokes_added))
-    enumerate(painting.brush_strokes)
-    bs = [x for i,x in enumerate(painting.brush_strokes) if not i in to_delete]
-    painting.brush_strokes = torch.nn.ModuleList(bs)
+    painting.brush_strokes.keep([i for i in range(len(painting.brush_strokes)) if not i in to_delete])
     # return painting
     with torch.no_grad():
         p = painting(h*4,w*4)
@@ -417,20 +483,20 @@ def remove_strokes_by_object(painting, target_img):
     return p[:,:3], mask_img, boolean_mask
 
 
-clip_model, _ = clip.load("ViT-B/32", device=device, jit=False)
-clip_model.eval()
-
 def clip_score(text_fn, img_fn):
+    # Same ViT-B/32 the losses use, loaded on first use
+    clip_model, _ = get_clip_model("ViT-B/32", device)
     image_paths = [img_fn]
     candidates = [text_fn]
 
-    image_feats = extract_all_images(
-        image_paths, clip_model, device, batch_size=64, num_workers=8)
+    with loss_lock: # The CLIP model is shared with the planning stage
+        image_feats = extract_all_images(
+            image_paths, clip_model, device, batch_size=64, num_workers=8)
 
-    # get image-text clipscore
-    with torch.no_grad():
-        _, per_instance_image_text, candidate_feats = get_clip_score(
-            clip_model, image_feats, candidates, device)
+        # get image-text clipscore
+        with torch.no_grad():
+            _, per_instance_image_text, candidate_feats = get_clip_score(
+                clip_model, image_feats, candidates, device)
 
     return per_instance_image_text[0]
 
@@ -441,8 +507,6 @@ if __name__ == '__main__':
 
     os.makedirs(opt.output_parent_dir, exist_ok=True)
 
-    data_dict_fn = os.path.join(opt.output_parent_dir, 'data_dict.pkl')
-
     opt.writer = create_tensorboard(log_dir=opt.tensorboard_dir)
 
     w = int(opt.render_height * (opt.CANVAS_WIDTH_M/opt.CANVAS_HEIGHT_M))
@@ -472,10 +536,11 @@ if __name__ == '__main__':
         transforms.ColorJitter(brightness=(0.5, 1.25), hue=0.2, contrast=0.1, saturation=0.2)
     ])
 
-    data_dict = []
-    if os.path.exists(data_dict_fn):
-        data_dict = pickle.load(open(data_dict_fn,'rb'))
-    
+    id_offset = get_id_offset(opt.output_parent_dir)
+    done_samples = set([line['sample_id'] for line in read_manifest_lines(opt.output_parent_dir)])
+    manifest = ManifestWriter(opt.output_parent_dir, opt.cofrida_worker_id)
+    data_dict_fn = os.path.join(opt.output_parent_dir, 'data_dict.pkl')
+
     painting = None
 
     if opt.generate_cofrida_training_data:
@@ -484,26 +549,32 @@ if __name__ == '__main__':
         lora_pipeline = load_lora_data_generator(
             lora_path=lora_model_dir if os.path.exists(os.path.join(lora_model_dir, 'pytorch_lora_weights.bin')) else None)
 
-    for i in range(opt.max_images):
-        if opt.generate_cofrida_training_data:
-            # Update the LoRA model that generates the images to paint
-            if ((i+1)%opt.retrain_cofrida_image_generator) == 0 and (len(data_dict) > 100):
-                print('Training LoRA model on previously made drawings.')
-                del painting, lora_pipeline # Free up memory
-                train_lora_data_generator(data_dict_fn=data_dict_fn, 
-                                        output_dir=lora_model_dir)
-                lora_pipeline = load_lora_data_generator(lora_path=lora_model_dir)
+    removal_methods = ['random', 'random', 'random', 'random', 
+                       'salience', 'not_salience', 'object', 'object', 'all']
 
+    ##########################################################
+    # Each stage runs in its own thread, connected by queues, so that getting targets,
+    # planning, removing strokes, writing images and CLIP scoring overlap.
+    # A sample that fails anywhere isn't written to the manifest, so it's redone on resume.
+    ##########################################################
+    queues = [queue.Queue(maxsize=opt.cofrida_queue_size) for _ in range(4)]
+    plan_queue, removal_queue, write_queue, score_queue = queues
+    batch_size = opt.cofrida_batch_size
+    planning_start, n_planned = time.time(), 0
 
+    def get_target(sample_id):
         # Get a new image
-        try:
-            if opt.generate_cofrida_training_data:
-                datum = generate_image_text_pair(prompts[random.randint(0,len(prompts))], lora_pipeline)
-            else:
-                datum = get_image_text_pair(dataset)
-        except Exception as e:
-            print(e)
-            continue
+        for attempt in range(10):
+            try:
+                if opt.generate_cofrida_training_data:
+                    datum = generate_image_text_pair(prompts[random.randint(0,len(prompts))], lora_pipeline)
+                else:
+                    datum = get_image_text_pair(dataset)
+                break
+            except Exception as e:
+                print(e)
+        else:
+            return None
         target_img_full = crop(datum['img']).to(device)
         target_img = transforms.Resize((h,w), bicubic, antialias=True)(target_img_full)
         
@@ -523,46 +594,121 @@ if __name__ == '__main__':
         current_canvas = bg_aug(default_current_canvas)
 
         full_painting_strokes = random.randint(opt.min_strokes_added, opt.max_strokes_added)
-    
-        painting = plan_from_image(opt, full_painting_strokes, target_img, current_canvas[:,:3])
+        return {'sample_id':sample_id, 'datum':datum, 'datum_no_img':datum_no_img, 
+                'target_img_full':target_img_full, 'target_img':target_img, 'colors':colors, 
+                'current_canvas':current_canvas, 'full_painting_strokes':full_painting_strokes}
+
+    def run_stage(stage, in_queue, out_queue):
+        '''
+        Run stage(items) in a thread. The end of the stream (None) is always sent to out_queue, even
+        if the stage fails. If it stops before the end of its input, the rest of the input is
+        thrown away so that the stages before it don't block on a full queue.
+        '''
+        def items():
+            for item in iter(in_queue.get, None):
+                yield item
+            ended[0] = True
+        ended = [in_queue is None]
+        try:
+            stage(items() if in_queue is not None else None)
+        except Exception as e:
+            print('Exception in', stage.__name__, e)
+        finally:
+            if out_queue is not None:
+                out_queue.put(None)
+            if not ended[0]:
+                for _ in iter(in_queue.get, None): pass
+
+    def acquisition_stage(_):
+        global lora_pipeline
+        n_acquired = 0
+        for sample_id in claim_ranges(opt.output_parent_dir, opt.cofrida_worker_id, opt.max_images, 
+                                      opt.cofrida_claim_size, stale_after=opt.cofrida_claim_timeout):
+            if sample_id in done_samples: continue
+            if opt.generate_cofrida_training_data:
+                # Update the LoRA model that generates the images to paint
+                try:
+                    if ((n_acquired+1)%opt.retrain_cofrida_image_generator) == 0 \
+                            and (len(load_manifest(opt.output_parent_dir)) > 100):
+                        print('Training LoRA model on previously made drawings.')
+                        del lora_pipeline # Free up memory
+                        train_lora_data_generator(data_dict_fn=write_data_dict(opt.output_parent_dir), 
+                                                output_dir=lora_model_dir)
+                        lora_pipeline = load_lora_data_generator(lora_path=lora_model_dir)
+                except Exception as e:
+                    print('Exception retraining the LoRA model', e)
+            n_acquired += 1
+            try:
+                item = get_target(sample_id)
+            except Exception as e:
+                # Skipped, it gets redone on resume
+                print('Exception getting sample {}'.format(sample_id), e)
+                continue
+            if item is not None:
+                plan_queue.put(item)
+
+    def planning_stage(items):
+        global colors, n_planned
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < batch_size:
+                item = next(items, None)
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+            if len(batch) == 0: break
+            try:
+                if len(batch) == 1:
+                    colors = batch[0]['colors']
+                    paintings = [plan_from_image(opt, batch[0]['full_painting_strokes'], batch[0]['target_img'], 
+                                                 batch[0]['current_canvas'][:,:3])]
+                else:
+                    paintings = plan_from_images(opt, [b['full_painting_strokes'] for b in batch], 
+                                                 [b['target_img'] for b in batch],
+                                                 [b['current_canvas'][:,:3] for b in batch], 
+                                                 [b['colors'] for b in batch])
+            except Exception as e:
+                print('Exception', e)
+                continue
+            n_planned += len(paintings)
+            opt.writer.add_scalar('cofrida/paintings_per_hour', 
+                                  n_planned / ((time.time() - planning_start) / 3600.), n_planned)
+            for item, painting in zip(batch, paintings):
+                removal_queue.put((item, painting))
+
+    def removal_stage(items):
+        for item, painting in items:
+            try:
+                write_queue.put(remove_strokes(item, painting))
+            except Exception as e:
+                print('Exception', e)
 
-        # If the painting doesn't fit the text prompt well, just break
+    def remove_strokes(item, painting):
+        ''' Partial paintings made from the full painting with each removal method. 
+        Returns the item, its data_dict entries and the images to write '''
+        datum, datum_no_img = item['datum'], item['datum_no_img']
+        target_img_full, target_img = item['target_img_full'], item['target_img']
+        full_painting_strokes = item['full_painting_strokes']
+        first_id = id_offset + item['sample_id'] * len(removal_methods)
+
+        # Make sub-directories so single directories don't get too big
+        output_rel_dir = os.path.join(str(int(np.floor(first_id/100))),)
+        output_dir = os.path.join(opt.output_parent_dir, output_rel_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Save the target image once per stroke removal method (avoid large memory usage)
+        target_img_rel_path = os.path.join(output_rel_dir, 'id{}_target.png'.format(first_id))
         with torch.no_grad():
             final_painting = painting(h*4,w*4)
-        output_dir = os.path.join(opt.output_parent_dir, str(int(np.floor(len(data_dict)/100))),)
-        output_rel_dir = os.path.join(str(int(np.floor(len(data_dict)/100))),)
-        if not os.path.exists(output_dir): os.mkdir(output_dir)
-        final_img_path = os.path.join(output_dir, 'id{}_{}strokes.png'.format(len(data_dict), full_painting_strokes))
-        save_image(final_painting[:,:3],final_img_path)
-        with warnings.catch_warnings(): # suppress annoing clip_score warning
-            warnings.simplefilter("ignore")
-            cs = clip_score(datum['TEXT'], final_img_path)
-        # print('clip score:', cs, datum['TEXT'])
-
-        target_img_already_saved = False
-        for method in ['random', 'random', 'random', 'random', 
-                       'salience', 'not_salience', 'object', 'object', 'all']:
-            try:
-                # Make sub-directories so single directories don't get too big
-                output_dir = os.path.join(opt.output_parent_dir,
-                                        str(int(np.floor(len(data_dict)/100))),)
-                output_rel_dir = os.path.join(str(int(np.floor(len(data_dict)/100))))
-                if not os.path.exists(output_dir): os.mkdir(output_dir)
-
-                # Save the target image once per stroke removal method (avoid large memory usage)
-                if not target_img_already_saved:
-                    target_img_path = os.path.join(output_dir, 'id{}_target.png'.format(len(data_dict)))
-                    target_img_rel_path = os.path.join(output_rel_dir, 'id{}_target.png'.format(len(data_dict)))
-                    save_image(target_img_full[:,:3],target_img_path)
-                    target_img_already_saved = True
-                            
-                with torch.no_grad():
-                    final_painting = painting(h*4,w*4)
-
-                final_img_path = os.path.join(output_dir, 'id{}_{}strokes.png'.format(len(data_dict), full_painting_strokes))
-                final_img_rel_path = os.path.join(output_rel_dir, 'id{}_{}strokes.png'.format(len(data_dict), full_painting_strokes))
-                save_image(final_painting[:,:3],final_img_path)
+        final_img_rel_path = os.path.join(output_rel_dir, 'id{}_{}strokes.png'.format(first_id, full_painting_strokes))
+        images = [(target_img_rel_path, target_img_full[:,:3]), (final_img_rel_path, final_painting[:,:3])]
 
+        entries = []
+        for k, method in enumerate(removal_methods):
+            entry_id = first_id + k
+            try:
                 # How many strokes in the random removal canvas
                 partial_painting_strokes = random.randint(int(0.25*full_painting_strokes), int(0.75*full_painting_strokes))
 
@@ -574,13 +720,10 @@ if __name__ == '__main__':
                     # Remove strokes by region
                     start_painting, attn, salient = remove_strokes_by_region(copy.deepcopy(painting), 
                                                             target_img, datum["TEXT"])
-                    attn_path = os.path.join(output_dir, 'id{}_{}_attn.png'.format(len(data_dict), 
-                                                                            full_painting_strokes))
-                    save_image(attn[None,None].float().repeat((1,3,1,1)), attn_path)
-                    salience_path = os.path.join(output_dir, 'id{}_{}_salience.png'.format(len(data_dict), 
-                                                                            full_painting_strokes))
-                    save_image(salient[None,None].float().repeat((1,3,1,1)), salience_path)
-                    
+                    images.append((os.path.join(output_rel_dir, 'id{}_{}_attn.png'.format(entry_id, full_painting_strokes)),
+                                   attn[None,None].float().repeat((1,3,1,1))))
+                    images.append((os.path.join(output_rel_dir, 'id{}_{}_salience.png'.format(entry_id, full_painting_strokes)),
+                                   salient[None,None].float().repeat((1,3,1,1))))
                 elif method == 'not_salience':
                     # Remove strokes by region
                     start_painting, attn, salient = remove_strokes_by_region(copy.deepcopy(painting), 
@@ -588,13 +731,11 @@ if __name__ == '__main__':
                 elif method == 'object':
                     start_painting, mask_img, boolean_mask = remove_strokes_by_object(copy.deepcopy(painting), 
                                                             target_img)
-                    mask_path = os.path.join(output_dir, 'id{}_{}_mask.png'.format(len(data_dict), 
-                                                                            full_painting_strokes))
-                    Image.fromarray((mask_img*254).astype(np.uint8)).save(mask_path)
-                    boolean_mask_path = os.path.join(output_dir, 'id{}_{}_bool_obj_mask.png'.format(len(data_dict), 
-                                                                            full_painting_strokes))
+                    images.append((os.path.join(output_rel_dir, 'id{}_{}_mask.png'.format(entry_id, full_painting_strokes)),
+                                   Image.fromarray((mask_img*254).astype(np.uint8))))
                     boolean_mask = boolean_mask[0].cpu().numpy().transpose(1,2,0)
-                    Image.fromarray((boolean_mask*254).astype(np.uint8)).save(boolean_mask_path)
+                    images.append((os.path.join(output_rel_dir, 'id{}_{}_bool_obj_mask.png'.format(entry_id, full_painting_strokes)),
+                                   Image.fromarray((boolean_mask*254).astype(np.uint8))))
                 elif method == 'all':
                     start_painting = painting.background_img
                 else:
@@ -609,11 +750,10 @@ if __name__ == '__main__':
                 #     # print('not different enough')
                 #     continue
 
-                start_img_path = os.path.join(output_dir, 'id{}_start.png'.format(len(data_dict)))
-                start_img_rel_path = os.path.join(output_rel_dir, 'id{}_start.png'.format(len(data_dict)))
-                save_image(start_painting[:,:3],start_img_path)
+                start_img_rel_path = os.path.join(output_rel_dir, 'id{}_start.png'.format(entry_id))
+                images.append((start_img_rel_path, start_painting[:,:3]))
 
-                d = {'id':len(data_dict),
+                entries.append({'id':entry_id,
                         'num_strokes_added':full_painting_strokes-partial_painting_strokes,
                         'num_prev_strokes':partial_painting_strokes,
                         'start_img':start_img_rel_path,
@@ -623,24 +763,56 @@ if __name__ == '__main__':
                     #  'text':datum['text'],#sketches
                         'text':datum['TEXT'],
                         'photo_to_sketch_diff': diff.item(),
-                        'clip_score':cs,
-                        'dataset_info':datum_no_img}
-
-                # current_canvas = p.detach()
-                # start_img_path = final_img_path
-
-                current_canvas = final_painting.detach()
-                current_canvas = transforms.Resize((h,w), antialias=True)(current_canvas)
+                        'clip_score':None,
+                        'dataset_info':datum_no_img})
+            except Exception as e:
+                print('Exception', e)
+                continue
+        return item, entries, images
 
-                data_dict.append(d)
+    def writing_stage(items):
+        # The images are encoded and written by the image writer's threads. The scoring stage waits
+        # for them before reading the final image and recording the sample.
+        image_writer = get_image_writer(num_workers=opt.image_writer_workers, max_queue=opt.image_writer_queue)
+        for item, entries, images in items:
+            try:
+                written = []
+                for rel_path, img in images:
+                    path = os.path.join(opt.output_parent_dir, rel_path)
+                    if torch.is_tensor(img):
+                        written.append(image_writer.save_image(img, path))
+                    else:
+                        written.append(image_writer.submit(lambda img=img, path=path : img.save(path)))
+                score_queue.put((item, entries, written))
+            except Exception as e:
+                print('Exception', e)
 
-                if os.path.exists(data_dict_fn):
-                    shutil.copyfile(data_dict_fn,
-                                os.path.join(opt.output_parent_dir, 'data_dict_saved.pkl'))
-                                    
-                with open(data_dict_fn,'wb') as f:
-                    pickle.dump(data_dict, f)
+    def scoring_stage(items):
+        for item, entries, written in items:
+            try:
+                # Don't record the sample if any of its images failed to write, so it gets redone on resume
+                failed = [Exception('dropped') if done is None else done.exception() for done in written]
+                failed = [e for e in failed if e is not None]
+                if len(failed) > 0:
+                    print('Sample {} not recorded, writing its images failed:'.format(item['sample_id']), failed[0])
+                    continue
+                if len(entries) > 0:
+                    with warnings.catch_warnings(): # suppress annoing clip_score warning
+                        warnings.simplefilter("ignore")
+                        cs = clip_score(item['datum']['TEXT'], 
+                                        os.path.join(opt.output_parent_dir, entries[0]['final_img']))
+                    for entry in entries: entry['clip_score'] = cs
+                manifest.append(item['sample_id'], entries)
             except Exception as e:
                 print('Exception', e)
-                continue
-        
+
+    stages = [acquisition_stage, planning_stage, removal_stage, writing_stage, scoring_stage]
+    stage_queues = [None] + queues + [None]
+    threads = [threading.Thread(target=run_stage, args=(stage, stage_queues[k], stage_queues[k+1]), name=stage.__name__) 
+               for k, stage in enumerate(stages)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    manifest.close()
+
+    # For the training scripts
+    write_data_dict(opt.output_parent_dir, data_dict_fn)
@@ -0,0 +1,121 @@
+'''
+Write images in the background so the planning loop doesn't wait on the disk or on PNG/JPEG encoding.
+
+Tensors are copied to pinned host memory with a non-blocking copy on the submitting thread. The
+worker threads wait for that copy, then encode and write (or log to TensorBoard). The queue is
+bounded: when the writers fall behind, submitting blocks and the time spent blocked is counted
+in stats() (or the image is dropped with on_full='drop').
+
+    from async_writer import get_image_writer
+    get_image_writer().save_image(p[:,:3], 'painting.png')
+    get_image_writer().add_image(opt.writer, 'images/plan', p, step)
+'''
+
+import atexit
+import concurrent.futures
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+from torchvision.utils import save_image
+
+
+class AsyncImageWriter(object):
+    def __init__(self, num_workers=2, max_queue=16, on_full='block'):
+        '''
+        kwargs:
+            num_workers (int) : encoding/writing threads
+            max_queue (int) : images that can be waiting before submitting blocks
+            on_full (str) : 'block' to wait for room in the queue, 'drop' to skip the image
+        '''
+        if on_full not in ['block', 'drop']:
+            raise Exception('on_full must be block or drop, not {}'.format(on_full))
+        self.on_full = on_full
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.n_submitted, self.n_dropped, self.n_failed = 0, 0, 0
+        self.blocked_s, self.max_depth = 0., 0
+
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for t in self.workers: t.start()
+
+    def _to_host(self, x):
+        ''' Start copying x to the CPU. Returns the host tensor and an event to wait on (or None) '''
+        x = x.detach()
+        if x.device.type != 'cuda':
+            return x.clone(), None
+        host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        host.copy_(x, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return host, event
+
+    def submit(self, fn, x=None):
+        '''
+        Run fn in a worker thread. If x (torch.Tensor) is given, fn gets its CPU copy.
+        returns:
+            concurrent.futures.Future : done once fn has run. Its result() is fn's return value, or raises
+                fn's exception if the write failed. None if it was dropped because the queue was full
+        '''
+        done = concurrent.futures.Future()
+        job = (fn, done) + (self._to_host(x) if x is not None else (None, None))
+        start = time.perf_counter()
+        try:
+            self.jobs.put(job, block=self.on_full == 'block')
+        except queue.Full:
+            with self.lock: self.n_dropped += 1
+            return None
+        with self.lock:
+            self.blocked_s += time.perf_counter() - start
+            self.n_submitted += 1
+            self.max_depth = max(self.max_depth, self.jobs.qsize())
+        return done
+
+    def _work(self):
+        while True:
+            fn, done, host, event = self.jobs.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                done.set_result(fn() if host is None else fn(host))
+            except Exception as e:
+                with self.lock: self.n_failed += 1
+                print('AsyncImageWriter:', e)
+                done.set_exception(e)
+            finally:
+                self.jobs.task_done()
+
+    def save_image(self, x, path, **kwargs):
+        ''' torchvision.utils.save_image in the background. The file type comes from the extension '''
+        return self.submit(lambda host : save_image(host.float(), path, **kwargs), x)
+
+    def add_image(self, writer, tag, x, step=None, callback=None):
+        ''' Log a (1,C,h,w) tensor to a my_tensorboard.TensorBoard in the background.
+        callback gets the same channels last [0,1] numpy image. '''
+        def log(host):
+            img = np.clip(host[0,:3].float().numpy().transpose(1,2,0), a_min=0, a_max=1)
+            writer.add_image(tag, img, step)
+            if callback is not None: callback(img)
+        return self.submit(log, x)
+
+    def flush(self):
+        ''' Wait for everything submitted so far to be written '''
+        self.jobs.join()
+
+    def stats(self):
+        ''' How much the writers have been holding up the callers '''
+        with self.lock:
+            return {'submitted':self.n_submitted, 'dropped':self.n_dropped, 'failed':self.n_failed,
+                    'queued':self.jobs.qsize(), 'max_queued':self.max_depth, 'blocked_s':self.blocked_s}
+
+image_writer = None
+
+def get_image_writer(num_workers=2, max_queue=16):
+    ''' Process-wide AsyncImageWriter, flushed when the program exits '''
+    global image_writer
+    if image_writer is None:
+        image_writer = AsyncImageWriter(num_workers=num_workers, max_queue=max_queue)
+        atexit.register(image_writer.flush)
+    return image_writer
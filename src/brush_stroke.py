@@ -2,15 +2,8 @@ import copy
 import math
 import torch
 from torch import nn
-import torchgeometry
-import torchvision.transforms as T
-from torchvision.transforms import InterpolationMode 
-bicubic = InterpolationMode.BICUBIC
-import warnings
 import numpy as np
 
-from param2stroke import special_sigmoid
-
 
 def get_quaternion_from_euler(roll, pitch, yaw):
     """
@@ -80,51 +73,162 @@ def rigid_body_transform(a, xt, yt, anchor_x, anchor_y):
     A[0,2,2] = 1
     return A
 
-class RigidBodyTransformation(nn.Module):
+def stroke_trajectories(painter, x_start, y_start, rotation, stroke_length, stroke_bend, stroke_z, stroke_alpha,
+                        step_size=.005, min_points=10, curve_angle_is_rotation=False):
+    '''
+    Robot trajectories of N strokes, all the points evaluated at once.
+    Each stroke is the cubic Bezier curve from BrushStroke.simple_parameterization_to_bezier_points, sampled
+    every step_size meters along its (estimated) arc length, with at least min_points points.
+    args:
+        x_start, y_start (array[N]) : global coordinates (m), before painter.H_coord
+        rotation (array[N]) : radians
+        stroke_length, stroke_bend, stroke_z, stroke_alpha (array[N]) : stroke parameters
+    kwargs:
+        curve_angle_is_rotation : angle the brush down towards the rotation instead of perpendicular to the curve
+    returns:
+        dict of
+            positions (np.array[M,3]) : every point of every stroke, clamped to the canvas
+            orientations (np.array[M,4]) : quaternion [x,y,z,w] of the brush tilt at each point
+            offsets (np.array[N+1]) : stroke i is positions[offsets[i]:offsets[i+1]]
+            off_canvas (np.array[M]) : whether each point was off the canvas (and lifted up a bit)
+            starts (np.array[N,2]) : where each stroke starts, after painter.H_coord
+            ends (np.array[N,2]) : where each stroke ends, clamped to the canvas
+    '''
+    x_start, y_start, rotation = [np.asarray(v, dtype=np.float64).reshape(-1) for v in [x_start, y_start, rotation]]
+    length, bend, z, alpha = [np.asarray(v, dtype=np.float64).reshape(-1) 
+                              for v in [stroke_length, stroke_bend, stroke_z, stroke_alpha]]
+    n_strokes = len(x_start)
+
+    # Need to translate x,y a bit to be accurate according to camera
+    if painter.H_coord is not None:
+        # Translate the coordinates so they're similar. see coordinate_calibration
+        real_coords = np.stack([x_start, y_start, np.ones(n_strokes)], axis=1) @ np.asarray(painter.H_coord).T
+        x_start, y_start = real_coords[:,0]/real_coords[:,2], real_coords[:,1]/real_coords[:,2]
+
+    # Control points (N,4), rotated like BrushStroke.get_rotated_trajectory
+    cx = (np.arange(4)/3.)[None] * length[:,None]
+    cy = np.stack([np.zeros(n_strokes), bend, bend, np.zeros(n_strokes)], axis=1)
+    cz = np.stack([np.full(n_strokes, .2), z, z, np.full(n_strokes, .2)], axis=1)
+    cos_r, sin_r = np.cos(rotation)[:,None], np.sin(rotation)[:,None]
+    ctrl_x, ctrl_y = cos_r*cx - sin_r*cy, sin_r*cx + cos_r*cy
+
+    # Points per stroke from the arc length, estimated as (2*chord + control polygon)/3
+    chord = np.hypot(ctrl_x[:,3] - ctrl_x[:,0], ctrl_y[:,3] - ctrl_y[:,0])
+    polygon = np.hypot(np.diff(ctrl_x, axis=1), np.diff(ctrl_y, axis=1)).sum(axis=1)
+    n_points = np.maximum(min_points, np.ceil((2*chord + polygon) / 3 / step_size)).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(n_points)])
+
+    # Which stroke each point is in and its t in [0,1]
+    stroke_ind = np.repeat(np.arange(n_strokes), n_points)
+    t = (np.arange(offsets[-1]) - offsets[stroke_ind]) / (n_points[stroke_ind] - 1)
+    px, py, cz = ctrl_x[stroke_ind], ctrl_y[stroke_ind], cz[stroke_ind]
+    u = 1 - t
+    bernstein = np.stack([u**3, 3*u**2*t, 3*u*t**2, t**3], axis=1)
+    x = (bernstein * px).sum(axis=1)
+    y = (bernstein * py).sum(axis=1)
+    # Derivative of the curve
+    d_bernstein = np.stack([-3*u**2, 3*u**2 - 6*t*u, 6*t*u - 3*t**2, 3*t**2], axis=1)
+    dx_dt = (d_bernstein * px).sum(axis=1)
+    dy_dt = (d_bernstein * py).sum(axis=1)
+
+    # Depth is piecewise linear between the control points
+    seg = np.where(t < 0.333, 0, np.where(t < 0.666, 1, 2))
+    frac = (t - seg*.333) / .333
+    rows = np.arange(len(t))
+    z = (1 - frac) * cz[rows, seg] + frac * cz[rows, seg+1]
+
+    theta_sphere = np.arctan2(dy_dt, dx_dt) + np.pi/2 # the pi makes it perpendicular to trajectory
+    if curve_angle_is_rotation:
+        theta_sphere = rotation[stroke_ind]
+    phi_sphere = alpha[stroke_ind] # Same alpha throughout stroke, for now.
+    roll = np.cos(theta_sphere)*np.sin(phi_sphere)
+    pitch = np.pi - np.sin(theta_sphere)*np.sin(phi_sphere)
+    yaw = np.full(len(t), np.deg2rad(270.)) # Constant yaw
+    orientations = np.stack(get_quaternion_from_euler(roll, pitch, yaw), axis=1)
+
+    z_range = np.abs(painter.Z_MAX_CANVAS - painter.Z_CANVAS)
+    l = painter.opt.brush_length
+    if l is not None:
+        r = l * np.sin(phi_sphere)
+        x = x + r * np.cos(theta_sphere)
+        y = y + r * np.sin(theta_sphere)
+        dz = l - l * np.cos(phi_sphere)
+        new_z_range = z_range * np.abs(np.cos(phi_sphere))
+        z = painter.Z_CANVAS - z * new_z_range - dz
+    else:
+        z = painter.Z_CANVAS - z * z_range
+
+    x_next = x_start[stroke_ind] + x
+    y_next = y_start[stroke_ind] + y
+    opt = painter.opt
+    # If off the canvas, lift up
+    off_canvas = (x_next > opt.X_CANVAS_MAX) | (x_next < opt.X_CANVAS_MIN) \
+                    | (y_next > opt.Y_CANVAS_MAX) | (y_next < opt.Y_CANVAS_MIN)
+    z = z + 0.005 * off_canvas
+    # Don't over shoot the canvas
+    x_next = np.clip(x_next, opt.X_CANVAS_MIN, opt.X_CANVAS_MAX)
+    y_next = np.clip(y_next, opt.Y_CANVAS_MIN, opt.Y_CANVAS_MAX)
+
+    ends = np.stack([np.clip(x_start + ctrl_x[:,3], opt.X_CANVAS_MIN, opt.X_CANVAS_MAX),
+                     np.clip(y_start + ctrl_y[:,3], opt.Y_CANVAS_MIN, opt.Y_CANVAS_MAX)], axis=1)
+    return {'positions':np.stack([x_next, y_next, z], axis=1), 'orientations':orientations, 'offsets':offsets,
+            'off_canvas':off_canvas, 'starts':np.stack([x_start, y_start], axis=1), 'ends':ends}
+
+def stroke_program(painter, traj, i):
+    '''
+    Instructions that paint stroke i of stroke_trajectories: approach, stroke, lift.
+    Plain lists and floats, so they can be serialized (see plan_compiler.py).
+    returns:
+        list of {'op':'move', 'position':[x,y,z], 'speed':float} and {'op':'stroke', 'positions':[[x,y,z],...]}
+    '''
+    x_start, y_start = traj['starts'][i].tolist()
+    program = [{'op':'move', 'position':[x_start, y_start, painter.Z_CANVAS + 0.03], 'speed':0.4},
+               {'op':'move', 'position':[x_start, y_start, painter.Z_CANVAS + 0.005], 'speed':0.1}]
+
+    start, end = traj['offsets'][i], traj['offsets'][i+1]
+    if traj['off_canvas'][start:end].mean() < 0.9:
+        program.append({'op':'stroke', 'positions':traj['positions'][start:end].tolist()})
+
+    # Don't over shoot the canvas
+    x_next, y_next = traj['ends'][i].tolist()
+    program.append({'op':'move', 'position':[x_next, y_next, painter.Z_CANVAS + 0.04], 'speed':0.3})
+    return program
+
+def run_stroke_program(painter, program):
+    ''' Send a stroke_program to the robot. Returns whether the stroke trajectory completed '''
+    stroke_complete = False
+    for instruction in program:
+        if instruction['op'] == 'move':
+            painter.move_to(*instruction['position'], speed=instruction['speed'])
+        elif instruction['op'] == 'stroke':
+            ######
+            # TODO: fix the tilt of the brush for the Franka robot. Use the orientations from stroke_trajectories
+            orientations = [None] * len(instruction['positions'])
+            ####
+            stroke_complete = painter.move_to_trajectories(instruction['positions'], orientations)
+        else:
+            raise Exception('Not a stroke instruction: {}'.format(instruction['op']))
+    return stroke_complete
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+def _as_stroke_tensor(v):
+    # Single stroke attributes are stored as tensors of shape (1,)
+    return (torch.ones(1)*v).detach().float() if not torch.is_tensor(v) \
+        else v.detach().float().reshape(1)
+
+class StrokeTransformation(object):
+    ''' Rotation (a, in radians) and translation (xt, yt in [-1,1] canvas proportions) of a stroke '''
     def __init__(self, a, xt, yt):
-        super(RigidBodyTransformation, self).__init__()
-        # weights = torch.zeros(3)
-        # weights[0] = a
-        # weights[1] = xt
-        # weights[2] = yt
-        # weights.requires_grad = True
-        # self.weights = nn.Parameter(weights)
-
-        # t = torch.ones(1)
-        # t[0] = xt
-        # t.requires_grad = True
-        # self.xt = nn.Parameter(t)
-
-        # t = torch.ones(1)
-        # t[0] = yt
-        # t.requires_grad = True
-        # self.yt = nn.Parameter(t)
-
-
-        # t = torch.ones(1)
-        # t[0] = a
-        # t.requires_grad = True
-        # self.a = nn.Parameter(t)
-
-        # self.xt.requires_grad = True
-        # self.yt.requires_grad = True
-        # self.a.requires_grad = True
-
-        self.xt = nn.Parameter(torch.ones(1)*xt)
-        self.yt = nn.Parameter(torch.ones(1)*yt)
-        self.a = nn.Parameter(torch.ones(1)*a)
-
-    def forward(self, x):
-        h, w = x.shape[2], x.shape[3]
-        anchor_x, anchor_y = w/2, h/2
-
-        # M = rigid_body_transform(self.weights[0], self.weights[1]*(w/2), self.weights[2]*(h/2), anchor_x, anchor_y)
-        M = rigid_body_transform(self.a[0], self.xt[0]*(w/2), self.yt[0]*(h/2), anchor_x, anchor_y)
-        with warnings.catch_warnings(): # suppress annoing torchgeometry warning
-            warnings.simplefilter("ignore")
-            return torchgeometry.warp_perspective(x, M, dsize=(h,w))
-
-class BrushStroke(nn.Module):
+        self.xt = _as_stroke_tensor(xt)
+        self.yt = _as_stroke_tensor(yt)
+        self.a = _as_stroke_tensor(a)
+
+class BrushStroke(object):
+    ''' A single brush stroke. 
+    Strokes are optimized and rendered together as a StrokeBatch. A BrushStroke is a light
+    weight view of one stroke used to initialize a painting and to execute a stroke on the robot.
+    '''
     def __init__(self, 
                  opt,
                 stroke_length=None, stroke_z=None, stroke_bend=None, stroke_alpha=None,
@@ -132,8 +236,6 @@ class BrushStroke(nn.Module):
                 ink=False,
                 a=None, xt=None, yt=None,
                 device='cuda'):
-        super(BrushStroke, self).__init__()
-
         self.MAX_STROKE_LENGTH = opt.MAX_STROKE_LENGTH
         self.MIN_STROKE_LENGTH = opt.MIN_STROKE_LENGTH
         self.MIN_STROKE_Z = opt.MIN_STROKE_Z
@@ -152,117 +254,19 @@ class BrushStroke(nn.Module):
         if stroke_bend is None: stroke_bend = (torch.rand(1)*2 - 1) * self.MAX_BEND
         stroke_bend = min(stroke_bend, stroke_length) if stroke_bend > 0 else max(stroke_bend, -1*stroke_length)
 
-        self.transformation = RigidBodyTransformation(a, xt, yt)
+        self.transformation = StrokeTransformation(a, xt, yt)
         
-        self.stroke_length = stroke_length
-        self.stroke_z = stroke_z
-        self.stroke_bend = stroke_bend
-        self.stroke_alpha = stroke_alpha
-
-        self.stroke_length.requires_grad = True
-        self.stroke_z.requires_grad = True
-        self.stroke_bend.requires_grad = True
-        self.stroke_alpha.requires_grad = True
-
-        self.stroke_length = nn.Parameter(self.stroke_length)
-        self.stroke_z = nn.Parameter(self.stroke_z)
-        self.stroke_bend = nn.Parameter(self.stroke_bend)
-        self.stroke_alpha = nn.Parameter(self.stroke_alpha)
+        self.stroke_length = _as_stroke_tensor(stroke_length)
+        self.stroke_z = _as_stroke_tensor(stroke_z)
+        self.stroke_bend = _as_stroke_tensor(stroke_bend)
+        self.stroke_alpha = _as_stroke_tensor(stroke_alpha)
 
+        self.ink = ink
         if not ink:
-            self.color_transform = nn.Parameter(color)
+            self.color_transform = color.detach().float()
         else:
             self.color_transform = torch.zeros(3).to(device)
 
-    def forward(self, h, w, param2img):
-        # # Do rigid body transformation
-        # full_param = torch.zeros((1,16)).to(self.stroke_length.device)
-        
-        # # X
-        # full_param[0,0] = 0
-        # full_param[0,4] = self.stroke_length/3 
-        # full_param[0,8] = 2*self.stroke_length/3
-        # full_param[0,12] = self.stroke_length
-        # # Y
-        # full_param[0,1] = 0
-        # full_param[0,5] = self.stroke_bend
-        # full_param[0,9] = self.stroke_bend
-        # full_param[0,13] = 0
-        # # Z
-        # full_param[0,2] = 0.2
-        # full_param[0,6] = self.stroke_z
-        # full_param[0,10] = self.stroke_z
-        # full_param[0,14] = 0.2
-        # # alpha
-        # full_param[0,3] = self.stroke_alpha
-        # full_param[0,7] = self.stroke_alpha
-        # full_param[0,11] = self.stroke_alpha
-        # full_param[0,15] = self.stroke_alpha
-
-        # full_param = torch.zeros((1,16)).to(self.stroke_length.device)
-        full_param = torch.cat([self.stroke_length, self.stroke_bend, self.stroke_z, self.stroke_alpha]).to(self.stroke_length.device)
-        full_param = full_param.unsqueeze(0)
-
-        # model_ind = np.random.randint(len(param2imgs))
-        # # print(model_ind)
-        # stroke = param2imgs[model_ind](full_param).unsqueeze(0)
-        # stroke = pad_for_full(stroke)
-        stroke = param2img(full_param, h, w).unsqueeze(0)
-
-        # Pad 1 or two to make it fit
-        # print('ffff', stroke.shape, h, w)
-        if stroke.shape[2] != h or stroke.shape[3] != w:
-            stroke = T.Resize((h, w), bicubic, antialias=True)(stroke)
-
-        # x = self.transformation(strokes[self.stroke_ind].permute(2,0,1).unsqueeze(0))
-        # from plan import show_img
-        # show_img(stroke)
-        x = self.transformation(stroke)
-
-        # Remove stray color from the neural network being sloppy
-        # x[x < 0.1] = 0
-        # # x[x >= 0.1] = 1
-        #x = 1/(1+torch.exp(-1.*((x*2-1)+0.5) / 0.05))
-        x = special_sigmoid(x)
-        # import kornia as K
-        # x = K.filters.median_blur(x, (3,3))
-        
-
-        # show_img(x)
-        x = torch.cat([x,x,x,x], dim=1)
-        # print('forawrd brush', x.shape)
-        # Color change
-        x = torch.cat((x[:,:3]*0 + self.color_transform[None,:,None,None], x[:,3:]), dim=1)
-        return x
-
-    def make_valid(stroke):
-        with torch.no_grad():
-            og_len = stroke.stroke_length.item()
-            stroke.stroke_length.data.clamp_(stroke.MIN_STROKE_LENGTH+0.002, 
-                                             stroke.MAX_STROKE_LENGTH-0.002)
-            # if stroke.stroke_length.item() != og_len:
-            #     print('length constrained')
-            
-            stroke.stroke_bend.data.clamp_(-1*stroke.stroke_length, stroke.stroke_length)
-            stroke.stroke_bend.data.clamp_(-1.0*stroke.MAX_BEND, stroke.MAX_BEND)
-
-            stroke.stroke_alpha.data.clamp_(-1.0*stroke.MAX_ALPHA, stroke.MAX_ALPHA)
-
-            stroke.stroke_z.data.clamp_(stroke.MIN_STROKE_Z,1.0-0.01)
-
-            # stroke.transformation.weights[1:3].data.clamp_(-1.,1.)
-            stroke.transformation.xt.data.clamp_(-1.,1.)
-            stroke.transformation.yt.data.clamp_(-1.,1.)
-
-
-            #stroke.color_transform.data.clamp_(0.02,0.75)
-            if stroke.color_transform.min() < 0.35:
-                # If it's a colored stroke, don't let it go to a flourescent color
-                stroke.color_transform.data.clamp_(0.02,0.70)
-            else:
-                # Well balanced RGB, less constraint
-                stroke.color_transform.data.clamp_(0.02,0.85)
-    
     def simple_parameterization_to_bezier_points(stroke_length, bend, z, alpha=0):
         xs = (np.arange(4)/3.) * stroke_length
 
@@ -277,176 +281,11 @@ class BrushStroke(nn.Module):
     def execute(self, painter, x_start, y_start, rotation, step_size=.005, curve_angle_is_rotation=False):
         # x_start, y_start in global coordinates. rotation in radians
         # curve_angle_is_rotation if true, then the brush is angled constantly down towards theta
-        smooth = True
-        if smooth:
-            all_positions = []
-            all_orientations = []
-
-        # Need to translate x,y a bit to be accurate according to camera
-        if painter.H_coord is not None:
-            # Translate the coordinates so they're similar. see coordinate_calibration
-            sim_coords = np.array([x_start, y_start, 1.])
-            real_coords = painter.H_coord.dot(sim_coords)
-            x_start, y_start = real_coords[0]/real_coords[2], real_coords[1]/real_coords[2]
-
-        z_range = np.abs(painter.Z_MAX_CANVAS - painter.Z_CANVAS)
-
-        trajectory = BrushStroke.simple_parameterization_to_bezier_points(
-                self.stroke_length.detach().cpu().item(),
-                self.stroke_bend.detach().cpu().item(),
-                self.stroke_z.detach().cpu().item(),
-                self.stroke_alpha.detach().cpu().item(),
-            )
-        path = BrushStroke.get_rotated_trajectory(rotation, trajectory)
-        
-        painter.move_to(x_start+path[0,0], y_start+path[0,1], painter.Z_CANVAS + 0.03, speed=0.4)
-        painter.move_to(x_start+path[0,0], y_start+path[0,1], painter.Z_CANVAS + 0.005, speed=0.1)
-
-        p0 = path[0,0], path[0,1], path[0,2]
-        p3 = None
-
-        alpha = self.stroke_alpha.item() # Same alpha throughout stroke, for now.
-        # print('alpha', alpha)
-
-        n_points_off_canvas, n_points_total = 0, 0
-
-        for i in range(1, len(path)-1, 3):
-            p1 = path[i+0,0], path[i+0,1], path[i+0,2]
-            p2 = path[i+1,0], path[i+1,1], path[i+1,2]
-            p3 = path[i+2,0], path[i+2,1], path[i+2,2]
-
-            stroke_length = ((p3[0]-p0[0])**2 + (p3[1] - p0[1])**2)**.5
-            n = max(2, int(stroke_length/step_size))
-            n=10#5#30 # TODO: something more than this? see previous line
-            for t in np.linspace(0,1,n):
-                x = (1-t)**3 * p0[0] \
-                      + 3*(1-t)**2*t*p1[0] \
-                      + 3*(1-t)*t**2*p2[0] \
-                      + t**3*p3[0]
-                y = (1-t)**3 * p0[1] \
-                      + 3*(1-t)**2*t*p1[1] \
-                      + 3*(1-t)*t**2*p2[1] \
-                      + t**3*p3[1]
-                if t < 0.333:
-                    z = (1 - t/.333) * p0[2] + (t/.333)*p1[2]
-                elif t < 0.666:
-                    z = (1 - (t-.333)/.333) * p1[2] + ((t-.333)/.333)*p2[2]
-                else:
-                    z = (1 - (t-.666)/.333) * p2[2] + ((t-.666)/.333)*p3[2]
-
-                def deriv_cubic_bez(p0,p1,p2,p3,t):
-                    return -3*(1-t)**2*p0 \
-                            + 3*(1-t)**2*p1 \
-                            - 6*t*(1-t)*p1 \
-                            - 3*t**2*p2 \
-                            + 6*t*(1-t)*p2 \
-                            + 3*t**2*p3
-                dx_dt = deriv_cubic_bez(p0[0], p1[0], p2[0], p3[0], t)
-                dy_dt = deriv_cubic_bez(p0[1], p1[1], p2[1], p3[1], t)
-                dy_dx = dy_dt / dx_dt
-                curve_angle = np.arctan(dy_dx)
-                # print('curve_angle', curve_angle)
-
-                def rad_to_deg(rad):
-                    return 1.0*rad/math.pi * 180
-                def deg_to_rad(deg):
-                    return 1.0*deg/180*math.pi
-
-                theta_sphere = np.arctan2(dy_dt, dx_dt) + np.pi/2 # the pi makes it perpendicular to trajectory
-
-                if curve_angle_is_rotation:
-                    theta_sphere = rotation
-
-                phi_sphere = alpha
-                # print(theta_sphere, phi_sphere)
-                roll = np.cos(theta_sphere)*np.sin(phi_sphere)
-                # pitch =  np.pi - np.sin(theta_sphere)*np.cos(phi_sphere)*np.sin(phi_sphere)
-                pitch =  np.pi - np.sin(theta_sphere)*np.sin(phi_sphere)
-                yaw = deg_to_rad(270.) # Constant yaw
-                q = get_quaternion_from_euler(roll,pitch,yaw)
-
-                ######
-                # TODO: fix the tilt of the brush for the Franka robot
-                q = None
-                ####
-
-                #brush_length = 0.095
-                l = painter.opt.brush_length
-                
-                if l is not None:
-                    r = l * np.sin(phi_sphere)
-                    dx = r * np.cos(theta_sphere)
-                    dy = r * np.sin(theta_sphere)
-                    dz = l - l * np.cos(phi_sphere)
-                    # print('dx dy', dx, dy)
-                    x += dx
-                    y += dy
-                    #z -= dz
-                    # print('dz', dz)
-                    new_z_range = z_range * np.abs(np.cos(phi_sphere))
-                    # print('z range', z_range, new_z_range)
-                    # print('dz', dz)
-                    # print('painter.Z_CANVAS', painter.Z_CANVAS)
-                    # print('painter.Z_MAX_CANVAS', painter.Z_MAX_CANVAS)
-
-                    z = painter.Z_CANVAS - z * new_z_range - dz #+ 0.07
-                    # print(x,y,z)
-                else:
-                    z = painter.Z_CANVAS - z * z_range 
-
-                x_next = x_start + x 
-                y_next = y_start + y
-
-
-                # If off the canvas, lift up
-                if (x_next > painter.opt.X_CANVAS_MAX) or (x_next < painter.opt.X_CANVAS_MIN) or \
-                        (y_next > painter.opt.Y_CANVAS_MAX) or (y_next < painter.opt.Y_CANVAS_MIN):
-                    z += 0.005
-                    n_points_off_canvas += 1
-                n_points_total += 1
-
-                # Don't over shoot the canvas
-                x_next = min(max(painter.opt.X_CANVAS_MIN, x_next), painter.opt.X_CANVAS_MAX) 
-                y_next = min(max(painter.opt.Y_CANVAS_MIN, y_next), painter.opt.Y_CANVAS_MAX)
-
-                if smooth:
-                    if t == 0 and i==0:
-                        all_positions.append([x_next, y_next, z+0.02])
-                        all_orientations.append(q)
-                        all_positions.append([x_next, y_next, z+0.005])
-                        all_orientations.append(q)
-                    all_positions.append([x_next, y_next, z])
-                    all_orientations.append(q)
-                    if t == 1 and (i == len(path)-4):
-                        all_positions.append([x_next, y_next, z+0.01])
-                        all_orientations.append(q)
-                        all_positions.append([x_next, y_next, z+0.02])
-                        all_orientations.append(q)
-                else:
-                    if t == 0 and i==0:
-                        painter.move_to(x_next, y_next, z+0.02, q=q, method='direct', speed=0.1)
-                        painter.move_to(x_next, y_next, z+0.005, q=q, method='direct', speed=0.03)
-                    painter.move_to(x_next, y_next, z, q=q, method='direct', speed=0.05)
-                    if t == 1 and (i == len(path)-4):
-                        painter.move_to(x_next, y_next, z+0.01, q=q, method='direct', speed=0.03)
-                        painter.move_to(x_next, y_next, z+0.02, q=q, method='direct', speed=0.1)
-                # time.sleep(0.02)
-            p0 = p3
-
-        stroke_complete = False
-        if smooth and ((n_points_off_canvas/n_points_total) < 0.9):
-            stroke_complete = painter.move_to_trajectories(all_positions, all_orientations)
-        
-
-        # Don't over shoot the canvas
-        x_next = x_start+path[-1,0]
-        y_next = y_start+path[-1,1]
-        x_next = min(max(painter.opt.X_CANVAS_MIN, x_next), painter.opt.X_CANVAS_MAX) 
-        y_next = min(max(painter.opt.Y_CANVAS_MIN, y_next), painter.opt.Y_CANVAS_MAX)
-        painter.move_to(x_next, y_next, painter.Z_CANVAS + 0.04, speed=0.3)
-        # painter.hover_above(x_start+path[-1,0], y_start+path[-1,1], painter.Z_CANVAS)
-
-        return stroke_complete
+        traj = stroke_trajectories(painter, [x_start], [y_start], [rotation],
+                [self.stroke_length.detach().cpu().item()], [self.stroke_bend.detach().cpu().item()],
+                [self.stroke_z.detach().cpu().item()], [self.stroke_alpha.detach().cpu().item()],
+                step_size=step_size, curve_angle_is_rotation=curve_angle_is_rotation)
+        return run_stroke_program(painter, stroke_program(painter, traj, 0))
     
     def get_rotated_trajectory(rotation, trajectory):
         # Rotation in radians
@@ -466,4 +305,113 @@ class BrushStroke(nn.Module):
             stroke_z=torch.ones(1)*0.5, 
             stroke_bend=torch.zeros(1), 
             stroke_alpha=torch.zeros(1)
-        )
\ No newline at end of file
+        )
+
+
+class StrokeBatch(nn.Module):
+    ''' All the brush strokes of a painting, stored as one tensor per attribute.
+
+    The order the strokes are painted in is kept separately as an index permutation
+    (self.order), so reordering strokes doesn't touch the parameters or the optimizer state.
+    Indexing/iterating gives BrushStroke views in painting order.
+    '''
+    attributes = ['stroke_length', 'stroke_z', 'stroke_bend', 'stroke_alpha', 'xt', 'yt', 'a', 'color_transform']
+
+    def __init__(self, opt, brush_strokes=None, ink=None, device=device):
+        super(StrokeBatch, self).__init__()
+        self.MAX_STROKE_LENGTH = opt.MAX_STROKE_LENGTH
+        self.MIN_STROKE_LENGTH = opt.MIN_STROKE_LENGTH
+        self.MIN_STROKE_Z = opt.MIN_STROKE_Z
+        self.MAX_ALPHA = opt.MAX_ALPHA
+        self.MAX_BEND = opt.MAX_BEND
+
+        brush_strokes = [] if brush_strokes is None else list(brush_strokes)
+        if ink is None:
+            ink = len(brush_strokes) > 0 and all([bs.ink for bs in brush_strokes])
+        self.ink = ink
+
+        def gather(get_value, shape):
+            if len(brush_strokes) == 0: return torch.zeros(shape, device=device)
+            return torch.stack([get_value(bs).to(device) for bs in brush_strokes])
+
+        self.stroke_length = nn.Parameter(gather(lambda bs : bs.stroke_length[0], (0,)))
+        self.stroke_z = nn.Parameter(gather(lambda bs : bs.stroke_z[0], (0,)))
+        self.stroke_bend = nn.Parameter(gather(lambda bs : bs.stroke_bend[0], (0,)))
+        self.stroke_alpha = nn.Parameter(gather(lambda bs : bs.stroke_alpha[0], (0,)))
+        self.xt = nn.Parameter(gather(lambda bs : bs.transformation.xt[0], (0,)))
+        self.yt = nn.Parameter(gather(lambda bs : bs.transformation.yt[0], (0,)))
+        self.a = nn.Parameter(gather(lambda bs : bs.transformation.a[0], (0,)))
+        self.color_transform = nn.Parameter(gather(lambda bs : bs.color_transform, (0,3)), 
+                                            requires_grad=not ink)
+
+        self.register_buffer('order', torch.arange(len(brush_strokes), device=device))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        ''' BrushStroke view of the i-th stroke in painting order '''
+        j = self.order[i]
+        with torch.no_grad():
+            bs = BrushStroke.__new__(BrushStroke)
+            bs.MAX_STROKE_LENGTH = self.MAX_STROKE_LENGTH
+            bs.MIN_STROKE_LENGTH = self.MIN_STROKE_LENGTH
+            bs.MIN_STROKE_Z = self.MIN_STROKE_Z
+            bs.MAX_ALPHA = self.MAX_ALPHA
+            bs.MAX_BEND = self.MAX_BEND
+            bs.transformation = StrokeTransformation(self.a[j], self.xt[j], self.yt[j])
+            bs.stroke_length = _as_stroke_tensor(self.stroke_length[j])
+            bs.stroke_z = _as_stroke_tensor(self.stroke_z[j])
+            bs.stroke_bend = _as_stroke_tensor(self.stroke_bend[j])
+            bs.stroke_alpha = _as_stroke_tensor(self.stroke_alpha[j])
+            bs.ink = self.ink
+            bs.color_transform = self.color_transform[j].detach().clone()
+        return bs
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def ordered(self):
+        ''' The stroke attributes in painting order. 
+        returns:
+            dict of attribute name -> tensor[N] (tensor[N,3] for color_transform)
+        '''
+        return {name:getattr(self, name)[self.order] for name in StrokeBatch.attributes}
+
+    def reorder(self, inds):
+        ''' Reorder the strokes. inds are positions in the current painting order.
+        Updates the order tensor in place, so compiled steps that use it don't need to retrace. '''
+        self.order.copy_(self.order[torch.as_tensor(inds, dtype=torch.long, device=self.order.device)])
+
+    def keep(self, inds):
+        ''' Keep only the strokes at the given positions in the painting order (in that order).
+        This replaces the parameter tensors, so optimizers need to be recreated. '''
+        rows = self.order[torch.as_tensor(inds, dtype=torch.long, device=self.order.device)]
+        for name in StrokeBatch.attributes:
+            param = getattr(self, name)
+            setattr(self, name, nn.Parameter(param.data[rows].clone(), requires_grad=param.requires_grad))
+        self.order = torch.arange(len(rows), device=self.order.device)
+
+    def make_valid(self):
+        ''' Clamp all the strokes to valid parameters. 
+        Only tensor ops on the whole batch, no host-device syncs. '''
+        with torch.no_grad():
+            self.stroke_length.data.clamp_(self.MIN_STROKE_LENGTH+0.002, 
+                                           self.MAX_STROKE_LENGTH-0.002)
+            
+            self.stroke_bend.data.clamp_(-1*self.stroke_length.data, self.stroke_length.data)
+            self.stroke_bend.data.clamp_(-1.0*self.MAX_BEND, self.MAX_BEND)
+
+            self.stroke_alpha.data.clamp_(-1.0*self.MAX_ALPHA, self.MAX_ALPHA)
+
+            self.stroke_z.data.clamp_(self.MIN_STROKE_Z,1.0-0.01)
+
+            self.xt.data.clamp_(-1.,1.)
+            self.yt.data.clamp_(-1.,1.)
+
+            # If it's a colored stroke, don't let it go to a flourescent color.
+            # Well balanced RGB, less constraint
+            colored = self.color_transform.data.min(dim=1, keepdim=True).values < 0.35
+            max_color = torch.where(colored, 0.70, 0.85).to(self.color_transform.dtype)
+            self.color_transform.data.clamp_(torch.full_like(max_color, 0.02), max_color)
@@ -2,6 +2,7 @@
 
 import torch
 import clip_attn.clip as clip
+from clip_registry import get_clip_model
 from PIL import Image
 import numpy as np
 import cv2
@@ -23,7 +24,7 @@ clip_norm = transforms.Compose([
 def get_attention(img, prompt=""):
     global attn_model
     if attn_model is None:
-        attn_model, _  = clip.load("ViT-B/32", device=device, jit=False)
+        attn_model, _  = get_clip_model("ViT-B/32", device, variant='clip_attn')
     texts = [prompt]
     text = clip.tokenize(texts).to(device)
 
@@ -0,0 +1,93 @@
+'''
+One copy of each CLIP model per process.
+
+The losses used to each clip.load their own ViT-B/32 (and ViT-B/16) when imported, so a
+process that imported a few of them held several identical copies of the same weights on the GPU.
+Models are now loaded the first time they're asked for and shared by everyone that asks for the
+same (name, device, dtype). Models that aren't needed anymore can be evicted to free their memory.
+
+    from clip_registry import get_clip_model
+    clip_model, preprocess = get_clip_model('ViT-B/32', device)
+
+Shared models are in eval mode and are not meant to be trained or modified in place.
+'''
+
+import collections
+import threading
+import torch
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+# (variant, name, device, dtype) -> (model, preprocess)
+_models = collections.OrderedDict()
+# Held while checking for and loading a model, so threads asking for the same one at once load it once
+_lock = threading.Lock()
+
+def _default_dtype(device):
+    # clip.load keeps the fp16 weights on the GPU and converts them to fp32 on the CPU
+    return torch.float16 if torch.device(device).type == 'cuda' else torch.float32
+
+def _key(name, device, dtype, variant):
+    device = str(torch.device(device))
+    if dtype is None: dtype = _default_dtype(device)
+    return (variant, name, device, dtype)
+
+def _load(name, device, jit, variant):
+    if variant == 'openai':
+        import clip
+    elif variant == 'clip_attn':
+        # Copy of clip with the attention maps exposed, see clip_attn/
+        from clip_attn import clip
+    else:
+        raise Exception('Unknown CLIP variant {}'.format(variant))
+    return clip.load(name, device=device, jit=jit)
+
+def get_clip_model(name='ViT-B/32', device=device, dtype=None, jit=False, variant='openai'):
+    '''
+    Get a CLIP model, loading it if nobody has asked for it yet
+    args:
+        name (str) : any name clip.load accepts, e.g. 'ViT-B/32'
+    kwargs:
+        device : device to load it onto
+        dtype (torch.dtype) : None for clip.load's default (fp16 on the GPU, fp32 on the CPU)
+        jit (bool) : passed to clip.load
+        variant (str) : 'openai' for the clip package, 'clip_attn' for the copy in clip_attn/
+    returns:
+        (model, preprocess) : like clip.load
+    '''
+    key = _key(name, device, dtype, variant) + (jit,)
+    with _lock:
+        if key not in _models:
+            model, preprocess = _load(name, device, jit, variant)
+            if dtype is not None:
+                model = model.to(dtype)
+            model.eval()
+            _models[key] = (model, preprocess)
+        _models.move_to_end(key)
+        return _models[key]
+
+def evict_clip_model(name=None, device=None, dtype=None, variant=None):
+    '''
+    Drop loaded models from the registry. None matches anything, so evict_clip_model() drops all of them.
+    The memory is only freed once nobody else holds a reference to the model.
+    returns:
+        int : how many models were evicted
+    '''
+    evicted = 0
+    with _lock:
+        for key in list(_models.keys()):
+            k_variant, k_name, k_device, k_dtype, _ = key
+            if (name is None or name == k_name) \
+                    and (device is None or str(torch.device(device)) == k_device) \
+                    and (dtype is None or dtype == k_dtype) \
+                    and (variant is None or variant == k_variant):
+                del _models[key]
+                evicted += 1
+    if evicted > 0 and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return evicted
+
+def loaded_clip_models():
+    ''' (variant, name, device, dtype, jit) of every model currently loaded, least recently used first '''
+    with _lock:
+        return list(_models.keys())
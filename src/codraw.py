@@ -19,8 +19,9 @@ from tqdm import tqdm
 from PIL import Image
 
 from cofrida import get_instruct_pix2pix_model
-from paint_utils3 import canvas_to_global_coordinates, format_img, get_colors, initialize_painting, nearest_color, random_init_painting, save_colors, show_img
+from paint_utils3 import canvas_to_global_coordinates, format_img, get_colors, initialize_painting, nearest_color, prune_hidden_strokes, random_init_painting, save_colors, show_img
 from painting_optimization import optimize_painting
+from stroke_scheduler import schedule_strokes
 
 from painter import Painter
 from options import Options
@@ -177,6 +178,15 @@ if __name__ == '__main__':
                         + "Ensure mixed paint is provided and then exit this to "
                         + "start painting.")
 
+        # Don't paint strokes that will be covered up anyway
+        n_strokes = len(painting)
+        painting = prune_hidden_strokes(painting, h_render, w_render, threshold=opt.occlusion_threshold)
+        print('Removed {} hidden strokes before painting'.format(n_strokes - len(painting)))
+
+        if opt.schedule_execution:
+            painting = schedule_strokes(opt, painting, color_palette, curr_color=curr_color,
+                                        title='execution_{}'.format(i))
+
         # Execute plan
         for stroke_ind in tqdm(range(len(painting)), desc="Executing plan"):
             stroke = painting.pop()            
@@ -0,0 +1,106 @@
+'''
+Early stopping for the stroke optimization loops (--early_stop).
+
+The loops run a fixed number of iterations, with the colors being discretized over the last
+few of them. The monitor keeps an exponential moving average of the loss and of how much the
+parameters move each step. Once neither is changing anymore, the loop skips ahead to its final
+iterations (tail), so the colors still get discretized like they would have.
+
+    monitor = get_convergence_monitor(opt, painting, n_iters)
+    for it in range(n_iters):
+        if monitor.skip(it): continue
+        ...
+        monitor.update(loss, it)
+    monitor.log(opt.writer, 'plan')
+'''
+
+import torch
+
+log_steps = {} # title -> how many times it has been logged
+
+class ConvergenceMonitor(object):
+    def __init__(self, params, n_iters, tol=1e-3, patience=20, beta=0.9, min_iter=0.3, tail=0.1,
+                 check_every=5, enabled=True):
+        '''
+        args:
+            params (list[torch.Tensor]) : parameters being optimized
+            n_iters (int) : iterations the loop was scheduled to run
+        kwargs:
+            tol (float) : converged once the loss EMA improved by less than this (relative) over the
+                last patience iterations, and the parameter updates are smaller than this relative to the parameters
+            beta (float) : EMA decay
+            min_iter (float) : fraction of n_iters to always run
+            tail (float) : fraction of n_iters at the end that's always run
+            check_every (int) : how often to check, each check waits for the GPU
+        '''
+        self.params = [p for p in params if p is not None]
+        self.n_iters = n_iters
+        self.tol, self.patience, self.beta = tol, patience, beta
+        self.min_iter = int(min_iter * n_iters)
+        self.tail_start = n_iters - int(tail * n_iters)
+        self.check_every = check_every
+        self.enabled = enabled and len(self.params) > 0
+
+        self.ema_loss, self.ema_update = None, None
+        self.history = [] # (iteration, ema loss) at each check
+        self.prev_params = None
+        self.converged_at = None
+        self.iterations_saved = 0
+
+    def update(self, loss, it):
+        ''' Call after the optimizer step. Returns True if it has converged '''
+        if not self.enabled or self.converged_at is not None:
+            return self.converged_at is not None
+        with torch.no_grad():
+            loss = loss.detach().float().reshape(-1)[0].clone() # Could be a buffer that gets reused
+            self.ema_loss = loss if self.ema_loss is None else self.beta*self.ema_loss + (1-self.beta)*loss
+
+            if self.prev_params is not None:
+                update = torch.stack([(p - q).norm() for p, q in zip(self.params, self.prev_params)]).norm() \
+                    / (torch.stack([p.norm() for p in self.params]).norm() + 1e-8)
+                self.ema_update = update if self.ema_update is None \
+                    else self.beta*self.ema_update + (1-self.beta)*update
+            self.prev_params = [p.detach().clone() for p in self.params]
+
+        if it % self.check_every != 0 or it < self.min_iter or it >= self.tail_start:
+            return False
+
+        ema_loss, ema_update = self.ema_loss.item(), self.ema_update.item() if self.ema_update is not None else 1.
+        self.history.append((it, ema_loss))
+        past = [l for i, l in self.history if i <= it - self.patience]
+        if len(past) == 0:
+            return False
+        improvement = (past[-1] - ema_loss) / (abs(past[-1]) + 1e-8)
+        if improvement < self.tol and ema_update < self.tol:
+            self.converged_at = it
+            self.prev_params = None
+            return True
+        return False
+
+    def skip(self, it):
+        ''' Whether to skip iteration it, because it converged before the final iterations '''
+        if self.converged_at is not None and it < self.tail_start:
+            self.iterations_saved += 1
+            return True
+        return False
+
+    def log(self, writer, title):
+        ''' Log how many iterations were saved '''
+        if not self.enabled or writer is None: return
+        step = log_steps.get(title, 0)
+        log_steps[title] = step + 1
+        writer.add_scalar('early_stop/{}_iterations_saved'.format(title), self.iterations_saved, step)
+        if self.converged_at is not None:
+            writer.add_scalar('early_stop/{}_converged_at'.format(title), self.converged_at, step)
+
+def get_convergence_monitor(opt, painting, n_iters, min_iter=None):
+    '''
+    ConvergenceMonitor from the --early_stop options. It does nothing without --early_stop
+    args:
+        painting (Painting or list[Painting]) : several paintings optimized together are monitored as one
+    '''
+    paintings = painting if isinstance(painting, (list, tuple)) else [painting]
+    return ConvergenceMonitor([param for p in paintings for param in p.parameters()], n_iters,
+        tol=opt.early_stop_tol, patience=opt.early_stop_patience, beta=opt.early_stop_ema,
+        min_iter=opt.early_stop_min_iter if min_iter is None else min_iter,
+        enabled=opt.early_stop)
@@ -1,13 +1,14 @@
 
 import torch
 import clip
+from clip_registry import get_clip_model
 
 
 class CLIPLoss(torch.nn.Module):
 
     def __init__(self, opts):
         super(CLIPLoss, self).__init__()
-        self.model, self.preprocess = clip.load("ViT-B/32", device="cuda")
+        self.model, self.preprocess = get_clip_model("ViT-B/32", device="cuda")
         self.upsample = torch.nn.Upsample(scale_factor=7)
         self.avg_pool = torch.nn.AvgPool2d(kernel_size=opts.stylegan_size // 32)
 
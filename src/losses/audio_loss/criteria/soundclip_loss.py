@@ -8,6 +8,9 @@ import math
 import timm
 import os
 
+from losses.batched_augment import BatchedAugmentation
+from clip_registry import get_clip_model
+
 def copyStateDict(state_dict):
     if list(state_dict.keys())[0].startswith("module"):
         start_idx = 1
@@ -35,7 +38,7 @@ class SoundCLIPLoss(torch.nn.Module):
 
     def __init__(self):
         super(SoundCLIPLoss, self).__init__()
-        self.model, self.preprocess = clip.load("ViT-B/32", device="cuda")
+        self.model, self.preprocess = get_clip_model("ViT-B/32", device="cuda")
         self.upsample = torch.nn.Upsample(scale_factor=7)
         self.avg_pool = torch.nn.AvgPool2d(kernel_size=256 // 32)
 
@@ -61,12 +64,7 @@ class SoundCLIPLoss(torch.nn.Module):
 
 
 def get_image_augmentation():
-    augment_trans = transforms.Compose([
-        transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-        transforms.RandomResizedCrop(256, scale=(0.7,0.9), antialias=True),
-    ])
-
-    return augment_trans
+    return BatchedAugmentation(256, distortion_scale=0.5, scale=(0.7,0.9), fill=1)
 
 augment_trans = get_image_augmentation()
 num_augs = 10
@@ -77,7 +75,7 @@ def audio_loss(img, audio):
     if clip_audio_loss is None:
         clip_audio_loss = SoundCLIPLoss()
 
-    img_batch = torch.cat([augment_trans(img) for n in range(num_augs)])
+    img_batch = augment_trans(img, num_augs=num_augs)
     loss = 0
 
     for n in range(num_augs):
@@ -0,0 +1,169 @@
+'''
+Random perspective + resized crop augmentations for the whole augmentation batch at once.
+
+Same kind of augmentation as
+    transforms.RandomPerspective(fill=fill, p=1, distortion_scale=distortion_scale)
+    transforms.RandomResizedCrop(size, scale=scale, ratio=ratio)
+which the losses used to apply num_augs times in a Python loop. Here the parameters of every
+augmentation are sampled together, composed into one homography each, and all the images are
+warped with a single grid_sample call.
+'''
+
+import math
+import torch
+import torch.nn.functional as F
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def perspective_homographies(end_points, start_points):
+    ''' Batched homographies that map each set of 4 end_points onto start_points
+    args:
+        end_points, start_points (torch.Tensor[n,4,2])
+    returns:
+        torch.Tensor[n,3,3]
+    '''
+    n = len(end_points)
+    x, y = end_points[...,0], end_points[...,1]
+    X, Y = start_points[...,0], start_points[...,1]
+    zeros, ones = torch.zeros_like(x), torch.ones_like(x)
+    rows_x = torch.stack([x, y, ones, zeros, zeros, zeros, -X*x, -X*y], dim=-1)
+    rows_y = torch.stack([zeros, zeros, zeros, x, y, ones, -Y*x, -Y*y], dim=-1)
+    A = torch.cat([rows_x, rows_y], dim=1)
+    b = torch.cat([X, Y], dim=1)
+    h = torch.linalg.solve(A, b)
+    return torch.cat([h, torch.ones((n, 1), dtype=h.dtype, device=h.device)], dim=1).view(n, 3, 3)
+
+class BatchedAugmentation(object):
+    def __init__(self, size, distortion_scale=0.5, scale=(0.7, 0.9), ratio=(3./4., 4./3.),
+                 fill=1., perspective=True, normalize=False):
+        '''
+        args:
+            size (int) : output height and width
+        kwargs:
+            distortion_scale, fill : like transforms.RandomPerspective
+            scale, ratio : like transforms.RandomResizedCrop
+            perspective : if False, only the resized crop
+            normalize : apply CLIP's normalization to the output
+        '''
+        self.size = size
+        self.distortion_scale = distortion_scale
+        self.scale = scale
+        self.ratio = ratio
+        self.fill = fill
+        self.perspective = perspective
+        self.normalize = normalize
+
+    def sample_crop_size(self, n, h, w, rand, attempts=10):
+        ''' Crop sizes like transforms.RandomResizedCrop: crops that don't fit in the image are
+        sampled again, up to attempts times, then they're the center crop with the closest aspect ratio.
+        returns:
+            (torch.Tensor[n], torch.Tensor[n], torch.Tensor[n]) : crop widths and heights, and which are center crops
+        '''
+        area = h * w
+        log_ratio = (math.log(self.ratio[0]), math.log(self.ratio[1]))
+        crop_w, crop_h = torch.zeros(n, dtype=torch.float64), torch.zeros(n, dtype=torch.float64)
+        done = torch.zeros(n, dtype=torch.bool)
+        for attempt in range(attempts):
+            target_area = area * (self.scale[0] + (self.scale[1] - self.scale[0]) * rand(n))
+            aspect = torch.exp(log_ratio[0] + (log_ratio[1] - log_ratio[0]) * rand(n))
+            cw = torch.sqrt(target_area * aspect).round()
+            ch = torch.sqrt(target_area / aspect).round()
+            fits = ~done & (cw > 0) & (cw <= w) & (ch > 0) & (ch <= h)
+            crop_w, crop_h = torch.where(fits, cw, crop_w), torch.where(fits, ch, crop_h)
+            done = done | fits
+            if bool(done.all()):
+                return crop_w, crop_h, ~done
+
+        # Fallback to the center crop
+        if w / h < min(self.ratio):
+            fallback_w, fallback_h = w, int(round(w / min(self.ratio)))
+        elif w / h > max(self.ratio):
+            fallback_w, fallback_h = int(round(h * max(self.ratio))), h
+        else:
+            fallback_w, fallback_h = w, h
+        crop_w = torch.where(done, crop_w, torch.full_like(crop_w, fallback_w))
+        crop_h = torch.where(done, crop_h, torch.full_like(crop_h, fallback_h))
+        return crop_w, crop_h, ~done
+
+    def sample(self, n, h, w, device='cpu', generator=None):
+        ''' Sample n augmentations for (h,w) images
+        kwargs:
+            generator (torch.Generator) : CPU generator, for reproducible augmentations
+        returns:
+            torch.Tensor[n,3,3] : maps output pixel coordinates to input pixel coordinates
+        '''
+        rand = lambda *shape : torch.rand(shape, generator=generator, dtype=torch.float64)
+
+        # Random resized crop of the (perspective warped) image
+        crop_w, crop_h, center = self.sample_crop_size(n, h, w, rand)
+        crop_y = torch.where(center, torch.floor((h - crop_h) / 2), torch.floor(rand(n) * (h - crop_h + 1)))
+        crop_x = torch.where(center, torch.floor((w - crop_w) / 2), torch.floor(rand(n) * (w - crop_w + 1)))
+
+        # Output pixel -> crop pixel (resize with align_corners=False)
+        M = torch.zeros((n, 3, 3), dtype=torch.float64)
+        M[:,0,0] = crop_w / self.size
+        M[:,0,2] = crop_x + 0.5 * crop_w / self.size - 0.5
+        M[:,1,1] = crop_h / self.size
+        M[:,1,2] = crop_y + 0.5 * crop_h / self.size - 0.5
+        M[:,2,2] = 1
+
+        if self.perspective:
+            # Each corner moves inwards by up to distortion_scale * half the image size
+            dx = int(self.distortion_scale * (w // 2)) + 1
+            dy = int(self.distortion_scale * (h // 2)) + 1
+            rand_x = lambda : torch.floor(rand(n) * dx)
+            rand_y = lambda : torch.floor(rand(n) * dy)
+            end_points = torch.stack([
+                torch.stack([rand_x(), rand_y()], dim=1),
+                torch.stack([w - 1 - rand_x(), rand_y()], dim=1),
+                torch.stack([w - 1 - rand_x(), h - 1 - rand_y()], dim=1),
+                torch.stack([rand_x(), h - 1 - rand_y()], dim=1),
+            ], dim=1)
+            start_points = torch.tensor([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]],
+                                        dtype=torch.float64)[None].expand(n, -1, -1)
+            # Warped pixel -> input pixel
+            M = perspective_homographies(end_points, start_points) @ M
+
+        return M.float().to(device)
+
+    def apply(self, x, transforms):
+        ''' Warp every image with every transform in one grid_sample call
+        args:
+            x (torch.Tensor[B,C,H,W])
+            transforms (torch.Tensor[n,3,3]) : from sample()
+        returns:
+            torch.Tensor[B*n,C,size,size] : all augmentations of image 0, then of image 1, ...
+        '''
+        b, c, h, w = x.shape
+        n = len(transforms)
+        ar = torch.arange(self.size, device=x.device, dtype=transforms.dtype)
+        grid_y, grid_x = torch.meshgrid(ar, ar, indexing='ij')
+        points = torch.stack([grid_x, grid_y, torch.ones_like(grid_x)], dim=-1).view(-1, 3)
+        points = torch.einsum('nij,pj->npi', transforms.to(x.device), points)
+        px = points[...,0] / points[...,2]
+        py = points[...,1] / points[...,2]
+        grid = torch.stack([(2*px + 1) / w - 1, (2*py + 1) / h - 1], dim=-1).view(n, self.size, self.size, 2)
+
+        # Extra channel to know which pixels came from outside the image
+        x = torch.cat([x, torch.ones_like(x[:,:1])], dim=1)
+        x = x.repeat_interleave(n, dim=0)
+        out = F.grid_sample(x, grid.repeat(b, 1, 1, 1).to(x.dtype), mode='bilinear',
+                            padding_mode='zeros', align_corners=False)
+        out, inside = out[:,:c], out[:,c:]
+        out = out + (1 - inside) * self.fill
+
+        if self.normalize:
+            mean = torch.tensor(CLIP_MEAN, device=out.device, dtype=out.dtype)[None,:,None,None]
+            std = torch.tensor(CLIP_STD, device=out.device, dtype=out.dtype)[None,:,None,None]
+            out = (out - mean) / std
+        return out
+
+    def __call__(self, *imgs, num_augs=1, generator=None):
+        ''' num_augs random augmentations of each image. With more than one image (paired),
+        they all get the same augmentations. Returns one batch per image. '''
+        transforms = self.sample(num_augs, imgs[0].shape[2], imgs[0].shape[3],
+                                 device=imgs[0].device, generator=generator)
+        out = [self.apply(img, transforms) for img in imgs]
+        return out[0] if len(out) == 1 else tuple(out)
@@ -12,9 +12,12 @@ https://github.com/yael-vinker/CLIPasso/blob/173b954de3298f43a860bf38ea6387916e6
 '''
 
 import collections
+import threading
 import torch
 import torch.nn as nn
 from torchvision import models, transforms
+from losses.batched_augment import BatchedAugmentation
+from clip_registry import get_clip_model
 import clip
 import warnings
 
@@ -32,6 +35,9 @@ class CLIPVisualEncoder(nn.Module):
 
     def make_hook(self, name):
         def hook(module, input, output):
+            # The CLIP model is shared, only record features during this encoder's forward
+            if self.featuremaps is None:
+                return
             if len(output.shape) == 3:
                 self.featuremaps[name] = output.permute(
                     1, 0, 2)  # LND -> NLD bs, smth, 768
@@ -44,6 +50,7 @@ class CLIPVisualEncoder(nn.Module):
         self.featuremaps = collections.OrderedDict()
         fc_features = self.clip_model.encode_image(x).float()
         featuremaps = [self.featuremaps[k] for k in range(12)]
+        self.featuremaps = None
 
         return fc_features, featuremaps
 
@@ -95,8 +102,7 @@ class CLIPConvLoss(torch.nn.Module):
                 "Cos": cos_layers
             }
 
-        self.model, clip_preprocess = clip.load(
-            self.clip_model_name, args.device, jit=False)
+        self.model, clip_preprocess = get_clip_model(self.clip_model_name, args.device)
 
         if self.clip_model_name.startswith("ViT"):
             self.visual_encoder = CLIPVisualEncoder(self.model)
@@ -129,21 +135,62 @@ class CLIPConvLoss(torch.nn.Module):
         self.device = args.device
         self.num_augs = self.args.num_aug_clip
 
-        augemntations = []
-        if "affine" in args.augemntations:
-            augemntations.append(transforms.RandomPerspective(
-                fill=0, p=1.0, distortion_scale=0.5))
-            augemntations.append(transforms.RandomResizedCrop(
-                224, scale=(0.8, 0.8), ratio=(1.0, 1.0), antialias=True))
-        augemntations.append(
-            transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)))
-        self.augment_trans = transforms.Compose(augemntations)
+        self.use_affine = "affine" in args.augemntations
+        self.augment_batch = BatchedAugmentation(224, distortion_scale=0.5, scale=(0.8, 0.8), ratio=(1.0, 1.0),
+                                                 fill=0, normalize=True)
+
+        # Target features for a fixed bank of augmentations, so the target is only encoded once.
+        # Each step uses num_augs random augmentations from the bank.
+        self.aug_bank_size = args.aug_bank_size
+        self.aug_seed = args.aug_seed
+        self.target_cache = collections.OrderedDict()
+        self.max_cached_targets = 4
 
         self.clip_fc_layer_dims = None  # self.args.clip_fc_layer_dims
         self.clip_conv_layer_dims = None  # self.args.clip_conv_layer_dims
         self.clip_fc_loss_weight = args.clip_fc_loss_weight
         self.counter = 0
 
+    def augment(self, x, transforms):
+        ''' Augment x with transforms from self.augment_batch.sample '''
+        if not self.use_affine:
+            return self.normalize_transform(x).repeat(len(transforms), 1, 1, 1)
+        return self.augment_batch.apply(x, transforms)
+
+    def encode(self, xs):
+        if self.clip_model_name.startswith("RN"):
+            return self.forward_inspection_clip_resnet(xs.contiguous())
+        return self.visual_encoder(xs)
+
+    def get_target_features(self, y):
+        ''' Features of the target, un-augmented first and then the augmentation bank.
+        Cached by target tensor (and its in-place version) and augmentation seed. '''
+        key = (id(y), self.aug_seed)
+        cached = self.target_cache.get(key)
+        if cached is not None and cached['target'] is y and cached['version'] == y._version:
+            self.target_cache.move_to_end(key)
+            return cached
+
+        augs = self.augment_batch.sample(self.aug_bank_size, y.shape[2], y.shape[3], device=self.device,
+                                         generator=torch.Generator().manual_seed(self.aug_seed))
+        with torch.no_grad():
+            y_dev = y.to(self.device)
+            ys = torch.cat([self.normalize_transform(y_dev), self.augment(y_dev, augs)], dim=0)
+            fc_features, conv_features = [], []
+            for i in range(0, len(ys), 32):
+                fc, conv = self.encode(ys[i:i+32])
+                fc_features.append(fc)
+                conv_features.append(conv)
+            fc_features = torch.cat(fc_features, dim=0)
+            conv_features = [torch.cat([c[l] for c in conv_features], dim=0) for l in range(len(conv_features[0]))]
+
+        cached = {'target':y, 'version':y._version, 'augs':augs, 
+                  'fc':fc_features, 'conv':conv_features}
+        self.target_cache[key] = cached
+        while len(self.target_cache) > self.max_cached_targets:
+            self.target_cache.popitem(last=False)
+        return cached
+
     def forward(self, sketch, target, mode="train"):
         """
         Parameters
@@ -154,30 +201,21 @@ class CLIPConvLoss(torch.nn.Module):
         #         y = self.target_transform(target).to(self.args.device)
         conv_loss_dict = {}
         x = sketch.to(self.device)
-        y = target.to(self.device)
-        sketch_augs, img_augs = [self.normalize_transform(x)], [
-            self.normalize_transform(y)]
+        target_features = self.get_target_features(target)
+
+        # Index 0 is the un-augmented target, bank augmentation i is at i+1
+        inds = [0]
+        sketch_augs = [self.normalize_transform(x)]
         if mode == "train":
-            for n in range(self.num_augs):
-                with warnings.catch_warnings():
-                    # RandomPerspective has a really annoying warning
-                    warnings.simplefilter("ignore")
-                    augmented_pair = self.augment_trans(torch.cat([x, y]))
-                sketch_augs.append(augmented_pair[0].unsqueeze(0))
-                img_augs.append(augmented_pair[1].unsqueeze(0))
+            bank_inds = torch.randperm(self.aug_bank_size)[:self.num_augs].tolist()
+            # Same augmentations as the cached target features, all in one batch
+            sketch_augs.append(self.augment(x, target_features['augs'][bank_inds]))
+            inds += [i + 1 for i in bank_inds]
 
         xs = torch.cat(sketch_augs, dim=0).to(self.device)
-        ys = torch.cat(img_augs, dim=0).to(self.device)
-
-        if self.clip_model_name.startswith("RN"):
-            xs_fc_features, xs_conv_features = self.forward_inspection_clip_resnet(
-                xs.contiguous())
-            ys_fc_features, ys_conv_features = self.forward_inspection_clip_resnet(
-                ys.detach())
-
-        else:
-            xs_fc_features, xs_conv_features = self.visual_encoder(xs)
-            ys_fc_features, ys_conv_features = self.visual_encoder(ys)
+        xs_fc_features, xs_conv_features = self.encode(xs)
+        ys_fc_features = target_features['fc'][inds]
+        ys_conv_features = [c[inds] for c in target_features['conv']]
 
         conv_loss = self.distance_metrics[self.clip_conv_loss_type](
             xs_conv_features, ys_conv_features, self.clip_model_name)
@@ -195,6 +233,55 @@ class CLIPConvLoss(torch.nn.Module):
         self.counter += 1
         return conv_loss_dict
 
+    def forward_batch(self, sketches, targets, mode="train"):
+        '''
+        Loss of each sketch against its own target, with all the sketches (and their 
+        augmentations) encoded in one batch. Same loss as calling forward on each pair.
+        args:
+            sketches (torch.Tensor[B,C,H,W])
+            targets (list[torch.Tensor[1,C,H,W]]) : keep passing the same tensors so their features stay cached
+        returns:
+            torch.Tensor[B] : summed weighted loss of each sketch
+        '''
+        n = len(sketches)
+        self.max_cached_targets = max(self.max_cached_targets, n)
+        x = sketches.to(self.device)
+        xs, ys_fc_features, ys_conv_features = [], [], []
+        for b in range(n):
+            target_features = self.get_target_features(targets[b])
+            inds = [0]
+            xs.append(self.normalize_transform(x[b:b+1]))
+            if mode == "train":
+                bank_inds = torch.randperm(self.aug_bank_size)[:self.num_augs].tolist()
+                xs.append(self.augment(x[b:b+1], target_features['augs'][bank_inds]))
+                inds += [i + 1 for i in bank_inds]
+            ys_fc_features.append(target_features['fc'][inds])
+            ys_conv_features.append([c[inds] for c in target_features['conv']])
+
+        xs_fc_features, xs_conv_features = self.encode(torch.cat(xs, dim=0))
+        ys_fc_features = torch.cat(ys_fc_features, dim=0)
+        ys_conv_features = [torch.cat([y[l] for y in ys_conv_features], dim=0) 
+                            for l in range(len(ys_conv_features[0]))]
+
+        per_sketch = lambda d : d.reshape(n, -1).mean(dim=1)
+        loss = torch.zeros(n, device=xs_fc_features.device)
+        for layer, w in enumerate(self.args.clip_conv_layer_weights):
+            if w:
+                x_conv, y_conv = xs_conv_features[layer], ys_conv_features[layer]
+                if self.clip_conv_loss_type == "L2":
+                    d = torch.square(x_conv - y_conv)
+                elif self.clip_conv_loss_type == "L1":
+                    d = torch.abs(x_conv - y_conv)
+                else:
+                    d = 1 - torch.cosine_similarity(x_conv, y_conv, dim=1)
+                loss = loss + per_sketch(d) * w
+
+        if self.clip_fc_loss_weight:
+            loss = loss + per_sketch(1 - torch.cosine_similarity(xs_fc_features, 
+                                     ys_fc_features, dim=1)) * self.clip_fc_loss_weight
+        self.counter += 1
+        return loss
+
     def forward_inspection_clip_resnet(self, x):
         def stem(m, x):
             for conv, bn in [(m.conv1, m.bn1), (m.conv2, m.bn2), (m.conv3, m.bn3)]:
@@ -212,25 +299,15 @@ class CLIPConvLoss(torch.nn.Module):
 
 
 def get_image_augmentation(use_normalized_clip):
-    augment_trans = transforms.Compose([
-        transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-        transforms.RandomResizedCrop(224, scale=(0.7,0.9), antialias=True),
-    ])
-
-    if use_normalized_clip:
-        augment_trans = transforms.Compose([
-        transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-        transforms.RandomResizedCrop(224, scale=(0.7,0.9), antialias=True),
-        transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-    ])
-    return augment_trans
+    return BatchedAugmentation(224, distortion_scale=0.5, scale=(0.7,0.9), fill=1, normalize=use_normalized_clip)
 
 augment_trans = get_image_augmentation(False)
 num_augs = 10
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 def clip_loss(img0, img1):
-    img0_batch = torch.cat([augment_trans(img0) for n in range(num_augs)])
-    img1_batch = torch.cat([augment_trans(img1) for n in range(num_augs)])
+    img0_batch = augment_trans(img0, num_augs=num_augs)
+    img1_batch = augment_trans(img1, num_augs=num_augs)
+    clip_model, _ = get_clip_model('ViT-B/32', device)
     img0_features = clip_model.encode_image(img0_batch)
     img1_features = clip_model.encode_image(img1_batch)
 
@@ -247,48 +324,55 @@ class Dict2Class(object):
 clip_conv_layer_weights = [0, 0, 0, 0, 1.0]
 a = {'clip_model_name':'ViT-B/32','clip_conv_loss_type':'Cos','device':device,
     'num_aug_clip':num_augs,'augemntations':['affine'],
-     'clip_fc_loss_weight':0.0,'clip_conv_layer_weights':clip_conv_layer_weights}
-clip_conv_loss_model = CLIPConvLoss(Dict2Class(a))
+     'clip_fc_loss_weight':0.0,'clip_conv_layer_weights':clip_conv_layer_weights,
+     'aug_bank_size':4*num_augs,'aug_seed':0}
+_clip_conv_loss_model = None
+_clip_conv_loss_lock = threading.Lock()
+
+def get_clip_conv_loss_model():
+    ''' The CLIPConvLoss used by clip_conv_loss, created the first time it's needed.
+    Only ever one, each CLIPConvLoss adds its hooks to the shared CLIP model '''
+    global _clip_conv_loss_model
+    with _clip_conv_loss_lock:
+        if _clip_conv_loss_model is None:
+            _clip_conv_loss_model = CLIPConvLoss(Dict2Class(a))
+        return _clip_conv_loss_model
 
 def clip_conv_loss(painting, target):
     loss = 0
-    clip_loss = clip_conv_loss_model(painting[:,:3], target)
+    clip_loss = get_clip_conv_loss_model()(painting[:,:3], target)
     for key in clip_loss.keys():
         loss += clip_loss[key]
     return loss
 
+def clip_conv_loss_batch(paintings, targets):
+    ''' clip_conv_loss of each painting (torch.Tensor[B,C,H,W]) with its own target 
+    (list of B torch.Tensor[1,C,H,W]) in one batch. Returns torch.Tensor[B] '''
+    return get_clip_conv_loss_model().forward_batch(paintings[:,:3], targets)
+
 
 
 import torchvision.transforms as transforms
 
-augment_trans_text = transforms.Compose([
-    # transforms.GaussianBlur((21,21), sigma=(1.)),
-    # transforms.GaussianBlur((15,15), sigma=(1.)), # Doesn't work well it appears
-    # transforms.GaussianBlur((5,5), sigma=(1.)), # Maybe better than nothing? but marginally
-    # transforms.GaussianBlur((15,15), sigma=(2.)),
-    # transforms.Resize(64),
-    # transforms.Resize(256),
-    transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-    transforms.RandomResizedCrop(224, scale=(0.7,0.9), antialias=True),
-    transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-])
+augment_trans_text = BatchedAugmentation(224, distortion_scale=0.5, scale=(0.7,0.9), fill=1, normalize=True)
 
-import clip
-clip_model, preprocess = clip.load('ViT-B/32', device, jit=False)
-clip_model_16, preprocess_16 = clip.load('ViT-B/16', device, jit=False)
+def __getattr__(name):
+    # The models that used to be loaded on import, now loaded when first used
+    # (through the clip_registry, so everyone shares one copy)
+    if name in ('clip_model', 'preprocess'):
+        return get_clip_model('ViT-B/32', device)[name == 'preprocess']
+    if name in ('clip_model_16', 'preprocess_16'):
+        return get_clip_model('ViT-B/16', device)[name == 'preprocess_16']
+    if name == 'clip_conv_loss_model':
+        return get_clip_conv_loss_model()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def clip_text_loss(p, text_features, num_augs, text_features_16=None):
     loss = 0
-    img_augs = []
-    with warnings.catch_warnings():
-        # RandomPerspective has a really annoying warning
-        warnings.simplefilter("ignore")
-        for n in range(num_augs):
-            img_augs.append(augment_trans_text(p[:,:3]))
-
-    im_batch = torch.cat(img_augs)
+    im_batch = augment_trans_text(p[:,:3], num_augs=num_augs)
     # from plan_all_strokes import show_img 
     # show_img(im_batch[0])
+    clip_model, _ = get_clip_model('ViT-B/32', device)
     image_features = clip_model.encode_image(im_batch)
     if text_features_16 is not None:
         image_features_16 = clip_model.encode_image(im_batch)
@@ -301,16 +385,9 @@ def clip_text_loss(p, text_features, num_augs, text_features_16=None):
 
 def clip_fc_loss(p, other_img, num_augs, text_features_16=None):
     loss = 0
-    p_augs, other_img_augs = [], []
-    with warnings.catch_warnings():
-        # RandomPerspective has a really annoying warning
-        warnings.simplefilter("ignore")
-        for n in range(num_augs):
-            p_augs.append(augment_trans_text(p[:,:3]))
-            other_img_augs.append(augment_trans_text(other_img[:,:3]))
-
-    p_batch = torch.cat(p_augs)
-    other_batch = torch.cat(other_img_augs)
+    p_batch = augment_trans_text(p[:,:3], num_augs=num_augs)
+    other_batch = augment_trans_text(other_img[:,:3], num_augs=num_augs)
+    clip_model, _ = get_clip_model('ViT-B/32', device)
     p_features = clip_model.encode_image(p_batch)
     other_features = clip_model.encode_image(other_batch)
 
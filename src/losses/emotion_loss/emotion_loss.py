@@ -11,11 +11,10 @@ import warnings
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-augment = transforms.Compose([
-    transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-    transforms.RandomResizedCrop(224, scale=(0.7,0.9), antialias=True),
-    transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-])
+from losses.batched_augment import BatchedAugmentation
+from clip_registry import get_clip_model
+
+augment = BatchedAugmentation(224, distortion_scale=0.5, scale=(0.7,0.9), fill=1, normalize=True)
 
 ARTEMIS_EMOTIONS = [
     'amusement',
@@ -53,23 +52,15 @@ emotion = SLP(512) # For ViT
 emotion.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
 emotion = emotion.to(device)
 
-# clip_model, preprocess = clip.load("RN50x16")
-clip_model, preprocess = clip.load("ViT-B/32")
-clip_model.eval()
-clip_model = clip_model.to(device)
+# CLIP model is shared with the other losses, see clip_registry.py
+# clip_model, preprocess = get_clip_model("RN50x16", device)
 
 
 
 def emotion_loss(painting, emotion_feats, num_augs):
     loss = 0
-    img_augs = []
-    with warnings.catch_warnings():
-        # RandomPerspective has a really annoying warning
-        warnings.simplefilter("ignore")
-        for n in range(num_augs):
-            img_augs.append(augment(painting[:,:3]))
-
-    im_batch = torch.cat(img_augs)
+    im_batch = augment(painting[:,:3], num_augs=num_augs)
+    clip_model, _ = get_clip_model("ViT-B/32", device)
     image_features = emotion(clip_model.encode_image(im_batch))
     for n in range(num_augs):
         loss -= torch.cosine_similarity(emotion_feats, image_features[n:n+1], dim=1)
@@ -13,10 +13,9 @@ except NameError:
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
-augment_trans = transforms.Compose([
-    transforms.RandomPerspective(fill=1, p=1, distortion_scale=0.5),
-    transforms.RandomResizedCrop(512, scale=(0.7,0.9), antialias=True),
-])
+from losses.batched_augment import BatchedAugmentation
+
+augment_trans = BatchedAugmentation(512, distortion_scale=0.5, scale=(0.7,0.9), fill=1)
 
 def load_stable_pipe():
     stable_pipe = StableDiffusionPipeline.from_pretrained("CompVis/stable-diffusion-v1-4",
@@ -44,10 +43,7 @@ def stable_diffusion_loss(img_cut, text_embeddings, guidance_scale=70.0, num_aug
         stable_pipe = load_stable_pipe()
 
     # Augment
-    img_augs = []
-    for n in range(num_augs):
-        img_augs.append(augment_trans(img_cut))
-    img_cut = torch.cat(img_augs) * 2 - 1
+    img_cut = augment_trans(img_cut, num_augs=num_augs) * 2 - 1
 
     img_cut = torch.nn.functional.interpolate(img_cut, (512, 512))#############################
     # img_cut = torch.nn.functional.interpolate(img_cut, (400, 400))
@@ -0,0 +1,129 @@
+'''
+Optimize several initializations of a painting at the same time and keep the best.
+
+The paintings on a device are rendered together: the strokes of all of them go through
+param2img as one batch and are then composited onto their own canvases. With several devices,
+each device gets a share of the paintings and runs in its own thread. The losses are computed
+one painting at a time (they share models that aren't thread safe), the renders and backward
+passes overlap.
+'''
+
+import copy
+import threading
+import torch
+from tqdm import tqdm
+
+from brush_stroke import StrokeBatch
+from param2stroke import get_param2img
+from stroke_renderer import render_stroke_alphas, composite_strokes
+
+loss_lock = threading.Lock()
+
+
+def as_device(d):
+    ''' torch.device with an index for cuda, so it compares equal to tensor.device '''
+    d = torch.device(d)
+    if d.type == 'cuda' and d.index is None:
+        d = torch.device('cuda', torch.cuda.current_device())
+    return d
+
+def replicate_painting(opt, painting, device):
+    ''' Copy of the painting on another device, with its own param2img there '''
+    painting = copy.deepcopy(painting).to(device)
+    if painting.background_img is not None:
+        painting.background_img = painting.background_img.to(device)
+    painting.param2img = get_param2img(opt, device=device)
+    return painting
+
+def render_paintings(paintings, h, w, use_alpha=True, return_alphas=False):
+    '''
+    Render paintings that are on the same device, with all of their strokes in one param2img batch
+    returns:
+        list of each painting's canvas (and summed stroke alphas if return_alphas), like Painting.forward
+    '''
+    if len(paintings) == 1 or any([p.tile_compositing for p in paintings]) \
+            or any([len(p.brush_strokes) == 0 for p in paintings]):
+        return [p(h, w, use_alpha=use_alpha, return_alphas=return_alphas) for p in paintings]
+
+    strokes = [p.brush_strokes.ordered() for p in paintings]
+    s = {name:torch.cat([stroke[name] for stroke in strokes]) for name in StrokeBatch.attributes}
+    stroke_alphas = render_stroke_alphas(paintings[0].param2img,
+        s['stroke_length'], s['stroke_bend'], s['stroke_z'], s['stroke_alpha'], s['a'], s['xt'], s['yt'],
+        h, w)
+    stroke_alphas = torch.split(stroke_alphas, [len(p.brush_strokes) for p in paintings])
+
+    results = []
+    for painting, stroke, alphas in zip(paintings, strokes, stroke_alphas):
+        canvas = composite_strokes(painting.background_canvas(h, w), alphas, stroke['color_transform'],
+                                   use_alpha=use_alpha)
+        results.append((canvas, torch.sum(alphas, dim=0)) if return_alphas else canvas)
+    return results
+
+def optimize_multi_start(paintings, loss_fn, n_iters, h, w, lr_multiplier=1.0, ink=False,
+                         after_step=None, devices=None, opt=None, top_k=1, desc='Multi-start Optimization'):
+    '''
+    Optimize each painting independently and rank them by their final loss
+    args:
+        paintings (list[Painting]) : the initializations, on the same device
+        loss_fn (function(p, alphas) -> loss) : loss of one rendered painting
+    kwargs:
+        after_step (function(painting) -> painting) : e.g. validate and sort the strokes
+        devices (list) : spread the paintings over these devices. Needs opt to load param2img on each
+        top_k (int) : how many of the best paintings to return
+    returns:
+        list[(float, Painting)] : the top_k (final loss, painting), best first. On the paintings' original device.
+    '''
+    home = paintings[0].brush_strokes.xt.device
+    devices = [home] if devices is None or len(devices) == 0 else [as_device(d) for d in devices]
+
+    groups = [[] for _ in devices]
+    for k, painting in enumerate(paintings):
+        d = k % len(devices)
+        if devices[d] != home:
+            painting = replicate_painting(opt, painting, devices[d])
+        groups[d].append(painting)
+
+    final_losses = [[None]*len(group) for group in groups]
+    def optimize_group(g):
+        group = groups[g]
+        if len(group) == 0: return
+        optims = [p.get_optimizers(multiplier=lr_multiplier, ink=ink) for p in group]
+        iters = tqdm(range(n_iters), desc=desc) if g == 0 else range(n_iters)
+        for j in iters:
+            for painting_optims in optims:
+                for o in painting_optims: o.zero_grad() if o is not None else None
+
+            renders = render_paintings(group, h, w, use_alpha=True, return_alphas=True)
+            losses = []
+            for p, alphas in renders:
+                with loss_lock:
+                    losses.append(loss_fn(p, alphas))
+            sum(losses).backward()
+
+            for k in range(len(group)):
+                for o in optims[k]: o.step() if o is not None else None
+                group[k].validate()
+                for o in optims[k]: o.param_groups[0]['lr'] = o.param_groups[0]['lr'] * 0.95 if o is not None else None
+                if after_step is not None:
+                    group[k] = after_step(group[k])
+        final_losses[g] = [l.item() for l in losses]
+
+    if len(devices) == 1:
+        optimize_group(0)
+    else:
+        errors = []
+        def run(g):
+            try:
+                optimize_group(g)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(g,)) for g in range(len(devices))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    results = [(loss, painting) for g in range(len(groups)) for loss, painting in zip(final_losses[g], groups[g])]
+    results = sorted(results, key=lambda r : r[0])[:top_k]
+    return [(loss, painting if painting.brush_strokes.xt.device == home else replicate_painting(opt, painting, home))
+            for loss, painting in results]
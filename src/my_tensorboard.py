@@ -13,8 +13,8 @@ def process_img_for_logging(img, max_size=1024.):
     return img
 
 class TensorBoard(object):
-    def __init__(self, model_dir):
-        self.summary_writer = SummaryWriter(model_dir)
+    def __init__(self, model_dir, flush_secs=10):
+        self.summary_writer = SummaryWriter(model_dir, flush_secs=flush_secs)
     def add_image(self, tag, img, step=None, max_size=1024.):
         ''' Expects channels last rgb image '''
         img = np.array(img)
@@ -28,6 +28,9 @@ class TensorBoard(object):
             img = np.array(img)
         img = np.transpose(img, (2, 0, 1))
         self.summary_writer.add_image(tag, img, step)
+        # Not flushed here, the SummaryWriter's own thread flushes every flush_secs
+
+    def flush(self):
         self.summary_writer.flush()
 
     def add_scalar(self, tag, value, step=None):
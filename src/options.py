@@ -46,6 +46,12 @@ class Options(object):
 
         # Rendering Parameters
         parser.add_argument('--render_height', default=256, type=int, help='How much to downscale canvas for simulated environment')
+        parser.add_argument('--tile_compositing', action='store_true', help="Only render and blend each stroke's bounding box \
+                instead of the whole canvas. Memory scales with stroke area, so it allows much larger render_height.")
+        parser.add_argument('--param2img_atlas', action='store_true', help="Sample the stroke model once on a grid of \
+                stroke parameters and interpolate from that during optimization instead of running the model.")
+        parser.add_argument('--param2img_atlas_grid', nargs=4, type=int, default=[16,9,9,5], 
+                help='Number of atlas samples for length, bend, z and alpha.')
 
         # Stroke Library Parameters
         parser.add_argument('--num_papers', default=4, type=int, help='How papers of strokes to paint for stroke modelling data.')
@@ -65,11 +71,43 @@ class Options(object):
         parser.add_argument('--init_optim_iter', type=int, default=400)
         parser.add_argument('--optim_iter', type=int, default=150)
         parser.add_argument('--lr_multiplier', type=float, default=0.2)
+        parser.add_argument('--amp', action='store_true', help='Render and compute losses in mixed precision \
+                with gradient scaling (stroke parameters stay fp32). Reports the drift from fp32 before the first optimization.')
+        parser.add_argument('--compile_step', action='store_true', help='Compile render, loss, backward and optimizer \
+                steps into one torch.compile function (CUDA graphs on GPU). Recompiles when the number of strokes changes.')
+        parser.add_argument('--pyramid_levels', type=int, default=1, help='Coarse-to-fine planning. Optimize \
+                at 1/2^(levels-1) of the render size first, doubling it each level up to the full size.')
+        parser.add_argument('--pyramid_split', type=float, nargs='*', default=None, help='Fraction of the \
+                iterations spent at each pyramid level, coarsest first. Default is an even split.')
+        parser.add_argument('--early_stop', action='store_true', help='Skip to the final iterations of the \
+                optimization (where colors are discretized) once the loss and stroke parameters stop changing.')
+        parser.add_argument('--early_stop_tol', type=float, default=1e-3, help='Relative loss improvement over \
+                --early_stop_patience iterations, and relative parameter update size, that counts as converged.')
+        parser.add_argument('--early_stop_patience', type=int, default=20)
+        parser.add_argument('--early_stop_ema', type=float, default=0.9, help='EMA decay for the loss and update norms')
+        parser.add_argument('--early_stop_min_iter', type=float, default=0.3, help='Fraction of the iterations to always run')
 
         parser.add_argument('--num_augs', type=int, default=30)
 
         # Painting Parameters
         parser.add_argument('--how_often_to_get_paint', type=int, default=4)
+        parser.add_argument('--occlusion_threshold', type=float, default=0.05, help='Strokes of which less than this \
+                fraction shows in the painting are hidden. They are removed before the plan is executed. 0 to keep all of them')
+        parser.add_argument('--occlusion_reseed_every', type=int, default=0, help='Move hidden strokes to a new \
+                random spot every this many iterations, during the first half of the optimization. 0 for never')
+        parser.add_argument('--occlusion_prune', action='store_true', help='Remove hidden strokes at the end \
+                of each optimization, so they are not rendered when replanning')
+        parser.add_argument('--dry_run', action='store_true', help='Compile the plan into robot trajectories and \
+                report the path length and estimated duration instead of painting it. See plan_compiler.py')
+        parser.add_argument('--schedule_execution', action='store_true', help='Reorder the strokes before \
+                executing them to save time moving, cleaning the brush and getting paint. See stroke_scheduler.py')
+        parser.add_argument('--exec_overlap_margin', type=float, default=0.01, help='(m) Strokes of different \
+                colors closer than this keep their order when scheduling')
+        parser.add_argument('--exec_travel_speed', type=float, default=0.1, help='(m/s) For time estimates')
+        parser.add_argument('--exec_paint_speed', type=float, default=0.05, help='(m/s) For time estimates')
+        parser.add_argument('--exec_stroke_time', type=float, default=2.0, help='(s) Getting on and off the canvas for each stroke')
+        parser.add_argument('--exec_clean_time', type=float, default=15.0, help='(s) One clean_paint_brush')
+        parser.add_argument('--exec_get_paint_time', type=float, default=8.0, help='(s) One get_paint')
 
         # Logging Parameters
         parser.add_argument("--tensorboard_dir", type=str,
@@ -105,6 +143,22 @@ class Options(object):
             default=100, help='Minimum number of strokes in a cofrida training painting')
         parser.add_argument("--n_iters", type=int,
             default=300, help='Number of optimization iterations.')
+        parser.add_argument("--cofrida_batch_size", type=int,
+            default=1, help='How many cofrida training paintings to optimize together in one batch.')
+        parser.add_argument("--cofrida_worker_id", type=int,
+            default=0, help='Run several create_copaint_data.py workers on the same --output_parent_dir with different ids.')
+        parser.add_argument("--cofrida_claim_size", type=int,
+            default=100, help='How many samples a worker claims at a time.')
+        parser.add_argument("--cofrida_claim_timeout", type=float,
+            default=0, help='(s) Take over the samples claimed by a worker that has not started a sample in this long, \
+                e.g. because it crashed. Must be longer than any pause of a live worker (retraining the LoRA model). \
+                0 to never, then restart a crashed worker with the same --cofrida_worker_id to finish its samples.')
+        parser.add_argument("--cofrida_queue_size", type=int,
+            default=8, help='Max. samples waiting between each stage of the cofrida data pipeline.')
+        parser.add_argument("--image_writer_workers", type=int,
+            default=2, help='Threads that encode and write images and TensorBoard logs in the background.')
+        parser.add_argument("--image_writer_queue", type=int,
+            default=16, help='Max. images waiting to be written before the caller has to wait.')
         parser.add_argument("--colors", type=str,
             default=None, help='Specify a fixed palette of paint colors.')
         parser.add_argument("--codraw_metric_data_dir", type=str,
@@ -116,6 +116,12 @@ class Options(object):
         # parser.add_argument('--type', default='cubic_bezier', type=str, help='Type of instructions: [cubic_bezier | bezier]')
         # parser.add_argument('--continue_ind', default=0, type=int, help='Instruction to start from. Default 0.')
         parser.add_argument('--simulate', action='store_true', default=True)
+        parser.add_argument('--tile_compositing', action='store_true', help="Only render and blend each stroke's bounding box \
+                instead of the whole canvas. Memory scales with stroke area, so it allows much larger renders.")
+        parser.add_argument('--param2img_atlas', action='store_true', help="Sample the stroke model once on a grid of \
+                stroke parameters and interpolate from that during optimization instead of running the model.")
+        parser.add_argument('--param2img_atlas_grid', nargs=4, type=int, default=[16,9,9,5], 
+                help='Number of atlas samples for length, bend, z and alpha.')
 
 
 
@@ -132,8 +138,33 @@ class Options(object):
         parser.add_argument('--init_objective_weight', nargs='*', type=float, default=1.0)
         parser.add_argument('--init_optim_iter', type=int, default=40)
         parser.add_argument('--n_inits', type=int, default=0, help='Number of times to try different initializations')
+        parser.add_argument('--multi_start_devices', nargs='*', type=str, default=None, help='Spread the \
+                --n_inits initializations over these devices, e.g. cuda:0 cuda:1. Default is all on one device.')
+        parser.add_argument('--multi_start_top_k', type=int, default=1, help='How many of the best \
+                initializations to keep (in plan_hci.top_k_plans)')
 
         parser.add_argument('--intermediate_optim_iter', type=int, default=40)
+        parser.add_argument('--early_stop', action='store_true', help='Skip to the final iterations of the \
+                optimization (where colors are discretized) once the loss and stroke parameters stop changing.')
+        parser.add_argument('--early_stop_tol', type=float, default=1e-3, help='Relative loss improvement over \
+                --early_stop_patience iterations, and relative parameter update size, that counts as converged.')
+        parser.add_argument('--early_stop_patience', type=int, default=20)
+        parser.add_argument('--early_stop_ema', type=float, default=0.9, help='EMA decay for the loss and update norms')
+        parser.add_argument('--early_stop_min_iter', type=float, default=0.3, help='Fraction of the iterations to always run')
+        parser.add_argument('--amp', action='store_true', help='Render and compute losses in mixed precision \
+                with gradient scaling (stroke parameters stay fp32). Reports the drift from fp32 before the first optimization.')
+        parser.add_argument('--compile_step', action='store_true', help='Compile render, loss, backward and optimizer \
+                steps into one torch.compile function (CUDA graphs on GPU). Recompiles when the number of strokes changes.')
+        parser.add_argument('--pyramid_levels', type=int, default=1, help='Coarse-to-fine planning. Optimize \
+                at 1/2^(levels-1) of the render size first, doubling it each level up to the full size.')
+        parser.add_argument('--pyramid_split', type=float, nargs='*', default=None, help='Fraction of the \
+                iterations spent at each pyramid level, coarsest first. Default is an even split.')
+        parser.add_argument('--occlusion_threshold', type=float, default=0.05, help='Strokes of which less than this \
+                fraction shows in the painting are hidden. 0 to keep all of them')
+        parser.add_argument('--occlusion_reseed_every', type=int, default=0, help='Move hidden strokes to a new \
+                random spot every this many iterations, during the first half of the optimization. 0 for never')
+        parser.add_argument('--occlusion_prune', action='store_true', help='Remove hidden strokes at the end \
+                of each optimization, so they are not rendered when replanning')
         parser.add_argument('--use_colors_from', type=str, default=None, help="Get the colors from this image. \
                 None if you want the colors to come from the optimized painting.")
 
@@ -142,6 +173,10 @@ class Options(object):
 
         parser.add_argument('--plan_gif_dir', type=str, default='/home/frida/Videos/frida/')
         parser.add_argument('--log_frequency', type=int, default=500)
+        parser.add_argument("--image_writer_workers", type=int,
+            default=2, help='Threads that encode and write images and TensorBoard logs in the background.')
+        parser.add_argument("--image_writer_queue", type=int,
+            default=16, help='Max. images waiting to be written before the caller has to wait.')
 
         parser.add_argument("--output_dir", type=str, default="../outputs/", help='Where to write output to.')
 
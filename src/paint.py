@@ -6,13 +6,14 @@
 ################ All rights reserved. ####################
 ##########################################################
 
+import os
 import sys
 import cv2
 import datetime
 import numpy as np
 
 import torch
-from paint_utils3 import canvas_to_global_coordinates, get_colors, nearest_color, random_init_painting, save_colors, show_img
+from paint_utils3 import get_colors, prune_hidden_strokes, random_init_painting, save_colors, show_img
 
 from painter import Painter
 from options import Options
@@ -20,6 +21,8 @@ from options import Options
 
 from my_tensorboard import TensorBoard
 from painting_optimization import load_objectives_data, optimize_painting
+from stroke_scheduler import schedule_strokes
+from plan_compiler import compile_plan, execute_plan, new_execution_state, program_stats, save_program
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -49,9 +52,7 @@ if __name__ == '__main__':
     h_render = int(opt.render_height)
     opt.w_render, opt.h_render = w_render, h_render
 
-    consecutive_paints = 0
-    consecutive_strokes_no_clean = 0
-    curr_color = -1
+    brush_state = new_execution_state() # Which paint is on the brush, see plan_compiler.py
 
     color_palette = None
     if opt.use_colors_from is not None:
@@ -81,35 +82,32 @@ if __name__ == '__main__':
     strokes_per_adaptation = int(len(painting) / opt.num_adaptations)
     # for adaptation_it in range(opt.num_adaptations):
     while len(painting) > 0:
+        # Don't paint strokes that will be covered up anyway
+        n_strokes = len(painting)
+        painting = prune_hidden_strokes(painting, h_render, w_render, threshold=opt.occlusion_threshold)
+        print('Removed {} hidden strokes before painting'.format(n_strokes - len(painting)))
+
+        if opt.schedule_execution:
+            painting = schedule_strokes(opt, painting, color_palette, curr_color=brush_state['curr_color'])
+
+        if opt.dry_run:
+            # Compile the whole plan and report on it instead of painting
+            program, _ = compile_plan(opt, painter, painting, color_palette, state=brush_state)
+            stats = program_stats(opt, program)
+            print('Dry run: {} strokes, {} cleans, {} paint dips, path {:.2f} m ({:.2f} m painting), ~{:.1f} min'.format(
+                stats['strokes'], stats['cleans'], stats['get_paints'], stats['path_m'], stats['stroke_m'], stats['seconds']/60))
+            for k, v in stats.items():
+                opt.writer.add_scalar('dry_run/{}'.format(k), v, 0)
+            os.makedirs(opt.output_dir, exist_ok=True)
+            save_program(program, os.path.join(opt.output_dir, 'plan_program.json'))
+            break
+
         ################################
         ### Execute some of the plan ###
         ################################
-        for stroke_ind in range(min(len(painting),strokes_per_adaptation)):
-            stroke = painting.pop()            
-            
-            # Clean paint brush and/or get more paint
-            if not painter.opt.ink:
-                color_ind, _ = nearest_color(stroke.color_transform.detach().cpu().numpy(), 
-                                             color_palette.detach().cpu().numpy())
-                new_paint_color = color_ind != curr_color
-                if new_paint_color or consecutive_strokes_no_clean > 12:
-                    painter.clean_paint_brush()
-                    painter.clean_paint_brush()
-                    consecutive_strokes_no_clean = 0
-                    curr_color = color_ind
-                    new_paint_color = True
-                if consecutive_paints >= opt.how_often_to_get_paint or new_paint_color:
-                    painter.get_paint(color_ind)
-                    consecutive_paints = 0
-
-            # Convert the canvas proportion coordinates to meters from robot
-            x, y = stroke.transformation.xt.item()*0.5+0.5, stroke.transformation.yt.item()*0.5+0.5
-            y = 1-y
-            x, y = min(max(x,0.),1.), min(max(y,0.),1.) #safety
-            x_glob, y_glob,_ = canvas_to_global_coordinates(x,y,None,painter.opt)
-
-            # Runnit
-            stroke.execute(painter, x_glob, y_glob, stroke.transformation.a.item())
+        # Compiling the next strokes' trajectories overlaps with painting the current ones
+        brush_state = execute_plan(opt, painter, painting, n_strokes=strokes_per_adaptation,
+                                   color_palette=color_palette, state=brush_state)
 
         #######################
         ### Update the plan ###
@@ -53,14 +53,49 @@ def load_img(path, h=None, w=None):
     im = im.permute(2,0,1)
     return im.unsqueeze(0).float()
 
-def get_colors(img, n_colors=6):
-    from sklearn.cluster import KMeans
-    kmeans = KMeans(n_clusters=n_colors, random_state=0)
-    kmeans.fit(img.reshape((img.shape[0]*img.shape[1],3)))
-    colors = [kmeans.cluster_centers_[i] for i in range(len(kmeans.cluster_centers_))]
-    colors = (torch.from_numpy(np.array(colors)) / 255.).float()
+def get_colors(img, n_colors=6, seed=0):
+    ''' Fixed palette: the k-means centers of the image's pixels (np.array 0-255) '''
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    pixels = torch.from_numpy(np.ascontiguousarray(img.reshape((img.shape[0]*img.shape[1],3)))).float().to(device)
+    colors, _ = kmeans_torch(pixels, n_colors, seed=seed)
+    colors = (colors / 255.).float().cpu()
     return colors
 
+def kmeans_torch(x, n_clusters, init=None, n_iters=20, seed=0):
+    '''
+    K-means that stays on x's device. Deterministic given the seed.
+    args:
+        x (torch.Tensor[N,D]) : points
+        init (torch.Tensor[n_clusters,D]) : warm start centers (e.g. from the last call). 
+            k-means++ initialization if None
+    kwargs:
+        n_iters : fixed number of Lloyd iterations, so there's no host-device sync for checking convergence
+    returns:
+        torch.Tensor[n_clusters,D] : centers
+        torch.Tensor[N] : cluster index of each point
+    '''
+    x = x.float()
+    if init is None or len(init) != n_clusters:
+        generator = torch.Generator(device=x.device)
+        generator.manual_seed(seed)
+        # k-means++
+        centers = x[torch.randint(len(x), (1,), generator=generator, device=x.device)]
+        for _ in range(1, n_clusters):
+            d = torch.cdist(x, centers).min(dim=1).values**2
+            probs = d + 1e-12 # Duplicate points would otherwise give all zeros
+            centers = torch.cat([centers, x[torch.multinomial(probs, 1, generator=generator)]])
+    else:
+        centers = init.to(x.device).float().clone()
+
+    for _ in range(n_iters):
+        labels = torch.cdist(x, centers).argmin(dim=1)
+        sums = torch.zeros_like(centers).index_add_(0, labels, x)
+        counts = torch.bincount(labels, minlength=n_clusters).to(x.dtype)[:,None]
+        # Empty clusters keep their old center
+        centers = torch.where(counts > 0, sums / counts.clamp(min=1), centers)
+    labels = torch.cdist(x, centers).argmin(dim=1)
+    return centers, labels
+
 def to_video(frames, fn='animation{}.mp4'.format(time.time()), frame_rate=10):
     if len(frames) == 0: return
     h, w = frames[0].shape[0], frames[0].shape[1]
@@ -109,44 +144,81 @@ def show_img(img, display_actual_size=True, title=""):
 
 def sort_brush_strokes_by_color(painting, bin_size=3000):
     with torch.no_grad():
-        brush_strokes = [bs for bs in painting.brush_strokes]
-        for j in range(0,len(brush_strokes), bin_size):
-            brush_strokes[j:j+bin_size] = sorted(brush_strokes[j:j+bin_size], 
-                key=lambda x : x.color_transform.mean()+x.color_transform.prod(), 
-                reverse=True)
-        painting.brush_strokes = nn.ModuleList(brush_strokes)
+        strokes = painting.brush_strokes
+        colors = strokes.color_transform[strokes.order]
+        key = colors.mean(dim=1) + colors.prod(dim=1)
+        # Sort by color within each bin of bin_size strokes
+        perm = torch.sort(key, descending=True, stable=True)[1]
+        bins = torch.arange(len(strokes), device=perm.device) // bin_size
+        perm = perm[torch.sort(bins[perm], stable=True)[1]]
+        strokes.reorder(perm)
         return painting
 
 def sort_brush_strokes_by_location(painting, bin_size=3000):
-    from scipy.spatial import distance_matrix
-    points = np.zeros((2, len(painting.brush_strokes)))
-    for i in range(len(painting.brush_strokes)):
-        points[0,i] = painting.brush_strokes[i].transformation.xt.detach().cpu().numpy()
-        points[1,i] = painting.brush_strokes[i].transformation.yt.detach().cpu().numpy()
-    d_mat = distance_matrix(points.T, points.T)
-    
-    from tsp_solver.greedy import solve_tsp
-    ordered_stroke_inds = solve_tsp(d_mat)
+    ''' Order the strokes along a short path through their positions. 
+    Hilbert curve/nearest neighbor seed and local 2-opt on a k-d tree, see stroke_scheduler.order_run.
+    Never builds the N x N distance matrix, 100k strokes take a few seconds. '''
+    from stroke_scheduler import order_run
+    strokes = painting.brush_strokes
+    if len(strokes) < 3: return painting
+    with torch.no_grad():
+        # All the positions in one copy
+        points = torch.stack([strokes.xt, strokes.yt], dim=1)[strokes.order].detach().cpu().numpy()
+    # Limiting the reversals keeps 2-opt linear in the number of strokes
+    ordered_stroke_inds = order_run(points.astype(np.float64), max_reverse=50 if len(points) > 5000 else None)
+
+    with torch.no_grad():
+        strokes.reorder(ordered_stroke_inds)
+        return painting
+
+def hidden_stroke_inds(painting, h, w, threshold):
+    ''' Positions (painting order) of the strokes of which less than threshold (fraction of the stroke)
+    shows in the final painting. See Painting.stroke_visibility '''
+    visible, footprint = painting.stroke_visibility(h, w)
+    return torch.nonzero(visible < threshold * footprint.clamp(min=1e-6))[:,0]
 
+def prune_hidden_strokes(painting, h, w, threshold=0.05):
+    ''' Remove strokes that are (almost) completely covered by the strokes above them.
+    Replaces the parameter tensors, like StrokeBatch.keep, so optimizers need to be recreated. '''
+    if len(painting.brush_strokes) == 0 or threshold <= 0: return painting
     with torch.no_grad():
-        brush_strokes = [painting.brush_strokes[i] for i in ordered_stroke_inds]
-        painting.brush_strokes = nn.ModuleList(brush_strokes)
+        hidden = hidden_stroke_inds(painting, h, w, threshold)
+        if len(hidden) > 0:
+            keep = torch.ones(len(painting.brush_strokes), dtype=torch.bool, device=hidden.device)
+            keep[hidden] = False
+            painting.brush_strokes.keep(torch.nonzero(keep)[:,0])
         return painting
 
+def reseed_hidden_strokes(painting, h, w, threshold=0.05):
+    ''' Move strokes that are (almost) completely covered to a random place and angle, so they can 
+    contribute something. In place, so the optimizers and compiled steps stay valid.
+    returns:
+        int : how many were moved '''
+    if len(painting.brush_strokes) == 0 or threshold <= 0: return 0
+    with torch.no_grad():
+        strokes = painting.brush_strokes
+        hidden = hidden_stroke_inds(painting, h, w, threshold)
+        rows = strokes.order[hidden]
+        n = len(rows)
+        if n > 0:
+            strokes.xt.data[rows] = torch.rand(n, device=rows.device)*2-1
+            strokes.yt.data[rows] = torch.rand(n, device=rows.device)*2-1
+            strokes.a.data[rows] = (torch.rand(n, device=rows.device)*2-1)*3.14
+        return n
+
 def randomize_brush_stroke_order(painting):
     with torch.no_grad():
-        brush_strokes = [bs for bs in painting.brush_strokes]
-        random.shuffle(brush_strokes)
-        painting.brush_strokes = nn.ModuleList(brush_strokes)
+        painting.brush_strokes.reorder(torch.randperm(len(painting.brush_strokes)))
         return painting
 
 def discretize_colors(painting, discrete_colors):
-    # pass
+    ''' Set every stroke's color to the nearest palette color (all strokes at once) '''
     with torch.no_grad():
-        for brush_stroke in painting.brush_strokes:
-            new_color = discretize_color(brush_stroke, discrete_colors)
-            brush_stroke.color_transform.data *= 0
-            brush_stroke.color_transform.data += new_color
+        colors = painting.brush_strokes.color_transform
+        if len(colors) == 0: return
+        discrete_colors = discrete_colors.to(colors.device)
+        inds = nearest_color_inds(colors.data, discrete_colors)
+        colors.data.copy_(discrete_colors[inds].to(colors.dtype))
 
 def rgb2lab(image_rgb):
     image_rgb = image_rgb.astype(np.float32)
@@ -163,30 +235,117 @@ def lab2rgb(image_lab):
     image_rgb = cv2.cvtColor(image_lab, cv2.COLOR_LAB2RGB)
     return image_rgb
 
-def discretize_color(brush_stroke, discrete_colors):
-    dc = discrete_colors.cpu().detach().numpy()
-    #print('dc', dc.shape)
-    dc = dc[None,:,:]
-    #print('dc', dc.shape, dc.max())
-    dc = cv2.cvtColor(dc, cv2.COLOR_RGB2Lab)
-    #print('dc', dc.shape, dc.max())
+def discretize_color(color, discrete_colors):
+    ''' Nearest palette color to a single color (torch.Tensor[3]) '''
     with torch.no_grad():
-        color = brush_stroke.color_transform.detach()
-        # dist = torch.mean(torch.abs(discrete_colors - color[None,:])**2, dim=1)
-        # argmin = torch.argmin(dist)
-        c = color[None,None,:].detach().cpu().numpy()
-        #print('c', c.shape)
-        # print(c)
-        c = cv2.cvtColor(c, cv2.COLOR_RGB2Lab)
-        #print('c', c.shape)
-
-        
-        dist = colour.delta_E(dc, c)
-        #print(dist.shape)
-        argmin = np.argmin(dist)
-
-        return discrete_colors[argmin].clone()
+        discrete_colors = discrete_colors.to(color.device)
+        ind = nearest_color_inds(color.detach()[None], discrete_colors)[0]
+        return discrete_colors[ind].clone()
 
+def rgb2lab_torch(rgb):
+    ''' Same as rgb2lab (cv2.COLOR_RGB2Lab on [0,1] floats: sRGB, D65) but on torch tensors.
+    Differentiable.
+    args:
+        rgb (torch.Tensor[...,3]) : [0,1]
+    returns:
+        torch.Tensor[...,3] : L in [0,100], a and b roughly in [-127,127]
+    '''
+    rgb = rgb.clamp(0, 1)
+    linear = torch.where(rgb > 0.04045, ((rgb + 0.055) / 1.055).clamp(min=1e-8)**2.4, rgb / 12.92)
+    m = torch.tensor([[0.412453, 0.357580, 0.180423],
+                      [0.212671, 0.715160, 0.072169],
+                      [0.019334, 0.119193, 0.950227]], device=rgb.device, dtype=rgb.dtype)
+    xyz = linear @ m.T
+    xyz = xyz / torch.tensor([0.950456, 1., 1.088754], device=rgb.device, dtype=rgb.dtype)
+
+    eps = 216/24389.
+    f = torch.where(xyz > eps, xyz.clamp(min=1e-8)**(1/3.), (24389/27. * xyz + 16) / 116.)
+    L = torch.where(xyz[...,1] > eps, 116. * f[...,1] - 16, 24389/27. * xyz[...,1])
+    a = 500. * (f[...,0] - f[...,1])
+    b = 200. * (f[...,1] - f[...,2])
+    return torch.stack([L, a, b], dim=-1)
+
+def lab2rgb_torch(lab):
+    ''' Inverse of rgb2lab_torch 
+    args:
+        lab (torch.Tensor[...,3])
+    returns:
+        torch.Tensor[...,3] : RGB [0,1]
+    '''
+    L, a, b = lab[...,0], lab[...,1], lab[...,2]
+    fy = (L + 16) / 116.
+    f = torch.stack([fy + a / 500., fy, fy - b / 200.], dim=-1)
+    eps = 6/29.
+    xyz = torch.where(f > eps, f**3, (f - 16/116.) * 3 * eps**2)
+    xyz = xyz * torch.tensor([0.950456, 1., 1.088754], device=lab.device, dtype=lab.dtype)
+    m = torch.tensor([[ 3.240479, -1.53715,  -0.498535],
+                      [-0.969256,  1.875991,  0.041556],
+                      [ 0.055648, -0.204043,  1.057311]], device=lab.device, dtype=lab.dtype)
+    linear = (xyz @ m.T).clamp(0, 1)
+    return torch.where(linear > 0.0031308, 1.055 * linear.clamp(min=1e-8)**(1/2.4) - 0.055, 12.92 * linear)
+
+def delta_e_torch(lab0, lab1, method='CIE 2000'):
+    ''' Color difference like colour.delta_E, but on torch tensors that broadcast against each other.
+    args:
+        lab0, lab1 (torch.Tensor[...,3])
+        method : 'CIE 2000' (colour's default) or 'CIE 1976' (Euclidean distance in Lab)
+    '''
+    if method == 'CIE 1976':
+        return ((lab0 - lab1)**2).sum(dim=-1).clamp(min=1e-12).sqrt()
+    if method != 'CIE 2000':
+        raise Exception('Unknown delta E method: ' + method)
+
+    L1, a1, b1 = lab0[...,0], lab0[...,1], lab0[...,2]
+    L2, a2, b2 = lab1[...,0], lab1[...,1], lab1[...,2]
+    sqrt = lambda x : x.clamp(min=1e-12).sqrt()
+
+    C_bar = (sqrt(a1**2 + b1**2) + sqrt(a2**2 + b2**2)) / 2
+    G = 0.5 * (1 - sqrt(C_bar**7 / (C_bar**7 + 25.**7)))
+    a1, a2 = (1 + G) * a1, (1 + G) * a2
+    C1, C2 = sqrt(a1**2 + b1**2), sqrt(a2**2 + b2**2)
+    h1 = torch.rad2deg(torch.atan2(b1, a1)) % 360
+    h2 = torch.rad2deg(torch.atan2(b2, a2)) % 360
+    no_hue = (C1 * C2) == 0
+
+    dL = L2 - L1
+    dC = C2 - C1
+    dh = h2 - h1
+    dh = torch.where(dh > 180, dh - 360, torch.where(dh < -180, dh + 360, dh))
+    dh = torch.where(no_hue, torch.zeros_like(dh), dh)
+    dH = 2 * sqrt(C1 * C2) * torch.sin(torch.deg2rad(dh) / 2)
+
+    L_bar = (L1 + L2) / 2
+    C_bar = (C1 + C2) / 2
+    h_sum = h1 + h2
+    h_bar = torch.where((h1 - h2).abs() <= 180, h_sum / 2, 
+                        torch.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2))
+    h_bar = torch.where(no_hue, h_sum, h_bar)
+
+    T = 1 - 0.17 * torch.cos(torch.deg2rad(h_bar - 30)) \
+          + 0.24 * torch.cos(torch.deg2rad(2 * h_bar)) \
+          + 0.32 * torch.cos(torch.deg2rad(3 * h_bar + 6)) \
+          - 0.20 * torch.cos(torch.deg2rad(4 * h_bar - 63))
+    d_theta = 30 * torch.exp(-((h_bar - 275) / 25)**2)
+    R_C = 2 * sqrt(C_bar**7 / (C_bar**7 + 25.**7))
+    S_L = 1 + 0.015 * (L_bar - 50)**2 / sqrt(20 + (L_bar - 50)**2)
+    S_C = 1 + 0.045 * C_bar
+    S_H = 1 + 0.015 * C_bar * T
+    R_T = -torch.sin(torch.deg2rad(2 * d_theta)) * R_C
+
+    return sqrt((dL / S_L)**2 + (dC / S_C)**2 + (dH / S_H)**2 + R_T * (dC / S_C) * (dH / S_H))
+
+def nearest_color_inds(colors, discrete_colors, method='CIE 2000'):
+    ''' Index of the nearest palette color for every color, all in one go
+    args:
+        colors (torch.Tensor[N,3]) : RGB [0,1]
+        discrete_colors (torch.Tensor[K,3]) : RGB [0,1]
+    returns:
+        torch.Tensor[N] : indices into discrete_colors
+    '''
+    lab = rgb2lab_torch(colors.float())
+    palette_lab = rgb2lab_torch(discrete_colors.float())
+    dist = delta_e_torch(lab[:,None,:], palette_lab[None,:,:], method=method) # N x K
+    return torch.argmin(dist, dim=1)
 
 def compare_images(img1, img2):
     ''' Pixel wise comparison '''
@@ -196,10 +355,12 @@ def compare_images(img1, img2):
 
 def nearest_color(color, discrete_colors):
     ''' Get the most similar color to a given color (np.array([3])) '''
-    #dist = np.mean(np.abs(discrete_colors - color[None,:])**2, axis=1)
-    #argmin = np.argmin(dist)
-    diffs = [compare_images(rgb2lab(c[np.newaxis, np.newaxis]), rgb2lab(color[np.newaxis, np.newaxis])) for c in discrete_colors]
-    color_ind = np.argmin(np.array(diffs))
+    color = torch.from_numpy(np.array(color, dtype=np.float32))
+    palette = torch.from_numpy(np.array(discrete_colors, dtype=np.float32))
+    # Same as rgb2lab, which treats 0-255 colors as such
+    if color.max() > 2: color = color / 255.
+    palette = torch.where(palette.max(dim=1, keepdim=True).values > 2, palette / 255., palette)
+    color_ind = int(nearest_color_inds(color[None], palette)[0])
     return color_ind, discrete_colors[color_ind]
 
 def save_colors(allowed_colors):
@@ -274,7 +435,7 @@ def random_init_painting(opt, background_img, n_strokes, ink=False, device='cuda
     random.shuffle(xys)
     for x,y in xys:
         # Random brush stroke
-        brush_stroke = BrushStroke(opt, xt=x, yt=y, ink=ink)
+        brush_stroke = BrushStroke(opt, xt=x, yt=y, ink=ink, device=device)
         gridded_brush_strokes.append(brush_stroke)
 
     painting = Painting(opt, 0, background_img=background_img, 
@@ -305,8 +466,9 @@ def create_tensorboard(log_dir='painting_log'):
 
 
 def parse_csv_line_continuous(line):
+    ''' Parse a line of Painting.to_csv. Lines without the alpha column are also accepted '''
     toks = line.split(',')
-    if len(toks) != 9:
+    if len(toks) not in [9, 10]:
         return None
     x = float(toks[0])
     y = float(toks[1])
@@ -314,7 +476,7 @@ def parse_csv_line_continuous(line):
     length = float(toks[3])
     thickness = float(toks[4])
     bend = float(toks[5])
-    color = np.array([float(toks[6]), float(toks[7]), float(toks[8])])
+    color = np.array([float(toks[-3]), float(toks[-2]), float(toks[-1])])
 
 
     return x, y, r, length, thickness, bend, color
@@ -381,7 +543,7 @@ def initialize_painting(opt, n_strokes, target_img, background_img, ink, device=
 def add_strokes_to_painting(opt, painting, rendered_painting, n_strokes, target_img, background_img, ink, device='cuda'):
     attn = (target_img[0] - rendered_painting[0]).abs().mean(dim=0)
     brush_strokes = init_brush_strokes(opt, attn, n_strokes, ink)
-    existing_strokes = [painting.brush_strokes[i] for i in range(len(painting.brush_strokes))]
+    existing_strokes = list(painting.brush_strokes)
     painting = Painting(opt, 0, background_img=background_img, 
         brush_strokes=existing_strokes+brush_strokes).to(device)
     return painting
@@ -4,8 +4,10 @@ import torchvision.transforms as T
 from torchvision.transforms import InterpolationMode 
 bicubic = InterpolationMode.BICUBIC
 import numpy as np
-from brush_stroke import BrushStroke
+from brush_stroke import BrushStroke, StrokeBatch
 from param2stroke import get_param2img
+from stroke_renderer import render_stroke_alphas, render_single_stroke, composite_strokes, \
+        render_stroke_tiles, composite_stroke_tiles, sum_stroke_tiles
 
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
@@ -24,29 +26,24 @@ class Painting(nn.Module):
             self.background_img = torch.cat((self.background_img, t), dim=1)
 
         if brush_strokes is None:
-            self.brush_strokes = nn.ModuleList([BrushStroke(opt) for _ in range(n_strokes)])
+            brush_strokes = [BrushStroke(opt) for _ in range(n_strokes)]
+        if isinstance(brush_strokes, StrokeBatch):
+            self.brush_strokes = brush_strokes
         else:
-            self.brush_strokes = nn.ModuleList(brush_strokes)
+            self.brush_strokes = StrokeBatch(opt, brush_strokes)
         
-        self.param2img = get_param2img(opt)
+        self.param2img = get_param2img(opt, device=device)
+        self.tile_compositing = opt.tile_compositing
+        self.palette_lab = None # Last cluster_colors result, to warm start the next one
 
     def get_optimizers(self, multiplier=1.0, ink=False):
-        xt = []
-        yt = []
-        a = []
-        length = []
-        z = []
-        bend = []
-        color = []
-        
-        for n, p in self.named_parameters():
-            if "xt" in n.split('.')[-1]: xt.append(p)
-            if "yt" in n.split('.')[-1]: yt.append(p)
-            if "a" in n.split('.')[-1]: a.append(p)
-            if "stroke_length" in n.split('.')[-1]: length.append(p)
-            if "stroke_z" in n.split('.')[-1]: z.append(p)
-            if "stroke_bend" in n.split('.')[-1]: bend.append(p)
-            if "color_transform" in n.split('.')[-1]: color.append(p)
+        s = self.brush_strokes
+        xt, yt, a = [s.xt], [s.yt], [s.a]
+        length, z, bend = [s.stroke_length], [s.stroke_z], [s.stroke_bend]
+        color = [s.color_transform]
+        # The rotation optimizer has always also held stroke_alpha and color_transform
+        # (their names contain an "a"), keep it that way so plans optimize the same
+        a = a + [s.stroke_alpha] + (color if s.color_transform.requires_grad else [])
 
         position_opt = torch.optim.RMSprop(xt + yt, lr=5e-3*multiplier)
         rotation_opt = torch.optim.RMSprop(a, lr=1e-2*multiplier)
@@ -66,18 +63,42 @@ class Painting(nn.Module):
         return position_opt, rotation_opt, color_opt, bend_opt, length_opt, thickness_opt
 
 
-    def forward(self, h, w, use_alpha=True, return_alphas=False, opacity_factor=1.0, efficient=False):
-        if self.background_img is None:
-            canvas = torch.ones((1,4,h,w)).to(device)
-        else:
-            canvas = T.Resize((h,w), bicubic, antialias=True)(self.background_img).detach()
-        canvas[:,3] = 1 # alpha channel
+    def forward(self, h, w, use_alpha=True, return_alphas=False, opacity_factor=1.0, efficient=False, batched=True):
+        '''
+        kwargs:
+            batched : render all the strokes in one pass. Otherwise render and blend 
+                them one at a time (same result, much slower)
+        With opt.tile_compositing, the batched pass only renders and blends the tile
+        around each stroke instead of the whole canvas.
+        '''
+        canvas = self.background_canvas(h, w)
+
+        if batched and not efficient and self.tile_compositing and len(self.brush_strokes) > 0:
+            stroke_tiles, origins = self.render_stroke_tiles(h, w)
+            colors = self.brush_strokes.color_transform[self.brush_strokes.order]
+            canvas = composite_stroke_tiles(canvas, stroke_tiles, origins, colors, 
+                                            use_alpha=use_alpha, opacity_factor=opacity_factor)
+            if return_alphas:
+                return canvas, sum_stroke_tiles(stroke_tiles, origins, h, w)
+            return canvas
+
+        if batched and not efficient and len(self.brush_strokes) > 0:
+            stroke_alphas = self.render_stroke_alphas(h, w)
+            colors = self.brush_strokes.color_transform[self.brush_strokes.order]
+            canvas = composite_strokes(canvas, stroke_alphas, colors, 
+                                       use_alpha=use_alpha, opacity_factor=opacity_factor)
+            if return_alphas:
+                return canvas, torch.sum(stroke_alphas, dim=0)
+            return canvas
 
         mostly_opaque = False#True
         if return_alphas: stroke_alphas = []
 
-        for brush_stroke in self.brush_strokes:
-            single_stroke = brush_stroke(h,w, self.param2img)
+        strokes = self.brush_strokes.ordered()
+        for i in range(len(self.brush_strokes)):
+            single_stroke = render_single_stroke(self.param2img, 
+                *[strokes[name][i:i+1] for name in ['stroke_length', 'stroke_bend', 'stroke_z', 'stroke_alpha', 'a', 'xt', 'yt']],
+                strokes['color_transform'][i], h, w)
 
             if mostly_opaque: single_stroke[:,3][single_stroke[:,3] > 0.5] = 1.
             if return_alphas: stroke_alphas.append(single_stroke[:,3:])
@@ -102,69 +123,103 @@ class Painting(nn.Module):
         
         return canvas
 
-    def get_alpha(self, h, w):
-        # return the alpha values of the strokes of the painting
-
-        stroke_alphas = []
-        for brush_stroke in self.brush_strokes:
-            single_stroke = brush_stroke(h,w)
+    def background_canvas(self, h, w):
+        ''' The background at h x w, with an opaque alpha channel. Returns (1,4,h,w) '''
+        if self.background_img is None:
+            canvas = torch.ones((1,4,h,w)).to(device)
+        else:
+            canvas = T.Resize((h,w), bicubic, antialias=True)(self.background_img).detach()
+        canvas[:,3] = 1 # alpha channel
+        return canvas
 
-            stroke_alphas.append(single_stroke[:,3:])
+    def render_stroke_alphas(self, h, w):
+        ''' Alpha maps of all the strokes in painting order, rendered in one batch. Returns (N,1,h,w) '''
+        strokes = self.brush_strokes.ordered()
+        return render_stroke_alphas(self.param2img,
+            strokes['stroke_length'], strokes['stroke_bend'], strokes['stroke_z'], strokes['stroke_alpha'],
+            strokes['a'], strokes['xt'], strokes['yt'],
+            h, w)
+
+    def render_stroke_tiles(self, h, w):
+        ''' Alpha maps of all the strokes in painting order, only within a tile around each stroke.
+        Returns (N,1,T,T) tiles and the (N,2) canvas pixel (y,x) of their top left corners '''
+        strokes = self.brush_strokes.ordered()
+        return render_stroke_tiles(self.param2img,
+            strokes['stroke_length'], strokes['stroke_bend'], strokes['stroke_z'], strokes['stroke_alpha'],
+            strokes['a'], strokes['xt'], strokes['yt'],
+            h, w)
+
+    def stroke_visibility(self, h, w, opacity_factor=1.0, chunk_size=256):
+        ''' How much of each stroke shows in the painting, after the strokes on top of it (no gradients).
+        Rendered chunk_size strokes at a time, from the top stroke down, so memory doesn't grow with the stroke count.
+        returns:
+            torch.Tensor[N] : visible contribution of each stroke in painting order, sum over the pixels of
+                its alpha times the transmittance of the strokes above it (what composite_strokes weights its color by)
+            torch.Tensor[N] : footprint, sum of each stroke's alpha
+        '''
+        n = len(self.brush_strokes)
+        visible = torch.zeros(n, device=device)
+        footprint = torch.zeros(n, device=device)
+        with torch.no_grad():
+            strokes = self.brush_strokes.ordered()
+            transmittance = torch.ones((h, w), device=device) # Through every stroke above the chunk
+            for end in range(n, 0, -chunk_size):
+                start = max(0, end - chunk_size)
+                alphas = render_stroke_alphas(self.param2img,
+                    *[strokes[name][start:end] for name in ['stroke_length', 'stroke_bend', 'stroke_z', 'stroke_alpha', 'a', 'xt', 'yt']],
+                    h, w)[:,0] * opacity_factor
+                # Same scan as composite_strokes, within the chunk
+                within = torch.flip(torch.cumprod(torch.flip(1 - alphas, dims=[0]), dim=0), dims=[0])
+                above = torch.cat([within[1:], torch.ones_like(within[:1])], dim=0) * transmittance[None]
+                visible[start:end] = (alphas * above).sum(dim=(1,2))
+                footprint[start:end] = alphas.sum(dim=(1,2))
+                transmittance = transmittance * within[0]
+        return visible, footprint
 
-        alphas = torch.cat(stroke_alphas, dim=1)
-        alphas, _ = torch.max(alphas, dim=1)#alphas.max(dim=1)
+    def get_alpha(self, h, w):
+        # return the alpha values of the strokes of the painting
+        alphas, _ = torch.max(self.render_stroke_alphas(h, w), dim=0)
         return alphas
 
     def to_csv(self):
         ''' To csv string '''
-        csv = ''
-        for bs in self.brush_strokes:
+        with torch.no_grad():
+            strokes = {k:v.detach().cpu().tolist() for k, v in self.brush_strokes.ordered().items()}
+        lines = []
+        for i in range(len(self.brush_strokes)):
             # Translation in proportions from top left
-            # x = str((bs.transformation.weights[1].detach().cpu().item()+1)/2)
-            # y = str((bs.transformation.weights[2].detach().cpu().item()+1)/2)
-            # r = str(bs.transformation.weights[0].detach().cpu().item())
-            x = str((bs.transformation.xt[0].detach().cpu().item()+1)/2)
-            y = str((bs.transformation.yt[0].detach().cpu().item()+1)/2)
-            r = str(bs.transformation.a[0].detach().cpu().item())
-            length = str(bs.stroke_length.detach().cpu().item())
-            thickness = str(bs.stroke_z.detach().cpu().item())
-            bend = str(bs.stroke_bend.detach().cpu().item())
-            alpha = str(bs.stroke_alpha.detach().cpu().item())
-            color = bs.color_transform.detach().cpu().numpy()
-            csv += ','.join([x,y,r,length,thickness,bend,alpha,str(color[0]),str(color[1]),str(color[2])])
-            csv += '\n'
-        csv = csv[:-1] # remove training newline
-        return csv
+            x = str((strokes['xt'][i]+1)/2)
+            y = str((strokes['yt'][i]+1)/2)
+            r = str(strokes['a'][i])
+            length = str(strokes['stroke_length'][i])
+            thickness = str(strokes['stroke_z'][i])
+            bend = str(strokes['stroke_bend'][i])
+            alpha = str(strokes['stroke_alpha'][i])
+            color = strokes['color_transform'][i]
+            lines.append(','.join([x,y,r,length,thickness,bend,alpha,str(color[0]),str(color[1]),str(color[2])]))
+        return '\n'.join(lines)
 
     def validate(self):
         ''' Make sure all brush strokes have valid parameters '''
-        for s in self.brush_strokes:
-            BrushStroke.make_valid(s)
-
-
-    def cluster_colors(self, n_colors):
-        colors = [b.color_transform[:3].detach().cpu().numpy() for b in self.brush_strokes]
-        colors = np.stack(colors)[None,:,:]
-
-        from sklearn.cluster import KMeans
-        from paint_utils3 import rgb2lab, lab2rgb
-        # Cluster in LAB space
-        colors = rgb2lab(colors)
-        kmeans = KMeans(n_clusters=n_colors, random_state=0)
-        kmeans.fit(colors.reshape((colors.shape[0]*colors.shape[1],3)))
-        colors = [kmeans.cluster_centers_[i] for i in range(len(kmeans.cluster_centers_))]
-
-        colors = np.array(colors)
-
-        # Back to rgb
-        colors = lab2rgb(colors[None,:,:])[0]
-        return torch.from_numpy(colors).to(device)# *255., labels
+        self.brush_strokes.make_valid()
+
+
+    def cluster_colors(self, n_colors, seed=0):
+        ''' K-means of the stroke colors in Lab space, on the strokes' device.
+        Warm started from the last call's centers, so calling it repeatedly during optimization is cheap. '''
+        from paint_utils3 import rgb2lab_torch, lab2rgb_torch, kmeans_torch
+        with torch.no_grad():
+            colors = rgb2lab_torch(self.brush_strokes.color_transform[:,:3].detach())
+            centers, _ = kmeans_torch(colors, n_colors, init=self.palette_lab, seed=seed)
+            self.palette_lab = centers
+            # Back to rgb
+            return lab2rgb_torch(centers).to(device)
     
     def pop(self):
         ''' Remove and return first stroke in the plan '''
         bs = self.brush_strokes[0]
         # Remove the stroke
-        self.brush_strokes = nn.ModuleList([self.brush_strokes[i] for i in range(1,len(self.brush_strokes),1)])
+        self.brush_strokes.keep(torch.arange(1, len(self.brush_strokes)))
         return bs
     
     def __len__(self):
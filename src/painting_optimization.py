@@ -11,20 +11,17 @@ import numpy as np
 import torch
 from tqdm import tqdm
 import os
+import sys
+import time
+import importlib
+import copy
+import torch.nn.functional as F
 
-
-from losses.style_loss import compute_style_loss
-from losses.audio_loss.audio_loss import compute_audio_loss, load_audio_file
-from losses.emotion_loss.emotion_loss import emotion_loss
-from losses.face.face_loss import face_loss, parse_face_data
-from losses.stable_diffusion.stable_diffusion_loss2 import stable_diffusion_loss, encode_text_stable_diffusion
-from losses.speech2emotion.speech2emotion import speech2emotion, speech2text
-
-from losses.dino_loss import dino_loss
-from losses.clip_loss import clip_conv_loss, clip_model, clip_text_loss, clip_fc_loss
-import clip
-
-from paint_utils3 import discretize_colors, format_img, load_img, randomize_brush_stroke_order, sort_brush_strokes_by_color
+from async_writer import get_image_writer
+from clip_registry import get_clip_model
+from convergence import get_convergence_monitor
+from paint_utils3 import discretize_colors, format_img, load_img, prune_hidden_strokes, randomize_brush_stroke_order, \
+        reseed_hidden_strokes, sort_brush_strokes_by_color
 
 # from paint_utils3 import *
 
@@ -46,42 +43,61 @@ def log_progress(painting, opt, log_freq=5, force_log=False, title='plan'):
             #np_painting = painting(h,w, use_alpha=False).detach().cpu().numpy()[0].transpose(1,2,0)
             #opt.writer.add_image('images/{}'.format(title), np.clip(np_painting, a_min=0, a_max=1), local_it)
             p = painting(opt.h_render,opt.w_render, use_alpha=False)
-            p = format_img(p)
-            opt.writer.add_image('images/{}'.format(title), p, local_it)
-            
-            plans.append((p*255.).astype(np.uint8))
+            # Copied to the CPU, encoded and logged in the background
+            plans.append(None)
+            def add_to_plans(img, i=len(plans)-1):
+                plans[i] = (img*255.).astype(np.uint8)
+            get_image_writer(opt.image_writer_workers, opt.image_writer_queue).add_image(opt.writer, 'images/{}'.format(title), p, local_it, callback=add_to_plans)
 
-def parse_objective(objective_type, objective_data, p, weight=1.0, num_augs=30):
-    ''' p is the rendered painting '''
-    global local_it
-    if objective_type == 'text':
-        return clip_text_loss(p, objective_data, num_augs)[0] * weight
-    elif objective_type == 'style':
-        return compute_style_loss(p, objective_data) * weight
-    elif objective_type == 'clip_conv_loss':
-        return clip_conv_loss(p, objective_data) * weight
-    elif objective_type == 'dino':
-        return dino_loss(p, objective_data) * weight
-    elif objective_type == 'l2':
-        return ((p - objective_data)**2).mean() * weight
-    elif objective_type == 'clip_fc_loss':
-        return clip_fc_loss(p, objective_data, num_augs)[0] * weight
-    elif objective_type == 'emotion':
-        return emotion_loss(p, objective_data, num_augs)[0] * weight
-    elif objective_type == 'face':
-        return face_loss(p, objective_data, num_augs) * weight
-    elif objective_type == 'stable_diffusion':
-        # return sd_loss.stable_diffusion_loss(p, objective_data) * weight
-        return stable_diffusion_loss(p, objective_data) * weight
-    elif objective_type == 'speech':
-        return emotion_loss(p, objective_data[0], num_augs)[0] * weight \
-            + clip_text_loss(p, objective_data[1], num_augs)[0] * weight
-    elif objective_type == 'audio':
-        return compute_audio_loss(objective_data, p)[0] * weight
-    else:
-        print('don\'t know what objective')
-        1/0
+##########################################################
+# Objectives
+#
+# Most losses load big models (VGG, CLIP, StyleGAN, DINO, whisper, ...) when they're imported,
+# so a loss's module is only imported once an objective that uses it is asked for.
+# Other objectives can be added with register_objective.
+##########################################################
 
+objectives = {}
+import_times = {} # module name -> seconds it took to import
+
+def load_loss_module(name):
+    ''' Import a loss module, timing it the first time '''
+    if name not in sys.modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        import_times[name] = time.perf_counter() - start
+    return sys.modules[name]
+
+def register_objective(name, loss, load_data=None, modules=()):
+    '''
+    args:
+        name (str) : what goes in --objective
+        loss (function(p, objective_data, num_augs)) : returns the (unweighted) loss of rendering p
+    kwargs:
+        load_data (function(opt, objective_data_str)) : turns --objective_data into what loss() 
+            takes. If None, it's loaded as a target image.
+        modules (list[str]) : loss modules it needs, imported by resolve_objective
+    '''
+    objectives[name] = {'loss':loss, 'load_data':load_data, 'modules':list(modules)}
+
+def resolve_objective(name):
+    ''' Import everything the objective needs '''
+    if name not in objectives:
+        raise Exception('Unknown objective "{}". Options: {}'.format(name, ', '.join(objectives.keys())))
+    for module in objectives[name]['modules']:
+        load_loss_module(module)
+    return objectives[name]
+
+def print_import_times():
+    total = sum(import_times.values())
+    print('Objective imports ({:.2f}s):'.format(total))
+    for name, t in sorted(import_times.items(), key=lambda kv : -kv[1]):
+        print('\t{:>50} {:.2f}s'.format(name, t))
+
+def encode_text_clip(text):
+    import clip
+    clip_model, _ = get_clip_model('ViT-B/32', device)
+    return clip_model.encode_text(clip.tokenize(text).to(device))
 
 def parse_emotion_data(s):
     weights_str = s.split(',')
@@ -93,41 +109,181 @@ def parse_emotion_data(s):
     weights = torch.tensor(weights).float().to(device)
     return weights.unsqueeze(0)
 
+def load_face_data(opt, s):
+    img = load_img(s,h=opt.h_render, w=opt.w_render).to(device)/255.
+    return load_loss_module('losses.face.face_loss').parse_face_data(img)
+
+def load_speech_data(opt, s):
+    speech2emotion = load_loss_module('losses.speech2emotion.speech2emotion')
+    emotion = torch.tensor(speech2emotion.speech2emotion(s)).float().to(device)
+    speech_text = speech2emotion.speech2text(s)
+    return [emotion, encode_text_clip(speech_text)]
+
+clip_loss_module = lambda : load_loss_module('losses.clip_loss')
+emotion_loss_module = lambda : load_loss_module('losses.emotion_loss.emotion_loss')
+
+register_objective('text',
+    lambda p, d, num_augs : clip_loss_module().clip_text_loss(p, d, num_augs)[0],
+    load_data=lambda opt, s : encode_text_clip(s), modules=['losses.clip_loss'])
+register_objective('style',
+    lambda p, d, num_augs : load_loss_module('losses.style_loss').compute_style_loss(p, d),
+    modules=['losses.style_loss'])
+register_objective('clip_conv_loss',
+    lambda p, d, num_augs : clip_loss_module().clip_conv_loss(p, d), modules=['losses.clip_loss'])
+register_objective('dino',
+    lambda p, d, num_augs : load_loss_module('losses.dino_loss').dino_loss(p, d), modules=['losses.dino_loss'])
+register_objective('l2', lambda p, d, num_augs : ((p - d)**2).mean())
+register_objective('clip_fc_loss',
+    lambda p, d, num_augs : clip_loss_module().clip_fc_loss(p, d, num_augs)[0], modules=['losses.clip_loss'])
+register_objective('emotion',
+    lambda p, d, num_augs : emotion_loss_module().emotion_loss(p, d, num_augs)[0],
+    load_data=lambda opt, s : parse_emotion_data(s), modules=['losses.emotion_loss.emotion_loss'])
+register_objective('face',
+    lambda p, d, num_augs : load_loss_module('losses.face.face_loss').face_loss(p, d, num_augs),
+    load_data=load_face_data, modules=['losses.face.face_loss'])
+register_objective('stable_diffusion',
+    lambda p, d, num_augs : load_loss_module('losses.stable_diffusion.stable_diffusion_loss2').stable_diffusion_loss(p, d),
+    load_data=lambda opt, s : load_loss_module('losses.stable_diffusion.stable_diffusion_loss2').encode_text_stable_diffusion(s),
+    modules=['losses.stable_diffusion.stable_diffusion_loss2'])
+register_objective('speech',
+    lambda p, d, num_augs : emotion_loss_module().emotion_loss(p, d[0], num_augs)[0] \
+        + clip_loss_module().clip_text_loss(p, d[1], num_augs)[0],
+    load_data=load_speech_data, 
+    modules=['losses.emotion_loss.emotion_loss', 'losses.clip_loss', 'losses.speech2emotion.speech2emotion'])
+register_objective('audio',
+    lambda p, d, num_augs : load_loss_module('losses.audio_loss.audio_loss').compute_audio_loss(d, p)[0],
+    load_data=lambda opt, s : load_loss_module('losses.audio_loss.audio_loss').load_audio_file(s),
+    modules=['losses.audio_loss.audio_loss'])
+
+def parse_objective(objective_type, objective_data, p, weight=1.0, num_augs=30):
+    ''' p is the rendered painting '''
+    return resolve_objective(objective_type)['loss'](p, objective_data, num_augs) * weight
+
 def load_objectives_data(opt):
     # Load Objective data
     objective_data = [] 
     if not opt.objective:
         print('\n\nNo objectives. Are you sure?\n\n')
     for i in range(len(opt.objective) if opt.objective else 0):
-        if opt.objective[i] == 'text':
-            with torch.no_grad():
-                text_features = clip_model.encode_text(clip.tokenize(opt.objective_data[i]).to(device))
-                objective_data.append(text_features)
-        elif opt.objective[i] == 'audio':
-            with torch.no_grad():
-                objective_data.append(load_audio_file(opt.objective_data[i]))
-        elif opt.objective[i] == 'emotion':
+        objective = resolve_objective(opt.objective[i])
+        if objective['load_data'] is not None:
             with torch.no_grad():
-                objective_data.append(parse_emotion_data(opt.objective_data[i]))
-        elif opt.objective[i] == 'face':
-            with torch.no_grad():
-                img = load_img(opt.objective_data[i],h=opt.h_render, w=opt.w_render).to(device)/255.
-                objective_data.append(parse_face_data(img))
-        elif opt.objective[i] == 'stable_diffusion':
-            with torch.no_grad():
-                objective_data.append(encode_text_stable_diffusion(opt.objective_data[i]))
-        elif opt.objective[i] == 'speech':
-            with torch.no_grad():
-                emotion = torch.tensor(speech2emotion(opt.objective_data[i])).float().to(device)
-                speech_text = speech2text(opt.objective_data[i])
-                text_features = clip_model.encode_text(clip.tokenize(speech_text).to(device))
-                objective_data.append([emotion, text_features])
+                objective_data.append(objective['load_data'](opt, opt.objective_data[i]))
         else:
             # Must be an image
             img = load_img(opt.objective_data[i],h=opt.h_render, w=opt.w_render).to(device)/255.
             objective_data.append(img)
             opt.writer.add_image('target/input{}'.format(i), format_img(img), 0)
     opt.objective_data_loaded = objective_data
+    if len(import_times) > 0:
+        print_import_times()
+
+# Mixed precision (--amp). Stroke parameters stay fp32, only the activations are in low precision
+amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+amp_drift_reports = 0 # How many times amp_drift_report ran. Its TensorBoard step
+
+# Target images resized for the coarse pyramid levels. (id(target), h, w) -> (target, resized)
+resized_targets = {}
+
+def objective_data_at(opt, h, w):
+    ''' opt.objective_data_loaded with the target images resized to h x w '''
+    if (h, w) == (opt.h_render, opt.w_render):
+        return opt.objective_data_loaded
+    data = []
+    for objective, d in zip(opt.objective, opt.objective_data_loaded):
+        if resolve_objective(objective)['load_data'] is None and torch.is_tensor(d) \
+                and d.dim() == 4 and tuple(d.shape[-2:]) == (opt.h_render, opt.w_render):
+            key = (id(d), h, w)
+            if key not in resized_targets or resized_targets[key][0] is not d:
+                resized_targets[key] = (d, F.interpolate(d, (h, w), mode='area'))
+            d = resized_targets[key][1]
+        data.append(d)
+    return data
+
+def pyramid_schedule(opt, optim_iter):
+    ''' Render size (h,w) for each iteration of optimize_painting. Stroke parameters don't depend
+    on the resolution, so the same painting is optimized at every level. '''
+    n_levels = max(1, opt.pyramid_levels)
+    split = opt.pyramid_split if opt.pyramid_split else [1.]*n_levels
+    if len(split) != n_levels:
+        raise Exception('--pyramid_split needs {} fractions, one per level. Got {}'.format(n_levels, len(split)))
+    boundaries = np.cumsum(split) / np.sum(split)
+
+    sizes = []
+    for it in range(optim_iter):
+        level = min(int(np.searchsorted(boundaries, it / optim_iter, side='right')), n_levels-1)
+        scale = 0.5**(n_levels - 1 - level)
+        sizes.append((max(16, int(round(opt.h_render*scale))), max(16, int(round(opt.w_render*scale)))))
+    return sizes
+
+def compute_objective_loss(opt, painting, h=None, w=None):
+    ''' Render the painting (at h x w, default the render size) and sum up the weighted objectives '''
+    h, w = (opt.h_render, opt.w_render) if h is None else (h, w)
+    p, alphas = painting(h, w, use_alpha=False, return_alphas=True)
+    if opt.amp:
+        p = p.contiguous(memory_format=torch.channels_last)
+
+    objective_data = objective_data_at(opt, h, w)
+    loss = 0
+    for k in range(len(opt.objective)):
+        loss += parse_objective(opt.objective[k], 
+            objective_data[k], p[:,:3], 
+            weight=opt.objective_weight[k],
+            num_augs=opt.num_augs)
+    #loss += (1-alphas).mean() * opt.fill_weight
+    if opt.fill_weight > 0:
+        loss += torch.abs(1-alphas).mean() * opt.fill_weight
+    return loss, p
+
+def amp_drift_report(opt, painting, seed=0, loss_scale=2.**16):
+    ''' Compare one forward/backward pass under --amp to the fp32 one, 
+    with the same random augmentations. Prints and logs the differences. '''
+    global amp_drift_reports
+    step = amp_drift_reports
+    amp_drift_reports += 1
+    results = []
+    for use_amp in [False, True]:
+        with torch.random.fork_rng():
+            torch.manual_seed(seed)
+            painting.zero_grad()
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                loss, p = compute_objective_loss(opt, painting)
+            # Scale like the GradScaler would so fp16 gradients don't underflow
+            (loss.float() * loss_scale).backward()
+            grads = {n:param.grad.detach().float() / loss_scale 
+                     for n, param in painting.named_parameters() if param.grad is not None}
+            results.append((loss.float().item(), p.detach().float(), grads))
+    painting.zero_grad()
+
+    (loss32, p32, grads32), (loss_amp, p_amp, grads_amp) = results
+    print('AMP drift vs fp32 (seed {}):'.format(seed))
+    print('\tloss {:.6f} vs {:.6f}, canvas max abs diff {:.2e}'.format(
+        loss_amp, loss32, (p_amp - p32).abs().max().item()))
+    opt.writer.add_scalar('amp_drift/loss_rel_diff', abs(loss_amp - loss32) / (abs(loss32) + 1e-8), step)
+    opt.writer.add_scalar('amp_drift/canvas_max_abs_diff', (p_amp - p32).abs().max().item(), step)
+    for n in grads32.keys():
+        rel = ((grads_amp[n] - grads32[n]).norm() / (grads32[n].norm() + 1e-12)).item()
+        print('\t{} gradient relative error {:.2e}'.format(n, rel))
+        opt.writer.add_scalar('amp_drift/grad_rel_err/{}'.format(n), rel, step)
+
+def get_compiled_step(opt, painting, optims, h=None, w=None):
+    ''' One optimization step with the render + loss compiled (--compile_step).
+    torch.compile captures the forward pass and AOTAutograd its backward pass as two graphs (CUDA graphs
+    on GPU). The optimizer steps and validate run eagerly: loss.backward() inside the compiled function
+    would break the graph, and the optimizers are only fast without host syncs with float learning rates,
+    which torch.compile would recompile for every change of the schedule.
+    Reordering strokes only changes the painting's order index tensor, so it doesn't trigger a retrace.
+    Changing the number of strokes does. '''
+    compiled_loss = torch.compile(lambda : compute_objective_loss(opt, painting, h, w)[0], 
+                                  mode='reduce-overhead' if device.type == 'cuda' else 'default', dynamic=False)
+    def step():
+        loss = compiled_loss()
+        loss.backward()
+        for o in optims: o.step() if o is not None else None
+        painting.validate()
+        # The CUDA graph output is overwritten by the next call
+        return loss.detach().clone()
+    return step
 
 def optimize_painting(opt, painting, optim_iter, color_palette=None,
                       change_color=True, shuffle_strokes=True, log_title='plan'):
@@ -147,7 +303,30 @@ def optimize_painting(opt, painting, optim_iter, color_palette=None,
     # Learning rate scheduling. Start low, middle high, end low
     og_lrs = [o.param_groups[0]['lr'] if o is not None else None for o in optims]
 
+    render_sizes = pyramid_schedule(opt, optim_iter)
+
+    compiled_steps = None
+    if opt.compile_step:
+        if opt.amp:
+            raise Exception('--compile_step does not support --amp')
+        # One per pyramid level
+        compiled_steps = {size:get_compiled_step(opt, painting, optims, *size) for size in set(render_sizes)}
+
+    if opt.amp and amp_drift_reports == 0:
+        # Once per process, it costs two extra forward/backward passes
+        amp_drift_report(opt, painting)
+    scaler = torch.cuda.amp.GradScaler(enabled=opt.amp and device.type == 'cuda')
+    # Some parameters are in two optimizers, so unscale the gradients once through one that holds them all
+    grad_unscaler = torch.optim.SGD(list(painting.parameters()), lr=0.0)
+
+    # Only check for convergence once it's optimizing at the full resolution
+    full_res_start = render_sizes.index((opt.h_render, opt.w_render)) if (opt.h_render, opt.w_render) in render_sizes else 0
+    monitor = get_convergence_monitor(opt, painting, optim_iter, 
+            min_iter=max(opt.early_stop_min_iter, full_res_start / max(optim_iter, 1)))
+    n_reseeded = 0
+
     for it in tqdm(range(optim_iter), desc='Optimizing {} Strokes'.format(str(len(painting.brush_strokes)))):
+        if monitor.skip(it): continue
         for o in optims: o.zero_grad() if o is not None else None
 
         lr_factor = (1 - 2*np.abs(it/optim_iter - 0.5)) + 0.005
@@ -155,22 +334,25 @@ def optimize_painting(opt, painting, optim_iter, color_palette=None,
             if optims[i_o] is not None:
                 optims[i_o].param_groups[0]['lr'] = og_lrs[i_o]*lr_factor
 
-        p, alphas = painting(opt.h_render, opt.w_render, use_alpha=False, return_alphas=True)
-        
-        loss = 0
-        for k in range(len(opt.objective)):
-            loss += parse_objective(opt.objective[k], 
-                opt.objective_data_loaded[k], p[:,:3], 
-                weight=opt.objective_weight[k],
-                num_augs=opt.num_augs)
-        #loss += (1-alphas).mean() * opt.fill_weight
-        if opt.fill_weight > 0:
-            loss += torch.abs(1-alphas).mean() * opt.fill_weight
-        loss.backward()
+        if compiled_steps is not None:
+            loss = compiled_steps[render_sizes[it]]()
+        else:
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=opt.amp):
+                loss, p = compute_objective_loss(opt, painting, *render_sizes[it])
+            scaler.scale(loss).backward()
 
-        for o in optims: o.step() if o is not None else None
+            take_step = True
+            if scaler.is_enabled():
+                scaler.unscale_(grad_unscaler)
+                grads = [param.grad for param in painting.parameters() if param.grad is not None]
+                # Skip the step on inf/nan gradients, the scale gets lowered for the next iteration
+                take_step = bool(torch.stack([torch.isfinite(g).all() for g in grads]).all())
+                scaler.update()
+            if take_step:
+                for o in optims: o.step() if o is not None else None
 
-        painting.validate()
+            painting.validate()
+        monitor.update(loss, it)
 
         if not opt.ink and shuffle_strokes:
             painting = sort_brush_strokes_by_color(painting, bin_size=opt.bin_size)
@@ -179,6 +361,11 @@ def optimize_painting(opt, painting, optim_iter, color_palette=None,
             # make sure hidden strokes get some attention
             painting = randomize_brush_stroke_order(painting)
 
+        if opt.occlusion_reseed_every > 0 and it > 0 and it % opt.occlusion_reseed_every == 0 \
+                and it < 0.5*optim_iter:
+            # Give strokes that are covered up something else to do
+            n_reseeded += reseed_hidden_strokes(painting, *render_sizes[it], threshold=opt.occlusion_threshold)
+
         if (it % 10 == 0 and it > (0.5*optim_iter)) or it > 0.9*optim_iter:
             if opt.use_colors_from is None:
                 # Cluster the colors from the existing painting
@@ -188,7 +375,7 @@ def optimize_painting(opt, painting, optim_iter, color_palette=None,
             if not opt.ink:
                 discretize_colors(painting, color_palette)
         log_progress(painting, opt, log_freq=opt.log_frequency, title=log_title)#, force_log=True)
-
+    monitor.log(opt.writer, log_title)
 
     if not use_input_palette and not opt.ink:
         color_palette = painting.cluster_colors(opt.n_colors)
@@ -199,6 +386,67 @@ def optimize_painting(opt, painting, optim_iter, color_palette=None,
         discretize_colors(painting, color_palette)
         if shuffle_strokes:
             painting = sort_brush_strokes_by_color(painting, bin_size=opt.bin_size)
+
+    if n_reseeded > 0:
+        print('Moved {} hidden strokes'.format(n_reseeded))
+    if opt.occlusion_prune:
+        n_strokes = len(painting)
+        painting = prune_hidden_strokes(painting, opt.h_render, opt.w_render, threshold=opt.occlusion_threshold)
+        print('Removed {} hidden strokes'.format(n_strokes - len(painting)))
     log_progress(painting, opt, force_log=True, log_freq=opt.log_frequency, title=log_title)
 
     return painting, color_palette
+
+def pyramid_report(opt, painting, optim_iter, color_palette=None, seed=0, schedules=None):
+    '''
+    Wall-clock time and final full resolution loss of optimize_painting with each pyramid schedule,
+    starting from copies of the same painting.
+    kwargs:
+        schedules (list[(levels, split)]) : default is the single resolution baseline and 
+            --pyramid_levels/--pyramid_split
+    returns:
+        list[dict]
+    '''
+    if schedules is None:
+        schedules = [(1, None), (opt.pyramid_levels, opt.pyramid_split)]
+    og_schedule = (opt.pyramid_levels, opt.pyramid_split)
+
+    results = []
+    for levels, split in schedules:
+        opt.pyramid_levels, opt.pyramid_split = levels, split
+        with torch.random.fork_rng():
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            start = time.perf_counter()
+            p, _ = optimize_painting(opt, copy.deepcopy(painting), optim_iter, 
+                    color_palette=None if color_palette is None else color_palette.clone(), log_title='pyramid_report')
+            if device.type == 'cuda': torch.cuda.synchronize()
+            seconds = time.perf_counter() - start
+
+            torch.manual_seed(seed)
+            with torch.no_grad():
+                loss, _ = compute_objective_loss(opt, p)
+        results.append({'levels':levels, 'split':split, 'seconds':seconds, 'loss':loss.item()})
+    opt.pyramid_levels, opt.pyramid_split = og_schedule
+
+    print('Pyramid schedules ({} iterations):'.format(optim_iter))
+    for r in results:
+        print('\tlevels {} split {}: {:.2f}s, final loss {:.5f}'.format(r['levels'], r['split'], r['seconds'], r['loss']))
+        opt.writer.add_scalar('pyramid_report/seconds', r['seconds'], r['levels'])
+        opt.writer.add_scalar('pyramid_report/loss', r['loss'], r['levels'])
+    return results
+
+
+if __name__ == '__main__':
+    # Startup timing report: python painting_optimization.py [objective ...]
+    import argparse
+    parser = argparse.ArgumentParser(description='Time how long each objective takes to import')
+    parser.add_argument('objectives', nargs='*', default=list(objectives.keys()))
+    args = parser.parse_args()
+
+    for name in args.objectives:
+        start = time.perf_counter()
+        resolve_objective(name)
+        print('{:>20} {:.2f}s'.format(name, time.perf_counter() - start))
+    print_import_times()
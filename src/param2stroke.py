@@ -12,6 +12,8 @@ from tqdm import tqdm
 import os
 import copy
 import gzip
+import hashlib
+import itertools
 from torchvision.transforms.functional import affine
 
 def get_param2img(opt, device='cuda'):
@@ -39,11 +41,10 @@ def get_param2img(opt, device='cuda'):
     param2img.eval()
     param2img.to(device)
 
-    def forward(param, h_render_pix, w_render_pix):
+    def geometry(h_render_pix, w_render_pix):
         # Figure out what to resize the output of param2image should be based on the desired render size
         w_p2i_render_pix = int((w_p2i_m / w_canvas_m) * w_render_pix)
         h_p2i_render_pix = int((h_p2i_m / h_canvas_m) * h_render_pix)
-        res_to_render = transforms.Resize((h_p2i_render_pix, w_p2i_render_pix), bicubic, antialias=True)
 
         # Pad the output of param2image such that the start of the stroke is directly in the
         # middle of the canvas and the dimensions of the image match the render size
@@ -57,12 +58,115 @@ def get_param2img(opt, device='cuda'):
         pad_top_pix =    int(pad_top_m    * (h_render_pix / h_canvas_m))
         pad_bottom_pix = int(pad_bottom_m * (h_render_pix / h_canvas_m))
 
-        pad_for_full = transforms.Pad((pad_left_pix, pad_top_pix, pad_right_pix, pad_bottom_pix))
+        return {
+            'h_p2i':h_p2i_render_pix, 'w_p2i':w_p2i_render_pix,
+            'pad_left':pad_left_pix, 'pad_right':pad_right_pix, 
+            'pad_top':pad_top_pix, 'pad_bottom':pad_bottom_pix,
+            # Size after padding. Can be off from the render size by a pixel or two
+            'h_full':pad_top_pix + h_p2i_render_pix + pad_bottom_pix,
+            'w_full':pad_left_pix + w_p2i_render_pix + pad_right_pix,
+            # Proportion of the param2image width that a stroke of length L covers is (L + 2*xtra_room_horz_m)/w_p2i_m
+            'w_p2i_m':w_p2i_m, 'xtra_room_horz_m':xtra_room_horz_m,
+        }
+
+    def run_param2img(param, h_render_pix, w_render_pix):
+        g = geometry(h_render_pix, w_render_pix)
+        res_to_render = transforms.Resize((g['h_p2i'], g['w_p2i']), bicubic, antialias=True)
+        return res_to_render(param2img(param))
+
+    # Stroke atlases, one per render size. See get_param2img_atlas
+    atlases = {}
+    atlas_ranges = [(opt.MIN_STROKE_LENGTH, opt.MAX_STROKE_LENGTH), (-1*opt.MAX_BEND, opt.MAX_BEND),
+                    (opt.MIN_STROKE_Z, 1.0), (-1*opt.MAX_ALPHA, opt.MAX_ALPHA)]
+
+    def unpadded(param, h_render_pix, w_render_pix):
+        # Just the stroke images at render resolution, without the padding to the full canvas. 
+        # Use geometry() for where they sit in the padded image.
+        if not opt.param2img_atlas:
+            return run_param2img(param, h_render_pix, w_render_pix)
+        if (h_render_pix, w_render_pix) not in atlases:
+            atlases[(h_render_pix, w_render_pix)] = get_param2img_atlas(opt, 
+                lambda p : run_param2img(p, h_render_pix, w_render_pix),
+                atlas_ranges, h_render_pix, w_render_pix, device=device)
+        return interpolate_atlas(atlases[(h_render_pix, w_render_pix)], atlas_ranges, param)
+
+    def forward(param, h_render_pix, w_render_pix):
+        g = geometry(h_render_pix, w_render_pix)
+        pad_for_full = transforms.Pad((g['pad_left'], g['pad_top'], g['pad_right'], g['pad_bottom']))
 
-        return pad_for_full(res_to_render(param2img(param)))
+        return pad_for_full(unpadded(param, h_render_pix, w_render_pix))
+    forward.geometry = geometry
+    forward.unpadded = unpadded
     return forward#param2img#param2imgs, resize
 
 
+def get_param2img_atlas(opt, run_param2img, ranges, h_render_pix, w_render_pix, device='cuda'):
+    '''
+    Sample param2img once on a regular grid over (length, bend, z, alpha) at a given render size.
+    Cached in opt.cache_dir, keyed by the hash of param2img.pt, the render size and the grid.
+    args:
+        run_param2img : function (N,4) params -> (N,h,w) unpadded stroke images
+        ranges : list of (min,max) for each of the 4 parameters
+    returns:
+        torch.Tensor[G_length, G_bend, G_z, G_alpha, h, w]
+    '''
+    # No need for more than one sample in a dimension that can't vary (e.g., MAX_ALPHA=0)
+    grid_size = [g if hi > lo else 1 for g, (lo, hi) in zip(opt.param2img_atlas_grid, ranges)]
+
+    with open(os.path.join(opt.cache_dir, 'param2img.pt'), 'rb') as f:
+        model_hash = hashlib.md5(f.read()).hexdigest()
+    key = hashlib.md5(json.dumps([model_hash, h_render_pix, w_render_pix, grid_size, ranges]).encode()).hexdigest()
+    fn = os.path.join(opt.cache_dir, 'param2img_atlas_{}.pt'.format(key[:16]))
+    if os.path.exists(fn):
+        return torch.load(fn, map_location=device)
+
+    axes = [torch.linspace(lo, hi, g) if g > 1 else torch.tensor([lo]) for g, (lo, hi) in zip(grid_size, ranges)]
+    params = torch.cartesian_prod(*axes).view(-1, 4).to(device)
+    atlas = []
+    with torch.no_grad():
+        for i in tqdm(range(0, len(params), 512), desc='Building param2img atlas'):
+            atlas.append(run_param2img(params[i:i+512]))
+    atlas = torch.cat(atlas, dim=0)
+    atlas = atlas.view(*grid_size, atlas.shape[1], atlas.shape[2]).contiguous()
+    torch.save(atlas.cpu(), fn)
+    return atlas
+
+def interpolate_atlas(atlas, ranges, param):
+    '''
+    Multilinear interpolation of the stroke atlas. Differentiable w.r.t. the parameters.
+    Parameters outside of the atlas ranges are clamped.
+    args:
+        atlas (torch.Tensor[G_length, G_bend, G_z, G_alpha, h, w]) : from get_param2img_atlas
+        param (torch.Tensor[N,4])
+    returns:
+        torch.Tensor[N,h,w]
+    '''
+    grid_size = atlas.shape[:4]
+    flat_atlas = atlas.view(-1, atlas.shape[4], atlas.shape[5])
+    strides = [grid_size[1]*grid_size[2]*grid_size[3], grid_size[2]*grid_size[3], grid_size[3], 1]
+
+    lower, frac = [], []
+    for d in range(4):
+        lo, hi = ranges[d]
+        if grid_size[d] == 1:
+            lower.append(torch.zeros(len(param), dtype=torch.long, device=param.device))
+            frac.append(torch.zeros(len(param), dtype=param.dtype, device=param.device))
+            continue
+        t = ((param[:,d] - lo) / (hi - lo)).clamp(0, 1) * (grid_size[d] - 1)
+        i = torch.floor(t.detach()).long().clamp(max=grid_size[d] - 2)
+        lower.append(i)
+        frac.append(t - i)
+
+    out = 0
+    for corner in itertools.product([0, 1], repeat=4):
+        if any([c == 1 and grid_size[d] == 1 for d, c in enumerate(corner)]):
+            continue
+        ind = sum([(lower[d] + c) * strides[d] for d, c in enumerate(corner)])
+        weight = 1
+        for d, c in enumerate(corner):
+            weight = weight * (frac[d] if c == 1 else 1 - frac[d])
+        out = out + weight[:,None,None] * flat_atlas[ind]
+    return out
 
 def special_sigmoid(x):
     return 1/(1+torch.exp(-1.*((x*2-1)+0.2) / 0.05))
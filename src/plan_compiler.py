@@ -0,0 +1,176 @@
+'''
+Compile a Painting into a flat trajectory program for the robot, and run it.
+
+A program is a list of instructions, plain dicts that can be saved as json:
+    {'op':'clean'}                                      painter.clean_paint_brush()
+    {'op':'get_paint', 'color':int}                     painter.get_paint(color)
+    {'op':'move', 'position':[x,y,z], 'speed':float}    approach and lift, see brush_stroke.stroke_program
+    {'op':'stroke', 'positions':[[x,y,z],...]}          one painter.move_to_trajectories
+Every coordinate is computed up front (canvas to global coordinates, H_coord, the Bezier curves), so
+running it is only sending moves to the robot. execute_plan compiles the next chunk of strokes in a
+thread while the robot paints the current one.
+
+The cleaning and paint decisions are the same as the loops in paint.py used to make, and carry over
+between calls in a state dict:
+    state = new_execution_state()
+    program, state = compile_plan(opt, painter, painting, color_palette, state=state)
+    print(program_stats(opt, program))   # dry run
+'''
+
+import copy
+import json
+import queue
+import threading
+import numpy as np
+import torch
+
+from brush_stroke import StrokeBatch, run_stroke_program, stroke_program, stroke_trajectories
+from paint_utils3 import canvas_to_global_coordinates, nearest_color_inds
+
+
+def new_execution_state():
+    ''' Brush state before painting anything '''
+    return {'curr_color':-1, 'consecutive_paints':0, 'consecutive_strokes_no_clean':0}
+
+def stroke_arrays(painting, color_palette=None, ink=False):
+    ''' The strokes' parameters (and palette indices) in painting order, copied to the CPU at once
+    returns:
+        dict of attribute name -> np.array[N] (np.array[N,3] for color_transform), and color_ind
+    '''
+    with torch.no_grad():
+        strokes = painting.brush_strokes.ordered()
+        arrays = {name:strokes[name].detach().cpu().numpy() for name in StrokeBatch.attributes}
+        if ink or color_palette is None:
+            arrays['color_ind'] = np.zeros(len(painting.brush_strokes), dtype=np.int64)
+        else:
+            colors = strokes['color_transform'].detach()
+            arrays['color_ind'] = nearest_color_inds(colors, color_palette.to(colors.device)).cpu().numpy()
+    return arrays
+
+def compile_strokes(opt, painter, strokes, state=None):
+    '''
+    Program that paints the strokes, and the brush state after it
+    args:
+        strokes : from stroke_arrays, or a slice of it
+    returns:
+        (list, dict) : the program and the new state
+    '''
+    state = new_execution_state() if state is None else copy.deepcopy(state)
+
+    # Convert the canvas proportion coordinates to meters from robot
+    x = np.clip(strokes['xt']*0.5+0.5, 0., 1.)
+    y = np.clip(1 - (strokes['yt']*0.5+0.5), 0., 1.) #safety
+    x_glob, y_glob, _ = canvas_to_global_coordinates(x, y, None, opt)
+    traj = stroke_trajectories(painter, x_glob, y_glob, strokes['a'], strokes['stroke_length'],
+                               strokes['stroke_bend'], strokes['stroke_z'], strokes['stroke_alpha'])
+
+    program = []
+    for i in range(len(x)):
+        # Clean paint brush and/or get more paint
+        if not opt.ink:
+            color_ind = int(strokes['color_ind'][i])
+            new_paint_color = color_ind != state['curr_color']
+            if new_paint_color or state['consecutive_strokes_no_clean'] > 12:
+                program += [{'op':'clean'}, {'op':'clean'}]
+                state['consecutive_strokes_no_clean'] = 0
+                state['curr_color'] = color_ind
+                new_paint_color = True
+            if state['consecutive_paints'] >= opt.how_often_to_get_paint or new_paint_color:
+                program.append({'op':'get_paint', 'color':color_ind})
+                state['consecutive_paints'] = 0
+        program += stroke_program(painter, traj, i)
+    return program, state
+
+def compile_plan(opt, painter, painting, color_palette=None, state=None):
+    ''' Program for the whole painting. Returns the program and the brush state after it '''
+    return compile_strokes(opt, painter, stroke_arrays(painting, color_palette, ink=opt.ink), state)
+
+def run_program(painter, program):
+    ''' Send the program to the robot '''
+    for instruction in program:
+        if instruction['op'] == 'clean':
+            painter.clean_paint_brush()
+        elif instruction['op'] == 'get_paint':
+            painter.get_paint(instruction['color'])
+        else:
+            run_stroke_program(painter, [instruction])
+
+def execute_plan(opt, painter, painting, n_strokes=None, color_palette=None, state=None, chunk_size=8):
+    '''
+    Paint the first n_strokes of the plan and remove them from it. The next chunk_size strokes are
+    compiled in a thread while the robot paints the current ones.
+    returns:
+        dict : the brush state afterwards
+    '''
+    n_strokes = len(painting) if n_strokes is None else min(n_strokes, len(painting))
+    strokes = stroke_arrays(painting, color_palette, ink=opt.ink)
+    painting.brush_strokes.keep(torch.arange(n_strokes, len(painting)))
+
+    chunks = queue.Queue(maxsize=2)
+    final_state = [state]
+    def produce():
+        try:
+            s = state
+            for start in range(0, n_strokes, chunk_size):
+                chunk = {k:v[start:min(start+chunk_size, n_strokes)] for k, v in strokes.items()}
+                program, s = compile_strokes(opt, painter, chunk, s)
+                chunks.put(program)
+            final_state[0] = s
+        except Exception as e:
+            chunks.put(e)
+            return
+        chunks.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    for program in iter(chunks.get, None):
+        if isinstance(program, Exception):
+            raise program
+        run_program(painter, program)
+    producer.join()
+    return final_state[0] if final_state[0] is not None else new_execution_state()
+
+def program_stats(opt, program, start_position=None):
+    '''
+    Dry run. Path length of the moves and strokes and an estimate of how long the program takes,
+    from the --exec_* options. Cleaning and getting paint are counted by time only.
+    returns:
+        dict
+    '''
+    stats = {'strokes':0, 'cleans':0, 'get_paints':0, 'travel_m':0., 'stroke_m':0., 'seconds':0.}
+    position = None if start_position is None else np.asarray(start_position, dtype=np.float64)
+    for instruction in program:
+        if instruction['op'] == 'clean':
+            stats['cleans'] += 1
+            stats['seconds'] += opt.exec_clean_time
+        elif instruction['op'] == 'get_paint':
+            stats['get_paints'] += 1
+            stats['seconds'] += opt.exec_get_paint_time
+        elif instruction['op'] == 'move':
+            p = np.asarray(instruction['position'], dtype=np.float64)
+            if position is not None:
+                d = float(np.linalg.norm(p - position))
+                stats['travel_m'] += d
+                stats['seconds'] += d / opt.exec_travel_speed
+            position = p
+        elif instruction['op'] == 'stroke':
+            p = np.asarray(instruction['positions'], dtype=np.float64)
+            d = float(np.linalg.norm(np.diff(p, axis=0), axis=1).sum())
+            if position is not None:
+                travel = float(np.linalg.norm(p[0] - position))
+                stats['travel_m'] += travel
+                stats['seconds'] += travel / opt.exec_travel_speed
+            stats['strokes'] += 1
+            stats['stroke_m'] += d
+            stats['seconds'] += opt.exec_stroke_time + d / opt.exec_paint_speed
+            position = p[-1]
+    stats['path_m'] = stats['travel_m'] + stats['stroke_m']
+    return stats
+
+def save_program(program, fn):
+    with open(fn, 'w') as f:
+        json.dump(program, f)
+
+def load_program(fn):
+    with open(fn, 'r') as f:
+        return json.load(f)
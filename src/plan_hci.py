@@ -34,6 +34,9 @@ from clip_attn.clip_attn import get_attention
 import kornia as K
 
 from paint_utils3 import *
+from async_writer import get_image_writer
+from convergence import get_convergence_monitor
+from multi_start import optimize_multi_start
 from torchvision.utils import save_image
 
 
@@ -44,6 +47,7 @@ if not torch.cuda.is_available():
 # Utilities
 
 writer = None
+top_k_plans = [] # Best --multi_start_top_k intermediate paintings of the last plan()
 local_it = 0 
 plans = []
 
@@ -55,10 +59,11 @@ def log_progress(painting, log_freq=5, force_log=False, title='plan'):
             #np_painting = painting(h,w, use_alpha=False).detach().cpu().numpy()[0].transpose(1,2,0)
             #opt.writer.add_image('images/{}'.format(title), np.clip(np_painting, a_min=0, a_max=1), local_it)
             p = painting(h,w, use_alpha=False)
-            p = format_img(p)
-            opt.writer.add_image('images/{}'.format(title), p, local_it)
-            
-            plans.append((p*255.).astype(np.uint8))
+            # Copied to the CPU, encoded and logged in the background
+            plans.append(None)
+            def add_to_plans(img, i=len(plans)-1):
+                plans[i] = (img*255.).astype(np.uint8)
+            get_image_writer(opt.image_writer_workers, opt.image_writer_queue).add_image(opt.writer, 'images/{}'.format(title), p, local_it, callback=add_to_plans)
 
 def parse_objective(objective_type, objective_data, p, weight=1.0):
     ''' p is the rendered painting '''
@@ -109,10 +114,7 @@ def parse_objective(objective_type, objective_data, p, weight=1.0):
 
 def plan_from_image(opt):
     global colors
-    painting = random_init_painting(current_canvas, opt.num_strokes, ink=opt.ink)
-
     target_img = objective_data[0]
-    painting = initialize_painting(opt.num_strokes, target_img, current_canvas, opt.ink)
     
     attn = get_attention(target_img)
     opt.writer.add_image('target/attention', format_img(torch.from_numpy(attn)[None,None,:,:]), 0)
@@ -122,14 +124,13 @@ def plan_from_image(opt):
     stroke_batch_size = 100#64
     iters_per_batch =  300
 
-    painting = initialize_painting(0, target_img, current_canvas, opt.ink)
-    painting.to(device)
+    painting = initialize_painting(opt, 0, target_img, current_canvas, opt.ink, device=device)
 
     c = 0
     total_its = (opt.num_strokes/stroke_batch_size)*iters_per_batch
     for i in (range(0, opt.num_strokes, stroke_batch_size)):#, desc="Initializing"):
-        painting = add_strokes_to_painting(painting, painting(h,w)[:,:3], stroke_batch_size, 
-                                           target_img, current_canvas, opt.ink)
+        painting = add_strokes_to_painting(opt, painting, painting(h,w)[:,:3], stroke_batch_size, 
+                                           target_img, current_canvas, opt.ink, device=device)
         optims = painting.get_optimizers(multiplier=opt.lr_multiplier, ink=opt.ink)
 
         # Learning rate scheduling. Start low, middle high, end low
@@ -193,7 +194,7 @@ def plan_from_image(opt):
     return painting
 
 def plan(opt, current_canvas, colors, h, w):
-    painting = random_init_painting(current_canvas, opt.num_strokes, ink=opt.ink)
+    painting = random_init_painting(opt, current_canvas, opt.num_strokes, ink=opt.ink, device=device)
     # painting = Painting(opt.num_strokes, background_img=current_canvas)
 
     # Do initilization objective(s)
@@ -222,47 +223,37 @@ def plan(opt, current_canvas, colors, h, w):
             
 
     # Intermediate optimization. Do it a few times, and pick the best
-    init_painting = copy.deepcopy(painting.cpu())
-    best_init_painting, best_init_loss = init_painting, 999999999
-    painting.to(device)
-    for attempt in range(opt.n_inits):
-        painting = copy.deepcopy(init_painting).to(device)
-        # optim = torch.optim.RMSprop(painting.parameters(), lr=5e-3) # Coarse optimization
-        optims = painting.get_optimizers(multiplier=opt.lr_multiplier, ink=opt.ink)
-        for j in tqdm(range(opt.intermediate_optim_iter), desc="Intermediate Optimization"):
-            #optim.zero_grad()
-            for o in optims: o.zero_grad() if o is not None else None
-            p, alphas = painting(h, w, use_alpha=True, return_alphas=True)
+    if opt.n_inits > 0:
+        def intermediate_loss(p, alphas):
+            p, alphas = p.to(device), alphas.to(device)
             loss = 0
             for k in range(len(opt.objective)):
                 loss += parse_objective(opt.objective[k], 
                     objective_data[k], p[:,:3], weight=opt.objective_weight[k])
-
             loss += (1-alphas).mean() * opt.fill_weight
-
-            loss.backward()
-            # optim.step()
-            for o in optims: o.step() if o is not None else None
-            painting.validate()
-            for o in optims: o.param_groups[0]['lr'] = o.param_groups[0]['lr'] * 0.95 if o is not None else None
+            return loss
+        def after_step(painting):
             if not opt.ink:
                 painting = sort_brush_strokes_by_color(painting, bin_size=opt.bin_size)
-            # make sure hidden strokes get some attention
-            # painting = randomize_brush_stroke_order(painting)
-            # log_progress(painting, title='int_optimization_{}'.format(attempt), log_freq=opt.log_frequency)#, force_log=True)
-            
-        if loss.item() < best_init_loss:
-            best_init_loss = loss.item()
-            best_init_painting = copy.deepcopy(painting.cpu())
-            painting.to(device)
-            print('best_painting {}'.format(attempt))
-    painting = best_init_painting.to(device)
+            return painting
+        # All the attempts start from the initialization and are optimized at the same time
+        inits = [copy.deepcopy(painting) for attempt in range(opt.n_inits)]
+        best = optimize_multi_start(inits, intermediate_loss, opt.intermediate_optim_iter, h, w,
+                lr_multiplier=opt.lr_multiplier, ink=opt.ink, after_step=after_step,
+                devices=opt.multi_start_devices, opt=opt, top_k=max(1, opt.multi_start_top_k),
+                desc="Intermediate Optimization")
+        painting = best[0][1]
+        print('best_painting loss {:.5f}'.format(best[0][0]))
+        global top_k_plans
+        top_k_plans = [painting for loss, painting in best]
 
     # Create the plan
     position_opt, rotation_opt, color_opt, bend_opt, length_opt, thickness_opt \
                 = painting.get_optimizers(multiplier=opt.lr_multiplier, ink=opt.ink)
     optims = (position_opt, rotation_opt, color_opt, bend_opt, length_opt, thickness_opt)
+    monitor = get_convergence_monitor(opt, painting, opt.optim_iter)
     for i in tqdm(range(opt.optim_iter), desc='Optimizing {} Strokes'.format(str(len(painting.brush_strokes)))):
+        if monitor.skip(i): continue
         for o in optims: o.zero_grad() if o is not None else None
 
         p, alphas = painting(h, w, use_alpha=False, return_alphas=True)
@@ -281,6 +272,7 @@ def plan(opt, current_canvas, colors, h, w):
         length_opt.step()
         thickness_opt.step()
         if i < .8*opt.optim_iter: color_opt.step() if color_opt is not None else None
+        monitor.update(loss, i)
 
         # position_opt.param_groups[0]['lr'] = position_opt.param_groups[0]['lr'] * 0.99
         # rotation_opt.param_groups[0]['lr'] = rotation_opt.param_groups[0]['lr'] * 0.99
@@ -314,7 +306,7 @@ def plan(opt, current_canvas, colors, h, w):
         #     if not os.path.exists(opt.output_dir):
         #         os.makedirs(opt.output_dir)
         #     save_image(p, os.path.join(opt.output_dir, 'painting_{}.png'.format(i)))
-
+    monitor.log(opt.writer, 'plan')
 
 
     if opt.use_colors_from is None:
@@ -339,17 +331,17 @@ def adapt(plan_f, opt, current_canvas, colors, h, w):
 
     # Load past plan
     with open(plan_f, 'r') as fp:
-        instructions = [parse_csv_line_continuous_v2(line) for line in fp.readlines()] 
+        instructions = [parse_csv_line_continuous(line) for line in fp.readlines()] 
     brush_strokes = []
     for instruction in instructions[int(opt.remove_prop*opt.strokes_before_adapting):]:
-        x, y, r, length, thickness, bend, _, color = instruction
-        brush_strokes.append(BrushStroke( 
-            a=r, xt=x*2-1, yt=y*2-1, color=torch.from_numpy(color).float(),
+        x, y, r, length, thickness, bend, color = instruction
+        brush_strokes.append(BrushStroke(opt, 
+            a=r, xt=x*2-1, yt=y*2-1, color=torch.from_numpy(color).float(), device=device,
             stroke_length=torch.ones(1)*length,
             stroke_z=torch.ones(1)*thickness,
             stroke_bend=torch.ones(1)*bend))
 
-    painting = Painting(0, background_img=current_canvas, brush_strokes=brush_strokes).to(device)
+    painting = Painting(opt, 0, background_img=current_canvas, brush_strokes=brush_strokes).to(device)
     
     # with torch.no_grad():
         # p = painting(h,w, use_alpha=False)
@@ -361,7 +353,9 @@ def adapt(plan_f, opt, current_canvas, colors, h, w):
     position_opt, rotation_opt, color_opt, bend_opt, length_opt, thickness_opt \
             = painting.get_optimizers(multiplier=opt.lr_multiplier*.25, ink=opt.ink)
     # print(opt.objective)
+    monitor = get_convergence_monitor(opt, painting, opt.adapt_optim_iter)
     for j in tqdm(range(opt.adapt_optim_iter), desc='Optimizing {} Strokes'.format(str(len(painting.brush_strokes)))):
+        if monitor.skip(j): continue
         position_opt.zero_grad()
         rotation_opt.zero_grad()
         if not opt.ink:
@@ -383,6 +377,7 @@ def adapt(plan_f, opt, current_canvas, colors, h, w):
         bend_opt.step()
         length_opt.step()
         thickness_opt.step()
+        monitor.update(loss, j)
 
         position_opt.param_groups[0]['lr'] = position_opt.param_groups[0]['lr'] * 0.99
         rotation_opt.param_groups[0]['lr'] = rotation_opt.param_groups[0]['lr'] * 0.99
@@ -401,7 +396,7 @@ def adapt(plan_f, opt, current_canvas, colors, h, w):
 
         # if j%5 == 0 or j == opt.adapt_optim_iter-1:
             # opt.writer.add_image('images/plan_update{}'.format(opt.global_it), format_img(p), j+1)
-
+    monitor.log(opt.writer, 'adapt')
     if not opt.ink:
         painting = sort_brush_strokes_by_color(painting, bin_size=opt.bin_size)
         discretize_colors(painting, colors)
@@ -522,11 +517,12 @@ if __name__ == '__main__':
 
     # Start Planning
     if opt.generate_whole_plan or not opt.adaptive:
-        painting = plan_from_image(opt) if opt.paint_from_image else plan(opt)
+        painting = plan_from_image(opt) if opt.paint_from_image else plan(opt, current_canvas, colors, h, w)
     else:
-        painting = adapt(opt)
+        painting = adapt(os.path.join(opt.cache_dir, "next_brush_strokes.csv"), opt, current_canvas, colors, h, w)
 
-    to_video(plans, fn=os.path.join(opt.plan_gif_dir,'sim_canvases{}.mp4'.format(str(time.time()))))
+    get_image_writer().flush() # Fill in the last plans
+    to_video([p for p in plans if p is not None], fn=os.path.join(opt.plan_gif_dir,'sim_canvases{}.mp4'.format(str(time.time()))))
     with torch.no_grad():
         save_image(painting(h*4,w*4, use_alpha=False), os.path.join(opt.plan_gif_dir, 'init_painting_plan{}.png'.format(str(time.time()))))
 
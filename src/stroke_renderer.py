@@ -0,0 +1,303 @@
+import math
+import warnings
+import torch
+import torch.nn.functional as F
+import torchgeometry
+import torchvision.transforms as T
+from torchvision.transforms import InterpolationMode
+bicubic = InterpolationMode.BICUBIC
+
+from param2stroke import special_sigmoid
+from brush_stroke import rigid_body_transform
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+def rigid_body_transforms(a, xt, yt, anchor_x, anchor_y):
+    ''' Batched version of brush_stroke.rigid_body_transform
+    args:
+        a, xt, yt (torch.Tensor[N]) : angle in radians and translation terms in pixels
+        anchor_x, anchor_y (float) : where to rotate around (usually the center of the image)
+    returns:
+        torch.Tensor[N,3,3] : one transformation matrix per stroke
+    '''
+    a = -1.*a
+    cos_a, sin_a = torch.cos(a), torch.sin(a)
+    zeros, ones = torch.zeros_like(a), torch.ones_like(a)
+    row0 = torch.stack([cos_a, -sin_a, anchor_x - anchor_x * cos_a + anchor_y * sin_a + xt], dim=-1)
+    row1 = torch.stack([sin_a,  cos_a, anchor_y - anchor_x * sin_a - anchor_y * cos_a + yt], dim=-1)
+    row2 = torch.stack([zeros, zeros, ones], dim=-1)
+    return torch.stack([row0, row1, row2], dim=-2)
+
+def normal_transform_pixel(h, w, device=device):
+    ''' Pixel to [-1,1] coordinates. Same convention as torchgeometry '''
+    return torch.tensor([[2./(w-1), 0.,       -1.],
+                         [0.,       2./(h-1), -1.],
+                         [0.,       0.,        1.]], device=device)
+
+def warp_strokes(strokes, M):
+    ''' Warp every stroke image by its own transform with a single grid_sample call.
+    Matches torchgeometry.warp_perspective(strokes, M, dsize=(h,w)), which is what
+    render_single_stroke uses for a single stroke.
+    args:
+        strokes (torch.Tensor[N,C,h,w])
+        M (torch.Tensor[N,3,3]) : pixel space transform from stroke image to canvas
+    '''
+    h, w = strokes.shape[2], strokes.shape[3]
+    norm = normal_transform_pixel(h, w, device=strokes.device)
+    M_norm = norm @ M @ torch.inverse(norm)
+    # grid_sample needs the canvas -> stroke image mapping
+    theta = torch.inverse(M_norm)[:, :2]
+    grid = F.affine_grid(theta, list(strokes.shape), align_corners=True)
+    # torchgeometry samples with grid_sample's default align_corners=False
+    return F.grid_sample(strokes, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+def render_stroke_alphas(param2img, stroke_length, stroke_bend, stroke_z, stroke_alpha,
+                         a, xt, yt, h, w):
+    ''' Render the alpha map of N strokes at once
+    args:
+        param2img : from param2stroke.get_param2img
+        stroke_length, stroke_bend, stroke_z, stroke_alpha, a, xt, yt (torch.Tensor[N])
+        h, w (int) : render size
+    returns:
+        torch.Tensor[N,1,h,w]
+    '''
+    full_param = torch.stack([stroke_length, stroke_bend, stroke_z, stroke_alpha], dim=1)
+    strokes = param2img(full_param, h, w).unsqueeze(1)
+
+    # Pad 1 or two to make it fit
+    if strokes.shape[2] != h or strokes.shape[3] != w:
+        strokes = T.Resize((h, w), bicubic, antialias=True)(strokes)
+
+    M = rigid_body_transforms(a, xt*(w/2), yt*(h/2), w/2, h/2)
+    x = warp_strokes(strokes, M)
+
+    # Remove stray color from the neural network being sloppy
+    return special_sigmoid(x)
+
+def render_single_stroke(param2img, stroke_length, stroke_bend, stroke_z, stroke_alpha,
+                         a, xt, yt, color, h, w):
+    ''' Render one stroke on its own. This is the reference that render_stroke_alphas
+    has to match; Painting.forward(batched=False) blends strokes from here one at a time.
+    args:
+        stroke_length, stroke_bend, stroke_z, stroke_alpha, a, xt, yt (torch.Tensor[1])
+        color (torch.Tensor[3])
+    returns:
+        torch.Tensor[1,4,h,w] : color in the first three channels, alpha in the last
+    '''
+    full_param = torch.cat([stroke_length, stroke_bend, stroke_z, stroke_alpha]).unsqueeze(0)
+    stroke = param2img(full_param, h, w).unsqueeze(0)
+
+    # Pad 1 or two to make it fit
+    if stroke.shape[2] != h or stroke.shape[3] != w:
+        stroke = T.Resize((h, w), bicubic, antialias=True)(stroke)
+
+    M = rigid_body_transform(a[0], xt[0]*(w/2), yt[0]*(h/2), w/2, h/2)
+    with warnings.catch_warnings(): # suppress annoing torchgeometry warning
+        warnings.simplefilter("ignore")
+        x = torchgeometry.warp_perspective(stroke, M, dsize=(h,w))
+
+    # Remove stray color from the neural network being sloppy
+    x = special_sigmoid(x)
+
+    return torch.cat([x*0 + color[None,:,None,None].to(x.device), x], dim=1)
+
+def composite_strokes(canvas, stroke_alphas, colors, use_alpha=True, opacity_factor=1.0):
+    ''' Alpha composite all the strokes onto the canvas in order (first stroke is at the bottom).
+    Equivalent to blending them one at a time like Painting.forward(batched=False):
+        canvas = canvas * (1 - alpha_i) + alpha_i * stroke_i
+    The final canvas is the background times the transmittance through every stroke
+    plus each stroke's color weighted by its alpha and the transmittance of the strokes on top of it.
+    args:
+        canvas (torch.Tensor[1,4,h,w]) : background with alpha channel
+        stroke_alphas (torch.Tensor[N,1,h,w])
+        colors (torch.Tensor[N,3])
+    '''
+    if len(stroke_alphas) == 0:
+        return canvas
+
+    x = stroke_alphas[:,0]
+    alphas = x * opacity_factor
+
+    # transmittance[i] = prod_{j>=i} (1 - alpha_j). Scan from the top stroke down.
+    transmittance = torch.flip(torch.cumprod(torch.flip(1 - alphas, dims=[0]), dim=0), dims=[0])
+    transmittance_above = torch.cat([transmittance[1:], torch.ones_like(transmittance[:1])], dim=0)
+    weights = alphas * transmittance_above # How much each stroke shows in the final canvas
+
+    rgb = canvas[:,:3] * transmittance[:1,None] \
+            + torch.einsum('nhw,nc->chw', weights, colors.to(weights.dtype))[None]
+    if not use_alpha:
+        return rgb
+    alpha = canvas[:,3:] * transmittance[:1,None] + (weights * x).sum(dim=0)[None,None]
+    return torch.cat([rgb, alpha], dim=1)
+
+def _stroke_image_to_canvas(x, y, g, h, w):
+    ''' Pixel coordinates in the unpadded param2img output -> canvas pixel coordinates 
+    before the rigid body transform. Inverse of the mapping in render_stroke_tiles. '''
+    x = (x + g['pad_left'] + 0.5) * (w / g['w_full']) - 0.5
+    y = (y + g['pad_top'] + 0.5) * (h / g['h_full']) - 0.5
+    return (x + 0.5) * ((w - 1) / w), (y + 0.5) * ((h - 1) / h)
+
+def stroke_tile_size(param2img, h, w):
+    ''' Side length of a square tile that fits the longest stroke at any rotation '''
+    g = param2img.geometry(h, w)
+    x0, y0 = _stroke_image_to_canvas(-1, -1, g, h, w)
+    x1, y1 = _stroke_image_to_canvas(g['w_p2i'], g['h_p2i'], g, h, w)
+    return int(math.ceil(math.hypot(x1 - x0, y1 - y0))) + 2
+
+def render_stroke_tiles(param2img, stroke_length, stroke_bend, stroke_z, stroke_alpha,
+                        a, xt, yt, h, w):
+    ''' Render the alpha map of N strokes, but only within a tile around each stroke.
+    The tile is placed on the bounding box of the stroke (from its position, rotation and length).
+    Same values as render_stroke_alphas inside the tile (up to the final bicubic resize 
+    render_stroke_alphas does when the padded param2img output is off by a pixel), ~0 outside of it.
+    args:
+        param2img : from param2stroke.get_param2img
+        stroke_length, stroke_bend, stroke_z, stroke_alpha, a, xt, yt (torch.Tensor[N])
+        h, w (int) : render size
+    returns:
+        torch.Tensor[N,1,T,T] : alpha tiles
+        torch.Tensor[N,2] : canvas pixel (y,x) of the top left corner of each tile. Can be off the canvas.
+    '''
+    g = param2img.geometry(h, w)
+    tile_size = stroke_tile_size(param2img, h, w)
+    hs, ws = g['h_p2i'], g['w_p2i']
+
+    full_param = torch.stack([stroke_length, stroke_bend, stroke_z, stroke_alpha], dim=1)
+    strokes = param2img.unpadded(full_param, h, w).unsqueeze(1)
+
+    M = rigid_body_transforms(a, xt*(w/2), yt*(h/2), w/2, h/2)
+
+    with torch.no_grad():
+        # Bounding box of the part of the stroke image that the stroke can cover
+        x_end = ((stroke_length + 2*g['xtra_room_horz_m']) / g['w_p2i_m'] * ws).clamp(max=ws)
+        ones = torch.ones_like(x_end)
+        corners_x = torch.stack([-ones, x_end, x_end, -ones], dim=1)
+        corners_y = torch.stack([-ones, -ones, ones*hs, ones*hs], dim=1)
+        corners_x, corners_y = _stroke_image_to_canvas(corners_x, corners_y, g, h, w)
+        corners = M @ torch.stack([corners_x, corners_y, torch.ones_like(corners_x)], dim=1)
+        center = (corners[:,:2].max(dim=2).values + corners[:,:2].min(dim=2).values) / 2
+        origin = torch.floor(center - tile_size/2).long()
+        origin[:,0] = origin[:,0].clamp(-tile_size, w)
+        origin[:,1] = origin[:,1].clamp(-tile_size, h)
+        origins = origin[:,[1,0]]
+
+    # Canvas pixels of each tile
+    ar = torch.arange(tile_size, device=strokes.device, dtype=M.dtype)
+    cx = (origin[:,0:1] + ar[None]).to(M.dtype)[:,None,:].expand(-1, tile_size, -1)
+    cy = (origin[:,1:2] + ar[None]).to(M.dtype)[:,:,None].expand(-1, -1, tile_size)
+
+    # Canvas -> stroke image. Same convention as torchgeometry.warp_perspective
+    M_inv = torch.inverse(M)
+    ux = M_inv[:,0,0,None,None]*cx + M_inv[:,0,1,None,None]*cy + M_inv[:,0,2,None,None]
+    uy = M_inv[:,1,0,None,None]*cx + M_inv[:,1,1,None,None]*cy + M_inv[:,1,2,None,None]
+    qx, qy = ux * (w / (w - 1)) - 0.5, uy * (h / (h - 1)) - 0.5
+    # Undo the resize to the render size and the padding
+    px = (qx + 0.5) * (g['w_full'] / w) - 0.5 - g['pad_left']
+    py = (qy + 0.5) * (g['h_full'] / h) - 0.5 - g['pad_top']
+    grid = torch.stack([(2*px + 1) / ws - 1, (2*py + 1) / hs - 1], dim=-1)
+    x = F.grid_sample(strokes, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    # Remove stray color from the neural network being sloppy
+    return special_sigmoid(x), origins
+
+def _tile_canvas_inds(origins, t, wp):
+    ''' Flat index of each tile pixel in the canvas padded by t on every side. Returns (N,T,T) '''
+    ar = torch.arange(t, device=origins.device)
+    ys = origins[:,0:1] + t + ar[None]
+    xs = origins[:,1:2] + t + ar[None]
+    return ys[:,:,None] * wp + xs[:,None,:]
+
+def composite_stroke_tiles(canvas, stroke_tiles, origins, colors, use_alpha=True, opacity_factor=1.0):
+    ''' Alpha composite stroke tiles onto the canvas in order (first stroke is at the bottom).
+    Same as composite_strokes, but the transmittance products only run over the strokes whose tiles
+    cover a pixel. They are sums of log(1 - alpha) over the tile pixels sorted by canvas pixel, and
+    the results are scattered with index_add, so the forward and backward passes cost O(N*T*T + h*w)
+    and never touch a full canvas per stroke.
+    args:
+        canvas (torch.Tensor[1,4,h,w]) : background with alpha channel
+        stroke_tiles (torch.Tensor[N,1,T,T]), origins (torch.Tensor[N,2]) : from render_stroke_tiles
+        colors (torch.Tensor[N,3])
+    '''
+    if len(stroke_tiles) == 0:
+        return canvas
+    t = stroke_tiles.shape[-1]
+    h, w = canvas.shape[2], canvas.shape[3]
+    hp, wp = h + 2*t, w + 2*t
+
+    # Every tile pixel, sorted by the canvas pixel it lands on. Stable, so bottom strokes come first
+    inds, perm = torch.sort(_tile_canvas_inds(origins, t, wp).flatten(), stable=True)
+    x = stroke_tiles[:,0].flatten()[perm]
+    alphas = x * opacity_factor
+    stroke_colors = colors.to(x.dtype)[perm // (t*t)]
+
+    # log(1 - alpha) in double so the running sums don't lose the small terms.
+    # Clamped since saturated strokes are exactly opaque
+    log_t = torch.log((1 - alphas).double().clamp(min=1e-12))
+    # suffix[k] = sum of log_t[k:]. The strokes on top of entry k at its pixel are k+1 up to the
+    # pixel's last entry, so their transmittance is exp(suffix[k+1] - suffix[last+1])
+    suffix = torch.flip(torch.cumsum(torch.flip(log_t, dims=[0]), dim=0), dims=[0])
+    suffix = torch.cat([suffix, suffix.new_zeros(1)])
+    k = torch.arange(len(inds), device=inds.device)
+    is_last = torch.cat([inds[1:] != inds[:-1], torch.ones_like(inds[:1], dtype=torch.bool)])
+    last = torch.flip(torch.cummin(torch.flip(torch.where(is_last, k, len(inds)), dims=[0]), dim=0).values, dims=[0])
+    weights = (alphas.double() * torch.exp(suffix[k+1] - suffix[last+1])).to(x.dtype)
+
+    def place(values):
+        ''' Sum values onto the padded canvas and crop it. Returns (C,h,w) '''
+        total = torch.zeros(hp*wp, values.shape[1], device=values.device, dtype=values.dtype)
+        total = total.index_add(0, inds, values)
+        return total.view(hp, wp, -1)[t:t+h,t:t+w].permute(2,0,1)
+
+    transmittance = torch.exp(place(log_t[:,None])).to(canvas.dtype)
+    rgb = canvas[:,:3] * transmittance[None] + place(weights[:,None] * stroke_colors)[None]
+    if not use_alpha:
+        return rgb
+    alpha = canvas[:,3:] * transmittance[None] + place((weights * x)[:,None])[None]
+    return torch.cat([rgb, alpha], dim=1)
+
+def sum_stroke_tiles(stroke_tiles, origins, h, w):
+    ''' Sum of the stroke tiles placed on the canvas. Returns (1,h,w) '''
+    t = stroke_tiles.shape[-1]
+    hp, wp = h + 2*t, w + 2*t
+    inds = _tile_canvas_inds(origins, t, wp)
+    total = torch.zeros(hp*wp, device=stroke_tiles.device, dtype=stroke_tiles.dtype)
+    total = total.index_add(0, inds.flatten(), stroke_tiles[:,0].flatten())
+    return total.view(1, hp, wp)[:,t:t+h,t:t+w]
+
+if __name__ == '__main__':
+    # Check that the batched and tiled renderers match rendering the strokes one at a time
+    #   python stroke_renderer.py --use_cache --cache_dir caches/small_brush --materials_json ../materials.json
+    from options import Options
+    from painting import Painting
+
+    opt = Options()
+    opt.gather_options()
+    torch.manual_seed(0)
+
+    h = int(opt.render_height)
+    w = int(opt.render_height * (opt.CANVAS_WIDTH_M/opt.CANVAS_HEIGHT_M))
+    background = torch.rand((1,3,h,w), device=device)
+    painting = Painting(opt, n_strokes=opt.num_strokes, background_img=background).to(device)
+
+    def run(batched, tile_compositing):
+        painting.zero_grad()
+        painting.tile_compositing = tile_compositing
+        p, alphas = painting(h, w, use_alpha=use_alpha, return_alphas=True,
+                             opacity_factor=opacity_factor, batched=batched)
+        torch.manual_seed(1)
+        loss = (p * torch.rand(p.shape, device=device)).sum() + alphas.mean()
+        loss.backward()
+        grads = [param.grad.clone() for param in painting.parameters() if param.grad is not None]
+        return p.detach(), alphas.detach(), grads
+
+    for use_alpha in [True, False]:
+        for opacity_factor in [1.0, 0.5]:
+            p0, a0, g0 = run(batched=False, tile_compositing=False)
+            for name, (p1, a1, g1) in [('batched', run(batched=True, tile_compositing=False)), 
+                                       ('tiles', run(batched=True, tile_compositing=True))]:
+                grad_diff = max([(x - y).abs().max().item() for x, y in zip(g0, g1)])
+                grad_scale = max([x.abs().max().item() for x in g0])
+                print('{} use_alpha={} opacity_factor={}: canvas max diff {:.2e}, alphas max diff {:.2e}, grad max diff {:.2e} (max grad {:.2e})'.format(
+                    name, use_alpha, opacity_factor, (p0 - p1).abs().max().item(), (a0 - a1).abs().max().item(),
+                    grad_diff, grad_scale))
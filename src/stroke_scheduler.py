@@ -0,0 +1,346 @@
+'''
+Order a plan's strokes for execution on the robot (--schedule_execution).
+
+The plan comes out of the optimization sorted by color, with no regard for where the strokes are.
+Executing it costs time in three ways: moving between strokes, painting the strokes, and cleaning
+the brush and getting new paint whenever the color changes. The scheduler:
+
+    1. Finds strokes that overlap and have different colors. Those keep their relative order, the
+       later one is on top in the plan and has to stay on top on the canvas.
+    2. Paints the colors in runs. A run is every stroke of one color whose constraints are met. It
+       keeps the current color while it can, otherwise it switches to the color with the most
+       strokes ready to go. Strokes of the same color don't constrain each other, so a run can
+       be done in any order.
+    3. Orders each run as a path from where the brush is: nearest neighbor chaining on a k-d tree,
+       improved with 2-opt and Or-opt moves between k-d tree neighbors.
+
+The time estimates use the --exec_* options. They aren't measured, they're for comparing orders.
+
+    painting = schedule_strokes(opt, painting, color_palette, curr_color=curr_color)
+'''
+
+import math
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+from paint_utils3 import canvas_to_global_coordinates, nearest_color_inds
+
+log_steps = {} # title -> how many times it has been logged
+
+
+def stroke_endpoints(opt, painting):
+    ''' Start and end of each stroke in painting order, in meters like BrushStroke.execute
+    returns:
+        (np.array[N,2], np.array[N,2])
+    '''
+    s = painting.brush_strokes.ordered()
+    with torch.no_grad():
+        # One copy to the CPU for all of the strokes
+        xt, yt, a, length = torch.stack([s['xt'], s['yt'], s['a'], s['stroke_length']]).detach().cpu().numpy()
+    x = np.clip(xt*0.5+0.5, 0., 1.)
+    y = np.clip(1 - (yt*0.5+0.5), 0., 1.)
+    x, y, _ = canvas_to_global_coordinates(x, y, None, opt)
+    starts = np.stack([x, y], axis=1)
+    ends = starts + length[:,None] * np.stack([np.cos(a), np.sin(a)], axis=1)
+    return starts, ends
+
+def stroke_color_inds(painting, color_palette, ink=False):
+    ''' Palette index of each stroke in painting order. All zeros without colors to change '''
+    n = len(painting.brush_strokes)
+    if ink or color_palette is None:
+        return np.zeros(n, dtype=np.int64)
+    with torch.no_grad():
+        colors = painting.brush_strokes.color_transform[painting.brush_strokes.order].detach()
+        return nearest_color_inds(colors, color_palette.to(colors.device)).cpu().numpy()
+
+def overlap_constraints(starts, ends, color_inds, margin=0.01):
+    '''
+    Pairs of strokes of different colors that may overlap. A stroke is treated as a circle around its
+    midpoint, as wide as the stroke plus margin (m).
+    returns:
+        list of (i, j) : stroke i (earlier in the current order) has to be painted before stroke j
+    '''
+    mids = (starts + ends) / 2
+    radii = np.linalg.norm(ends - starts, axis=1) / 2 + margin
+    if len(mids) < 2: return []
+    pairs = cKDTree(mids).query_pairs(r=2*radii.max(), output_type='ndarray')
+    if len(pairs) == 0: return []
+    i, j = pairs.min(axis=1), pairs.max(axis=1)
+    close = np.linalg.norm(mids[i] - mids[j], axis=1) < radii[i] + radii[j]
+    keep = close & (color_inds[i] != color_inds[j])
+    return list(zip(i[keep].tolist(), j[keep].tolist()))
+
+def hilbert_order(points, bits=16):
+    '''
+    Order of the points along a Hilbert curve over their bounding box. Points close on the curve
+    are close in space, so it's an O(N log N) approximation of a short path.
+    args:
+        points (np.array[N,2])
+    returns:
+        np.array[N] : indices into points
+    '''
+    n = len(points)
+    if n == 0: return np.zeros(0, dtype=np.int64)
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    side = (1 << bits) - 1
+    xy = ((points - lo) / np.maximum(hi - lo, 1e-12) * side).astype(np.int64)
+    x, y = xy[:,0].copy(), xy[:,1].copy()
+    d = np.zeros(n, dtype=np.int64)
+    s = 1 << (bits - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, side - x, x)
+        y = np.where(flip, side - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return np.argsort(d, kind='stable')
+
+def nearest_neighbor_path(points, start=None, k=8):
+    '''
+    Visit all the points, always going to the nearest unvisited one of the k nearest. When those
+    have all been visited, continue with the next unvisited point along a Hilbert curve, instead of
+    searching further away (which gets slow once most of the points are visited).
+    args:
+        points (np.array[N,2])
+    kwargs:
+        start (np.array[2]) : where the path starts from. Default is the first point on the Hilbert curve
+    returns:
+        np.array[N] : indices into points
+    '''
+    n = len(points)
+    if n == 0: return np.zeros(0, dtype=np.int64)
+    k = min(k, n)
+    tree = cKDTree(points)
+    # Every point's k nearest neighbors, in one query
+    nbrs = tree.query(points, k=k)[1].reshape(n, k).tolist()
+    curve = hilbert_order(points).tolist()
+    visited = [False] * n
+    path = []
+    curr = curve[0] if start is None else int(np.atleast_1d(tree.query(start)[1])[0])
+    next_on_curve = 0
+    while True:
+        visited[curr] = True
+        path.append(curr)
+        if len(path) == n: break
+        nxt = None
+        for j in nbrs[curr]:
+            if not visited[j]:
+                nxt = j
+                break
+        if nxt is None:
+            while visited[curve[next_on_curve]]: next_on_curve += 1
+            nxt = curve[next_on_curve]
+        curr = nxt
+    return np.array(path, dtype=np.int64)
+
+def _path_lookup(path, n_points):
+    pos = np.zeros(n_points, dtype=np.int64)
+    pos[path] = np.arange(len(path))
+    return pos
+
+def two_opt(points, path, start=None, k=8, max_passes=5, max_reverse=None):
+    '''
+    Shorten an open path by reversing sections of it, only trying to connect k-d tree neighbors
+    kwargs:
+        start (np.array[2]) : fixed point the path starts from
+        k (int) : neighbors to try for each point
+        max_reverse (int) : longest section to reverse, None for no limit
+    returns:
+        np.array[N] : the new path
+    '''
+    n = len(path)
+    if n < 3: return path
+    # Node 0 is the start (or a copy of the first point, which can then be moved)
+    q = np.concatenate([points[path[:1]] if start is None else np.asarray(start)[None], points[path]])
+    route = list(range(n+1))
+    nbrs = cKDTree(q[1:]).query(q, k=min(k+1, n))[1] + 1
+    qx, qy = q[:,0].tolist(), q[:,1].tolist()
+    def d(u, v): return math.hypot(qx[u]-qx[v], qy[u]-qy[v])
+
+    pos = _path_lookup(np.array(route), n+1)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n):
+            a, b = route[i], route[i+1]
+            for c in nbrs[a]:
+                j = pos[c]
+                if j <= i+1 or (max_reverse is not None and j-i > max_reverse): continue
+                e = route[j+1] if j < n else None
+                delta = d(a,c) - d(a,b) + ((d(b,e) - d(c,e)) if e is not None else 0.)
+                if delta < -1e-9:
+                    route[i+1:j+1] = route[i+1:j+1][::-1]
+                    pos[route[i+1:j+1]] = np.arange(i+1, j+1)
+                    a, b = route[i], route[i+1]
+                    improved = True
+        if not improved: break
+    return path[np.array(route[1:]) - 1]
+
+def or_opt(points, path, start=None, k=8, max_passes=3, segment_lengths=(1,2,3)):
+    '''
+    Shorten an open path by moving short sections of it next to a k-d tree neighbor (possibly reversed)
+    returns:
+        np.array[N] : the new path
+    '''
+    n = len(path)
+    if n < 3: return path
+    q = np.concatenate([points[path[:1]] if start is None else np.asarray(start)[None], points[path]])
+    route = list(range(n+1))
+    nbrs = cKDTree(q[1:]).query(q, k=min(k+1, n))[1] + 1
+    qx, qy = q[:,0].tolist(), q[:,1].tolist()
+    def d(u, v): return 0. if u is None or v is None else math.hypot(qx[u]-qx[v], qy[u]-qy[v])
+
+    pos = _path_lookup(np.array(route), n+1)
+    for _ in range(max_passes):
+        improved = False
+        for length in segment_lengths:
+            i = 1
+            while i + length - 1 <= n:
+                seg = route[i:i+length]
+                p, nxt = route[i-1], route[i+length] if i+length <= n else None
+                gain = d(p, seg[0]) + d(seg[-1], nxt) - (d(p, nxt) if nxt is not None else 0.)
+                best = None
+                for end, other in ((seg[0], seg[-1]), (seg[-1], seg[0])):
+                    for c in nbrs[end]:
+                        j = pos[c]
+                        if i-1 <= j < i+length: continue
+                        e = route[j+1] if j+1 <= n else None
+                        # Insert between c and e, entering the segment at end
+                        if e in seg: continue
+                        cost = d(c, end) + d(other, e) - (d(c, e) if e is not None else 0.)
+                        if cost < gain - 1e-9 and (best is None or cost < best[0]):
+                            best = (cost, c, end != seg[0])
+                if best is not None:
+                    _, c, reverse = best
+                    rest = route[:i] + route[i+length:]
+                    j = rest.index(c)
+                    route = rest[:j+1] + (seg[::-1] if reverse else seg) + rest[j+1:]
+                    pos = _path_lookup(np.array(route), n+1)
+                    improved = True
+                i += 1
+        if not improved: break
+    return path[np.array(route[1:]) - 1]
+
+def path_length(points, path, start=None):
+    p = points[path]
+    length = float(np.linalg.norm(p[1:] - p[:-1], axis=1).sum())
+    return length if start is None or len(p) == 0 else length + float(np.linalg.norm(p[0] - start))
+
+def order_run(points, start=None, k=8, max_reverse=None, or_opt_max_points=5000):
+    '''
+    Short open path through the points, from start. The shorter of nearest neighbor chaining and the
+    Hilbert curve order, improved by 2-opt and then by Or-opt (which is O(N) per move, so only up to
+    or_opt_max_points points)
+    '''
+    path = nearest_neighbor_path(points, start, k=k)
+    if start is None:
+        curve = hilbert_order(points)
+        if path_length(points, curve) < path_length(points, path): path = curve
+    path = two_opt(points, path, start, k=k, max_reverse=max_reverse)
+    if len(points) <= or_opt_max_points:
+        path = or_opt(points, path, start, k=k)
+    return path
+
+def schedule_order(starts, ends, color_inds, constraints, curr_color=-1, start_pos=None):
+    '''
+    Execution order of the strokes (see the top of this file)
+    args:
+        starts, ends (np.array[N,2]) : stroke endpoints
+        color_inds (np.array[N]) : palette index of each stroke
+        constraints (list of (i,j)) : i has to be painted before j
+    kwargs:
+        curr_color (int) : color currently on the brush
+        start_pos (np.array[2]) : where the brush is
+    returns:
+        np.array[N] : stroke indices in the order to paint them
+    '''
+    n = len(starts)
+    mids = (starts + ends) / 2
+    n_before = np.zeros(n, dtype=np.int64)
+    after = [[] for _ in range(n)]
+    for i, j in constraints:
+        n_before[j] += 1
+        after[i].append(j)
+
+    ready = {}
+    for i in np.nonzero(n_before == 0)[0].tolist():
+        ready.setdefault(int(color_inds[i]), []).append(i)
+
+    order, pos = [], start_pos
+    while len(order) < n:
+        ready = {c:inds for c, inds in ready.items() if len(inds) > 0}
+        if len(ready) == 0:
+            raise Exception('Stroke ordering constraints have a cycle')
+        if curr_color not in ready:
+            curr_color = max(ready.keys(), key=lambda c : (len(ready[c]), -c))
+        run = np.array(ready.pop(curr_color))
+        run = run[order_run(mids[run], pos)]
+        order += run.tolist()
+        pos = ends[run[-1]]
+        for i in run.tolist():
+            for j in after[i]:
+                n_before[j] -= 1
+                if n_before[j] == 0:
+                    ready.setdefault(int(color_inds[j]), []).append(j)
+    return np.array(order, dtype=np.int64)
+
+def estimate_execution_time(opt, starts, ends, color_inds, order=None, curr_color=-1, start_pos=None):
+    '''
+    Rough time it takes the robot to paint the strokes in this order. Cleans and gets paint
+    when the color changes, like paint.py and codraw.py.
+    returns:
+        dict of seconds : travel, strokes, paint (cleaning and getting paint), total
+    '''
+    order = np.arange(len(starts)) if order is None else order
+    t = {'travel':0., 'strokes':0., 'paint':0.}
+    if len(order) == 0:
+        t['total'] = 0.
+        return t
+    s, e = starts[order], ends[order]
+    travel = np.linalg.norm(s[1:] - e[:-1], axis=1).sum()
+    if start_pos is not None:
+        travel += np.linalg.norm(s[0] - start_pos)
+    t['travel'] = float(travel) / opt.exec_travel_speed
+    t['strokes'] = len(order) * opt.exec_stroke_time \
+        + float(np.linalg.norm(e - s, axis=1).sum()) / opt.exec_paint_speed
+    if not opt.ink:
+        colors = np.concatenate([[curr_color], color_inds[order]])
+        n_changes = int((colors[1:] != colors[:-1]).sum())
+        t['paint'] = n_changes * (2*opt.exec_clean_time + opt.exec_get_paint_time)
+    t['total'] = t['travel'] + t['strokes'] + t['paint']
+    return t
+
+def schedule_strokes(opt, painting, color_palette=None, curr_color=-1, start_pos=None, title='execution'):
+    '''
+    Reorder the painting's strokes for execution (in place) and report the estimated time before and after
+    kwargs:
+        color_palette (torch.Tensor[K,3]) : paint colors. None treats all the strokes as one color
+        curr_color (int) : index of the paint on the brush, -1 for none
+        start_pos (np.array[2]) : where the brush is (m), None if it doesn't matter
+    returns:
+        Painting : the same painting
+    '''
+    if len(painting) < 2: return painting
+    starts, ends = stroke_endpoints(opt, painting)
+    color_inds = stroke_color_inds(painting, color_palette, ink=opt.ink)
+    constraints = overlap_constraints(starts, ends, color_inds, margin=opt.exec_overlap_margin)
+
+    before = estimate_execution_time(opt, starts, ends, color_inds, None, curr_color, start_pos)
+    order = schedule_order(starts, ends, color_inds, constraints, curr_color, start_pos)
+    after = estimate_execution_time(opt, starts, ends, color_inds, order, curr_color, start_pos)
+    with torch.no_grad():
+        painting.brush_strokes.reorder(order)
+
+    print('Estimated execution time: {:.1f} min before scheduling, {:.1f} min after ({} strokes, {} constraints)'.format(
+        before['total']/60, after['total']/60, len(order), len(constraints)))
+    if opt.writer is not None:
+        step = log_steps.get(title, 0)
+        log_steps[title] = step + 1
+        for k in before.keys():
+            opt.writer.add_scalar('{}/estimated_{}_s_before'.format(title, k), before[k], step)
+            opt.writer.add_scalar('{}/estimated_{}_s_after'.format(title, k), after[k], step)
+    return painting
@@ -0,0 +1,50 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+
+def make_opt(cache_dir, render_height=48, args=[]):
+    ''' Options for the simulated painter, with a tiny random param2img in cache_dir
+    (like benchmarks/benchmark_planning.py, without importing the robot and camera code) '''
+    import torch
+    from options import Options
+    from param2stroke import StrokeParametersToImage
+
+    materials_json = os.path.join(ROOT_DIR, 'materials.json')
+    opt = Options()
+    parser = opt.initialize(argparse.ArgumentParser())
+    opt.opt = vars(parser.parse_args(['--simulate', '--cache_dir', cache_dir,
+        '--materials_json', materials_json, '--render_height', str(render_height)] + args))
+    with open(materials_json, 'r') as f:
+        opt.opt = {**opt.opt, **json.load(f)}
+    opt.h_render = int(opt.render_height)
+    opt.w_render = int(opt.render_height * (opt.CANVAS_WIDTH_M/opt.CANVAS_HEIGHT_M))
+
+    torch.manual_seed(0)
+    torch.save(StrokeParametersToImage().state_dict(), os.path.join(cache_dir, 'param2img.pt'))
+    settings = {
+        'w_p2i_m': opt.MAX_STROKE_LENGTH + 0.04,
+        'h_p2i_m': 2*opt.MAX_BEND + 0.002,
+        'xtra_room_horz_m': 0.01,
+        'xtra_room_vert_m': 0.001,
+        'MAX_BEND': opt.MAX_BEND,
+    }
+    with open(os.path.join(cache_dir, 'param2stroke_settings.json'), 'w') as f:
+        json.dump(settings, f, indent=4)
+    return opt
+
+@pytest.fixture
+def opt(tmp_path):
+    pytest.importorskip('torch')
+    import numpy as np
+    # random_init_painting shuffles the strokes with random
+    random.seed(0)
+    np.random.seed(0)
+    return make_opt(str(tmp_path))
@@ -0,0 +1,37 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+transforms = pytest.importorskip('torchvision.transforms')
+
+from losses.batched_augment import BatchedAugmentation
+
+
+@pytest.mark.parametrize('h,w', [(64, 64), (48, 96)])
+def test_crop_sizes_match_random_resized_crop(h, w):
+    n = 20000
+    scale, ratio = (0.7, 0.9), (3./4., 4./3.)
+    augment = BatchedAugmentation(32, scale=scale, ratio=ratio, perspective=False)
+    rand = lambda *shape : torch.rand(shape, dtype=torch.float64)
+    torch.manual_seed(0)
+    crop_w, crop_h, center = augment.sample_crop_size(n, h, w, rand)
+    assert bool((crop_w <= w).all()) and bool((crop_h <= h).all())
+
+    img = torch.zeros(1, h, w)
+    ref = torch.tensor([transforms.RandomResizedCrop.get_params(img, scale, ratio)[2:] for _ in range(n)],
+                       dtype=torch.float64)
+    ref_h, ref_w = ref[:,0], ref[:,1]
+    for ours, theirs in [(crop_w, ref_w), (crop_h, ref_h)]:
+        assert abs(ours.mean() - theirs.mean()) <= 0.01 * theirs.mean()
+        assert abs(ours.std() - theirs.std()) <= 0.05 * theirs.std() + 1e-6
+        # Clamping used to pile the crops up at the full size
+        assert abs((ours == ours.max()).double().mean() - (theirs == theirs.max()).double().mean()) < 0.01
+
+def test_center_crop_fallback():
+    # No crop of this scale and ratio fits in a very wide image
+    augment = BatchedAugmentation(32, scale=(0.9, 0.9), ratio=(1., 1.), perspective=False)
+    crop_w, crop_h, center = augment.sample_crop_size(8, 10, 100, lambda *shape : torch.rand(shape, dtype=torch.float64))
+    assert bool(center.all())
+    assert crop_w.tolist() == [10.]*8 and crop_h.tolist() == [10.]*8
+    M = augment.sample(8, 10, 100)
+    # The center crop starts at x = 45
+    assert torch.allclose(M[:,0,2], torch.full((8,), 45 + 0.5 * 10 / 32 - 0.5))
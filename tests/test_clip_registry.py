@@ -0,0 +1,29 @@
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import clip_registry
+
+
+def test_concurrent_first_calls_load_once(monkeypatch):
+    loads = []
+    def slow_load(name, device, jit, variant):
+        loads.append(name)
+        time.sleep(0.2)
+        return torch.nn.Linear(2, 2), None
+    monkeypatch.setattr(clip_registry, '_load', slow_load)
+    monkeypatch.setattr(clip_registry, '_models', type(clip_registry._models)())
+
+    models = []
+    threads = [threading.Thread(target=lambda : models.append(clip_registry.get_clip_model('test', 'cpu')))
+               for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert loads == ['test']
+    assert len(models) == 4 and all([m is models[0] for m in models])
+    assert clip_registry.evict_clip_model(name='test') == 1
+    assert clip_registry.loaded_clip_models() == []
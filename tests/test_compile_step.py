@@ -0,0 +1,45 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from paint_utils3 import random_init_painting
+from painting import device
+from painting_optimization import compute_objective_loss, get_compiled_step
+
+
+def test_compiled_step_matches_eager(opt):
+    h, w = opt.h_render, opt.w_render
+    torch.manual_seed(0)
+    opt.objective, opt.objective_weight = ['l2'], [1.0]
+    opt.objective_data_loaded = [torch.rand(1,3,h,w, device=device)]
+    opt.fill_weight = 0.1
+    init = random_init_painting(opt, torch.ones(1,3,h,w, device=device), 16, device=device)
+
+    eager, compiled = copy.deepcopy(init), copy.deepcopy(init)
+    eager_optims = eager.get_optimizers(multiplier=opt.lr_multiplier, ink=opt.ink)
+    compiled_optims = compiled.get_optimizers(multiplier=opt.lr_multiplier, ink=opt.ink)
+    step = get_compiled_step(opt, compiled, compiled_optims)
+    og_lrs = [o.param_groups[0]['lr'] if o is not None else None for o in eager_optims]
+
+    n_iters = 6
+    for it in range(n_iters):
+        # The learning rate schedule of optimize_painting, it must not need a recompile
+        lr_factor = (1 - 2*abs(it/n_iters - 0.5)) + 0.005
+        for optims in [eager_optims, compiled_optims]:
+            for o, lr in zip(optims, og_lrs):
+                if o is not None:
+                    o.zero_grad()
+                    o.param_groups[0]['lr'] = lr*lr_factor
+
+        loss, _ = compute_objective_loss(opt, eager)
+        loss.backward()
+        for o in eager_optims: o.step() if o is not None else None
+        eager.validate()
+
+        compiled_loss = step()
+        assert torch.allclose(compiled_loss, loss.detach(), rtol=1e-4, atol=1e-6)
+
+    for (name, p_eager), (_, p_compiled) in zip(eager.named_parameters(), compiled.named_parameters()):
+        assert torch.allclose(p_compiled, p_eager, rtol=1e-4, atol=1e-5), name
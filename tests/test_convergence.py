@@ -0,0 +1,30 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from convergence import get_convergence_monitor
+
+
+def test_monitor_several_paintings(opt):
+    opt.early_stop = True
+    paintings = [torch.nn.Linear(3, 2), torch.nn.Linear(4, 1)]
+    monitor = get_convergence_monitor(opt, paintings, 100)
+    assert len(monitor.params) == 4
+    assert monitor.enabled
+
+    # Nothing changes, so it converges once past min_iter and patience, and skips to the tail
+    skipped = []
+    for it in range(100):
+        if monitor.skip(it):
+            skipped.append(it)
+            continue
+        monitor.update(torch.tensor(1.0), it)
+    assert monitor.converged_at is not None
+    assert monitor.converged_at >= opt.early_stop_min_iter * 100
+    assert skipped == list(range(monitor.converged_at + 1, monitor.tail_start))
+
+def test_monitor_disabled(opt):
+    opt.early_stop = False
+    monitor = get_convergence_monitor(opt, torch.nn.Linear(3, 2), 100)
+    assert len(monitor.params) == 2
+    assert not any([monitor.update(torch.tensor(1.0), it) or monitor.skip(it) for it in range(100)])
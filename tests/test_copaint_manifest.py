@@ -0,0 +1,48 @@
+import os
+import pickle
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cofrida'))
+
+from copaint_manifest import claim_ranges, get_id_offset, load_manifest
+
+
+def test_get_id_offset_concurrent(tmp_path):
+    legacy = [{'id':i, 'text':'legacy {}'.format(i)} for i in range(5)]
+    with open(os.path.join(str(tmp_path), 'data_dict.pkl'), 'wb') as f:
+        pickle.dump(legacy, f)
+
+    offsets = []
+    threads = [threading.Thread(target=lambda : offsets.append(get_id_offset(str(tmp_path)))) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+    assert offsets == [5]*8
+    assert [e['id'] for e in load_manifest(str(tmp_path))] == list(range(5))
+    assert sorted(os.listdir(os.path.join(str(tmp_path), 'manifest'))) == ['legacy.jsonl', 'meta.json']
+    # Later calls don't redo the legacy import
+    assert get_id_offset(str(tmp_path)) == 5
+
+def test_claim_ranges_split_and_resume(tmp_path):
+    d = str(tmp_path)
+    worker0 = claim_ranges(d, 0, 10, 3)
+    assert [next(worker0) for _ in range(3)] == [0, 1, 2]
+    assert list(claim_ranges(d, 1, 10, 3)) == [3, 4, 5, 6, 7, 8, 9]
+    # Worker 0 restarted resumes its own range
+    assert list(claim_ranges(d, 0, 10, 3)) == [0, 1, 2]
+
+def test_claim_ranges_take_over_stale(tmp_path):
+    d = str(tmp_path)
+    worker0 = claim_ranges(d, 0, 4, 4, stale_after=60)
+    assert next(worker0) == 0
+
+    assert list(claim_ranges(d, 1, 4, 4, stale_after=60)) == []
+    # Worker 0 stops updating its claim
+    old = time.time() - 120
+    os.utime(os.path.join(d, 'claims', '000000.claim'), (old, old))
+    assert list(claim_ranges(d, 1, 4, 4, stale_after=60)) == [0, 1, 2, 3]
+    assert list(claim_ranges(d, 2, 4, 4, stale_after=60)) == []
+    # Worker 0 was only slow. It sees the range was taken over and stops
+    assert list(worker0) == []
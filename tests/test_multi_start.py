@@ -0,0 +1,51 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from multi_start import optimize_multi_start, render_paintings
+from paint_utils3 import random_init_painting
+from painting import device
+
+
+def make_inits(opt, k, n_strokes=16):
+    h, w = opt.h_render, opt.w_render
+    background = torch.ones(1,3,h,w, device=device)
+    inits = []
+    for seed in range(k):
+        torch.manual_seed(seed)
+        inits.append(random_init_painting(opt, background, n_strokes, device=device))
+    return inits
+
+def test_render_paintings_matches_painting(opt):
+    h, w = opt.h_render, opt.w_render
+    inits = make_inits(opt, 3)
+    with torch.no_grad():
+        renders = render_paintings(inits, h, w, use_alpha=True, return_alphas=True)
+        for painting, (p, alphas) in zip(inits, renders):
+            p0, alphas0 = painting(h, w, use_alpha=True, return_alphas=True)
+            assert torch.allclose(p, p0, atol=1e-4)
+            assert torch.allclose(alphas, alphas0, atol=1e-4)
+
+def test_optimize_multi_start(opt):
+    h, w = opt.h_render, opt.w_render
+    k, top_k = 3, 2
+    torch.manual_seed(0)
+    target = torch.rand(1,3,h,w, device=device)
+    def loss_fn(p, alphas):
+        return ((p[:,:3] - target)**2).mean()
+
+    inits = make_inits(opt, k)
+    with torch.no_grad():
+        init_losses = [loss_fn(p, alphas).item() for p, alphas in render_paintings(inits, h, w, return_alphas=True)]
+
+    best = optimize_multi_start(inits, loss_fn, 5, h, w, lr_multiplier=opt.lr_multiplier, 
+                                ink=opt.ink, opt=opt, top_k=top_k)
+
+    assert len(best) == top_k
+    losses = [loss for loss, painting in best]
+    assert losses == sorted(losses)
+    assert losses[0] < min(init_losses)
+    assert len(set([id(painting) for loss, painting in best])) == top_k
+    for loss, painting in best:
+        assert painting.brush_strokes.xt.device == inits[0].brush_strokes.xt.device
+        assert len(painting) == len(inits[0])
@@ -0,0 +1,72 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn.functional as F
+
+from brush_stroke import BrushStroke, StrokeBatch
+from painting import Painting, device
+from stroke_renderer import composite_strokes, composite_stroke_tiles
+
+
+def weighted_sum(canvas):
+    # Weight the pixels so every channel and location contributes differently to the gradients
+    weights = torch.rand(canvas.shape, generator=torch.Generator().manual_seed(1)).to(canvas.device)
+    return (canvas * weights).sum()
+
+def render_with_grads(painting, h, w, use_alpha, batched):
+    painting.zero_grad()
+    canvas = painting(h, w, use_alpha=use_alpha, batched=batched)
+    weighted_sum(canvas).backward()
+    grads = {name:getattr(painting.brush_strokes, name).grad for name in StrokeBatch.attributes}
+    return canvas.detach(), grads
+
+@pytest.mark.parametrize('use_alpha', [True, False])
+def test_batched_matches_sequential(opt, use_alpha):
+    h, w = opt.h_render, opt.w_render
+    torch.manual_seed(0)
+    painting = Painting(opt, background_img=torch.rand(1,3,h,w, device=device),
+                        brush_strokes=[BrushStroke(opt, device=device) for _ in range(12)])
+    painting.brush_strokes.reorder(torch.randperm(len(painting), device=device))
+
+    canvas_seq, grads_seq = render_with_grads(painting, h, w, use_alpha, batched=False)
+    canvas_bat, grads_bat = render_with_grads(painting, h, w, use_alpha, batched=True)
+
+    assert canvas_bat.shape == canvas_seq.shape
+    assert torch.allclose(canvas_bat, canvas_seq, atol=1e-4)
+    for name in StrokeBatch.attributes:
+        assert grads_seq[name] is not None, name
+        assert grads_bat[name] is not None, name
+        assert torch.allclose(grads_bat[name], grads_seq[name], rtol=1e-3, atol=1e-4), name
+
+@pytest.mark.parametrize('opacity_factor', [1.0, 0.5])
+@pytest.mark.parametrize('use_alpha', [True, False])
+def test_composite_stroke_tiles_matches_full_canvas(use_alpha, opacity_factor):
+    h, w, t, n = 20, 30, 8, 40
+    torch.manual_seed(0)
+    background = torch.rand(1,4,h,w, requires_grad=True)
+    # Some tiles hang off the canvas, and some strokes are fully opaque in places
+    tiles = torch.rand(n,1,t,t).pow(0.3).clamp(max=1.).requires_grad_()
+    origins = torch.stack([torch.randint(-t, h, (n,)), torch.randint(-t, w, (n,))], dim=1)
+    colors = torch.rand(n,3, requires_grad=True)
+
+    def run(tiled):
+        for x in [background, tiles, colors]: x.grad = None
+        if tiled:
+            canvas = composite_stroke_tiles(background, tiles, origins, colors, 
+                                            use_alpha=use_alpha, opacity_factor=opacity_factor)
+        else:
+            # The same tiles placed on full size alpha maps
+            alphas = torch.stack([F.pad(tiles[i:i+1], (x+t, w+t-x-t, y+t, h+t-y-t))[0,:,t:t+h,t:t+w]
+                                  for i, (y, x) in enumerate(origins.tolist())])
+            canvas = composite_strokes(background, alphas, colors, 
+                                       use_alpha=use_alpha, opacity_factor=opacity_factor)
+        weighted_sum(canvas).backward()
+        return canvas.detach(), [x.grad.clone() for x in [background, tiles, colors]]
+
+    canvas_full, grads_full = run(tiled=False)
+    canvas_tiles, grads_tiles = run(tiled=True)
+
+    assert canvas_tiles.shape == canvas_full.shape
+    assert torch.allclose(canvas_tiles, canvas_full, atol=1e-5)
+    for name, g_tiles, g_full in zip(['background', 'tiles', 'colors'], grads_tiles, grads_full):
+        assert torch.allclose(g_tiles, g_full, rtol=1e-4, atol=1e-5), name